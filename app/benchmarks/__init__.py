@@ -0,0 +1 @@
+# Benchmarks of the ingest, query and notify paths over synthetic data, run with: python -m benchmarks.run
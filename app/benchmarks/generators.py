@@ -0,0 +1,58 @@
+import json
+import random
+from io import StringIO
+import csv
+
+EMPLOYEE_HEADER = ['row_id', 'user_id', 'user_state', 'user_manager', 'user_mail']
+
+# Manager of the employee at `position` (0 based): the first one manages itself, as in employee_data.csv,
+# and the rest report to someone hired before them around position / fanout, so the tree is about
+# log_fanout(n) levels deep with uneven team sizes.
+def manager_position(position, fanout, rng):
+    if position == 0:
+        return 0
+    center = (position - 1) // fanout
+    return rng.randint(max(0, center - fanout), center)
+
+#Rows of N employees, with user_ids first_id..first_id + n - 1
+def generate_employee_rows(n, first_id=1, fanout=8, seed=0):
+    rng = random.Random(seed)
+    for position in range(n):
+        user_id = first_id + position
+        manager_id = first_id + manager_position(position, fanout, rng)
+        yield [position + 1, user_id, rng.random() < 0.9, manager_id, f"employee{user_id}@company.com"]
+
+#Same data as generate_employee_rows, as the csv accepted by /employees/upload
+def generate_employees_csv(n, first_id=1, fanout=8, seed=0):
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(EMPLOYEE_HEADER)
+    writer.writerows(generate_employee_rows(n, first_id, fanout, seed))
+    return buffer.getvalue()
+
+# Entries that /db_info/upload must reject, one per validation rule
+INVALID_ENTRIES = [
+    lambda owner_id, i: {'owner_id': owner_id, 'classification': 1},
+    lambda owner_id, i: {'db_name': None, 'owner_id': owner_id, 'classification': 1},
+    lambda owner_id, i: {'db_name': f"bench_{i}_db", 'owner_id': str(owner_id), 'classification': 1},
+    lambda owner_id, i: {'db_name': f"bench_{i}_db", 'owner_id': -owner_id, 'classification': 1},
+    lambda owner_id, i: {'db_name': f"bench_{i}_db", 'owner_id': owner_id, 'classification': 7},
+    lambda owner_id, i: {'db_name': f"bench_{i}_db", 'owner_id': 0x7fffffff, 'classification': 1},
+]
+
+# M db_info entries owned by the employees first_owner_id..first_owner_id + owners - 1. `invalid_share` of them
+# break one of the validation rules and `high_share` of the valid ones are classified HIGH, the rest spread
+# over the other classifications.
+def generate_db_info_entries(m, owners, first_owner_id=1, invalid_share=0.05, high_share=0.1, seed=0):
+    rng = random.Random(seed)
+    for i in range(m):
+        owner_id = first_owner_id + rng.randrange(owners)
+        if rng.random() < invalid_share:
+            yield rng.choice(INVALID_ENTRIES)(owner_id, i)
+            continue
+        classification = 3 if rng.random() < high_share else rng.randint(0, 2)
+        yield {'db_name': f"bench_{i}_db", 'owner_id': owner_id, 'classification': classification}
+
+#Same data as generate_db_info_entries, as the json accepted by /db_info/upload
+def generate_db_info_json(m, owners, first_owner_id=1, invalid_share=0.05, high_share=0.1, seed=0):
+    return json.dumps(list(generate_db_info_entries(m, owners, first_owner_id, invalid_share, high_share, seed)))
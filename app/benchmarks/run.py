@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import resource
+import threading
+import argparse
+from contextlib import contextmanager
+from sqlalchemy import select
+from database import engine, Session
+from models.employee import Employee
+from models.db_info import DBInfo
+from models.notification_outbox import NotificationOutbox
+from crud import create_multiple_employees_from_raw, create_multiple_db_info_from_raw, get_unclassified_dbs, notify_db_owners_manager, get_bulk_writer, BULK_WRITER
+from benchmarks.generators import generate_employees_csv, generate_db_info_json
+from benchmarks.smtp_sink import SMTPSink
+from notifier import RecipientRateLimiter
+
+#Resident set size of the process right now, in MB, or None where /proc is not available (it is linux only)
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * resource.getpagesize() / (1024 * 1024)
+
+# Samples the RSS on a thread every `interval` seconds while the block runs. ru_maxrss is the peak of the whole
+# process, so after the biggest step every later one would report it; this keeps the peak of the block alone,
+# along with the RSS before it.
+class RSSSampler:
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.baseline = None
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        rss = current_rss_mb()
+        if rss is not None:
+            self.peak = max(self.peak, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.baseline = self.peak = current_rss_mb()
+        if self.baseline is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.baseline is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+
+#Runs fn and returns its value along with the timing entry of the results; `count` gives the rows it handled.
+#Memory is the RSS before the step and its peak during it, in MB (None if it can't be read on this platform).
+def timed(name, fn, count):
+    with RSSSampler() as rss:
+        start = time.perf_counter()
+        value = fn()
+        seconds = time.perf_counter() - start
+    rows = count(value)
+    return value, {
+        'name': name,
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'rows_per_sec': round(rows / seconds) if seconds > 0 else None,
+        'rss_before_mb': round(rss.baseline, 1) if rss.baseline is not None else None,
+        'peak_rss_mb': round(rss.peak, 1) if rss.peak is not None else None,
+        'peak_rss_growth_mb': round(rss.peak - rss.baseline, 1) if rss.peak is not None else None,
+    }
+
+#Points the notifier at the sink for the duration of the block
+@contextmanager
+def mail_server(sink):
+    previous = {key: os.environ.get(key) for key in ('MAIL_SERVER', 'MAIL_PORT')}
+    os.environ.update(MAIL_SERVER=sink.host, MAIL_PORT=str(sink.port))
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+def check(result, name):
+    if not result['success']:
+        raise RuntimeError(f"{name} failed: {result.get('error')}")
+    return result
+
+# The notify steps email the managers of every HIGH database and send every queued outbox email, not only the
+# generated ones, so the benchmark refuses to run unless the database is a scratch one with none of them.
+def check_scratch_database(db):
+    for model in (Employee, DBInfo, NotificationOutbox):
+        if db.execute(select(model.id).limit(1)).first() is not None:
+            raise RuntimeError(f"{model.__tablename__} has rows, run the benchmarks against an empty scratch database")
+
+# Loads the synthetic data through the same crud functions the endpoints use and times each step.
+# Everything runs in one transaction that is rolled back at the end, so the database is left as it was.
+# It must be empty, see check_scratch_database.
+def run_benchmarks(employees=10000, dbs=50000, invalid_share=0.05, high_share=0.1, fanout=8, first_id=1000000, seed=0, writer=BULK_WRITER):
+    params = {
+        'employees': employees, 'dbs': dbs, 'invalid_share': invalid_share, 'high_share': high_share,
+        'fanout': fanout, 'first_id': first_id, 'seed': seed, 'writer': writer,
+    }
+    employees_csv = generate_employees_csv(employees, first_id, fanout, seed)
+    db_info_json = generate_db_info_json(dbs, employees, first_id, invalid_share, high_share, seed)
+    results = []
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        db = Session(bind=connection, join_transaction_mode='create_savepoint')
+        try:
+            check_scratch_database(db)
+            _, entry = timed('create_multiple_employees_from_raw',
+                             lambda: check(create_multiple_employees_from_raw(db, employees_csv, get_bulk_writer(db, Employee, writer)), 'employees upload'),
+                             lambda result: result['total'])
+            results.append(entry)
+
+            result, entry = timed('create_multiple_db_info_from_raw',
+                                  lambda: check(create_multiple_db_info_from_raw(db, db_info_json, get_bulk_writer(db, DBInfo, writer)), 'db_info upload'),
+                                  lambda result: result['total'] + len(result['invalid_entries']))
+            entry['inserted'] = result['total']
+            entry['rejected'] = len(result['invalid_entries'])
+            results.append(entry)
+
+            _, entry = timed('get_unclassified_dbs', lambda: get_unclassified_dbs(db), len)
+            results.append(entry)
+
+            # the send throughput is measured without the per-recipient rate limit, which would defer most emails
+            unlimited = RecipientRateLimiter(rate=0)
+            with SMTPSink() as sink, mail_server(sink):
+                recipients_with_errors, entry = timed('notify_db_owners_manager', lambda: notify_db_owners_manager(db, limiter=unlimited), lambda _: len(sink.messages))
+            entry['failed'] = len(recipients_with_errors)
+            entry['smtp_connections'] = sink.connections
+            results.append(entry)
+
+            # same databases, one message per manager
+            with SMTPSink() as sink, mail_server(sink):
+                recipients_with_errors, entry = timed('notify_db_owners_manager_digest', lambda: notify_db_owners_manager(db, digest=True, limiter=unlimited), lambda _: len(sink.messages))
+            entry['failed'] = len(recipients_with_errors)
+            entry['smtp_connections'] = sink.connections
+            results.append(entry)
+        finally:
+            db.close()
+            transaction.rollback()
+    return {'params': params, 'results': results}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the ingest, query and notify paths over synthetic data and print the results as JSON')
+    parser.add_argument('--employees', type=int, default=10000, help='employees to generate')
+    parser.add_argument('--dbs', type=int, default=50000, help='db_info entries to generate')
+    parser.add_argument('--invalid-share', type=float, default=0.05, help='share of db_info entries that must be rejected')
+    parser.add_argument('--high-share', type=float, default=0.1, help='share of valid db_info entries classified HIGH')
+    parser.add_argument('--fanout', type=int, default=8, help='average direct reports per manager')
+    parser.add_argument('--first-id', type=int, default=1000000, help='first generated user_id')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--writer', default=BULK_WRITER, choices=['auto', 'copy', 'insert', 'orm', 'upsert'], help='bulk writer used by the uploads')
+    parser.add_argument('--output', help='file to write the JSON results to, instead of stdout')
+    args = parser.parse_args(argv)
+    report = run_benchmarks(args.employees, args.dbs, args.invalid_share, args.high_share, args.fanout, args.first_id, args.seed, args.writer)
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report_json + '\n')
+    else:
+        print(report_json)
+
+# Run from the app directory against an empty scratch database: python -m benchmarks.run --employees 100000 --dbs 500000
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import threading
+import socketserver
+
+# Minimal local SMTP server standing in for mailhog in the benchmarks and tests.
+# Stores every accepted message, counts connections and refuses the recipients in `reject`.
+class SMTPSink:
+
+    def __init__(self, reject=(), host='127.0.0.1', port=0):
+        self.reject = set(reject)
+        self.messages = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                sink._handle(self.rfile, self.wfile)
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _handle(self, rfile, wfile):
+        with self._lock:
+            self.connections += 1
+
+        def reply(line):
+            wfile.write(line.encode('ascii') + b'\r\n')
+            wfile.flush()
+
+        reply('220 sink ESMTP')
+        sender, recipients = None, []
+        for raw in rfile:
+            line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+            command = line[:4].upper()
+            if command == 'EHLO':
+                reply('250-sink')
+                reply('250 8BITMIME')
+            elif command == 'HELO':
+                reply('250 sink')
+            elif command == 'MAIL':
+                sender, recipients = _address(line), []
+                reply('250 OK')
+            elif command == 'RCPT':
+                recipient = _address(line)
+                if recipient in self.reject:
+                    reply('550 mailbox unavailable')
+                else:
+                    recipients.append(recipient)
+                    reply('250 OK')
+            elif command == 'DATA':
+                reply('354 end data with <CR><LF>.<CR><LF>')
+                data = []
+                for raw_data in rfile:
+                    if raw_data in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(raw_data)
+                with self._lock:
+                    self.messages.append((sender, recipients, b''.join(data).decode('utf-8', 'replace')))
+                reply('250 OK')
+            elif command in ('RSET', 'NOOP'):
+                if command == 'RSET':
+                    sender, recipients = None, []
+                reply('250 OK')
+            elif command == 'QUIT':
+                reply('221 bye')
+                return
+            else:
+                reply('502 command not implemented')
+
+def _address(line):
+    return line.split(':', 1)[1].strip().split()[0].strip('<>')
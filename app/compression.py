@@ -0,0 +1,331 @@
+import os
+import zlib
+import zstandard
+from starlette.datastructures import Headers, MutableHeaders
+
+# Responses smaller than this many bytes are sent uncompressed, the headers would take most of the saving
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get('COMPRESSION_ZSTD_LEVEL', 3))
+# Largest upload accepted once decompressed, so a small compressed file can't expand without bound
+UPLOAD_MAX_DECOMPRESSED_SIZE = int(os.environ.get('UPLOAD_MAX_DECOMPRESSED_SIZE', 4 * 1024 * 1024 * 1024))
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+class DecompressionError(ValueError):
+    pass
+
+# Most bytes a single decompression step produces, so an upload is stopped at most this far past max_size and
+# a small compressed chunk never inflates in memory all at once. Deflate output is capped directly; zstd can't
+# cap its output, so its input is fed in slices that can't expand past this: a zstd block holds at most
+# 128 KiB and takes at least 4 bytes (an RLE block).
+DECOMPRESS_PIECE_SIZE = 8 * 1024 * 1024
+ZSTD_MAX_RATIO = 128 * 1024 // 4
+ZSTD_FEED_SIZE = DECOMPRESS_PIECE_SIZE // ZSTD_MAX_RATIO
+
+# Incremental decoder of gzip members or zstd frames, any number of them back to back
+# (as written by `cat a.gz b.gz` or pzstd).
+class StreamDecoder:
+
+    def __init__(self, encoding, max_size=UPLOAD_MAX_DECOMPRESSED_SIZE):
+        self.encoding = encoding
+        self.max_size = max_size
+        self._size = 0
+        self._obj = self._new()
+        # whether the current member got data and hasn't ended yet
+        self._open = False
+
+    def _new(self):
+        if self.encoding == 'gzip':
+            return zlib.decompressobj(zlib.MAX_WBITS | 16)
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    #Yields the output of `data` in pieces of at most about DECOMPRESS_PIECE_SIZE bytes, checking max_size on each
+    def decompress(self, data):
+        pieces = self._gzip_pieces(data) if self.encoding == 'gzip' else self._zstd_pieces(data)
+        try:
+            for piece in pieces:
+                self._size += len(piece)
+                if self._size > self.max_size:
+                    raise DecompressionError(f"upload is larger than {self.max_size} bytes once decompressed")
+                if piece:
+                    yield piece
+        except (zlib.error, zstandard.ZstdError) as e:
+            raise DecompressionError(f"corrupt {self.encoding} upload: {e}") from e
+
+    def _gzip_pieces(self, data):
+        while data or self._open:
+            self._open = True
+            piece = self._obj.decompress(data, DECOMPRESS_PIECE_SIZE)
+            yield piece
+            if self._obj.eof:
+                data = self._obj.unused_data
+                self._obj = self._new()
+                self._open = False
+                continue
+            data = self._obj.unconsumed_tail
+            if not data and len(piece) < DECOMPRESS_PIECE_SIZE:
+                # input consumed and nothing held back by the output limit
+                return
+
+    def _zstd_pieces(self, data):
+        data = memoryview(data)
+        while data:
+            self._open = True
+            fed = data[:ZSTD_FEED_SIZE]
+            yield self._obj.decompress(fed)
+            if self._obj.eof:
+                data = data[len(fed) - len(self._obj.unused_data):]
+                self._obj = self._new()
+                self._open = False
+            else:
+                data = data[len(fed):]
+
+    def close(self):
+        if self._open:
+            raise DecompressionError(f"truncated {self.encoding} upload")
+
+#Compression of an upload from its first bytes: 'gzip', 'zstd' or None for plain text
+def detect_compression(head):
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+# Decompresses an upload fed in byte chunks if it starts as a gzip or zstd stream, passes it through otherwise.
+# The first bytes are held until there are enough of them to tell. feed and close return the output pieces.
+class UploadDecoder:
+
+    def __init__(self, max_size=UPLOAD_MAX_DECOMPRESSED_SIZE):
+        self.max_size = max_size
+        self.encoding = None
+        self._head = b''
+        self._decoder = None
+        self._plain = False
+
+    def feed(self, chunk):
+        if self._plain:
+            return (chunk,)
+        if self._decoder is not None:
+            return self._decoder.decompress(chunk)
+        self._head += chunk
+        if len(self._head) < len(ZSTD_MAGIC):
+            return ()
+        return self._start()
+
+    def _start(self):
+        head, self._head = self._head, b''
+        self.encoding = detect_compression(head)
+        if self.encoding is None:
+            self._plain = True
+            return (head,)
+        self._decoder = StreamDecoder(self.encoding, self.max_size)
+        return self._decoder.decompress(head)
+
+    def close(self):
+        output = list(self._start()) if self._head else []
+        if self._decoder is not None:
+            self._decoder.close()
+        return output
+
+def iter_decompressed(chunks, max_size=UPLOAD_MAX_DECOMPRESSED_SIZE):
+    decoder = UploadDecoder(max_size)
+    for chunk in chunks:
+        for output in decoder.feed(chunk):
+            if output:
+                yield output
+    for output in decoder.close():
+        if output:
+            yield output
+
+async def aiter_decompressed(chunks, max_size=UPLOAD_MAX_DECOMPRESSED_SIZE):
+    decoder = UploadDecoder(max_size)
+    async for chunk in chunks:
+        for output in decoder.feed(chunk):
+            if output:
+                yield output
+    for output in decoder.close():
+        if output:
+            yield output
+
+# Incremental encoders of the response bodies. compress(data, flush=True) returns everything written so far,
+# so each chunk of a streamed body reaches the client as soon as it is produced.
+class GzipEncoder:
+
+    def __init__(self, level=None):
+        self._obj = zlib.compressobj(COMPRESSION_GZIP_LEVEL if level is None else level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data, flush=False):
+        output = self._obj.compress(data)
+        return output + self._obj.flush(zlib.Z_SYNC_FLUSH) if flush else output
+
+    def finish(self):
+        return self._obj.flush()
+
+class ZstdEncoder:
+
+    def __init__(self, level=None):
+        self._obj = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL if level is None else level).compressobj()
+
+    def compress(self, data, flush=False):
+        output = self._obj.compress(data)
+        return output + self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK) if flush else output
+
+    def finish(self):
+        return self._obj.flush()
+
+ENCODERS = {'zstd': ZstdEncoder, 'gzip': GzipEncoder}
+
+#Picks the response encoding for an Accept-Encoding header: the accepted one with the highest q, zstd on ties
+def negotiate_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(','):
+        name, *params = [piece.strip() for piece in part.split(';')]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            weights[name.lower()] = q
+    best, best_q = None, 0.0
+    for encoding in ENCODERS:
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+#ETag of the `encoding` compressed representation of the response tagged `etag`
+def encoded_etag(etag, encoding):
+    if not etag.endswith('"'):
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+#If-None-Match as the app sees it for a request negotiated to `encoding`
+def decoded_if_none_match(if_none_match, encoding):
+    tags = []
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        suffix = next((f'-{name}"' for name in ENCODERS if tag.endswith(f'-{name}"')), None)
+        if suffix is None:
+            # '*' and the tags of uncompressed responses, sent when the body was under minimum_size
+            tags.append(tag)
+        elif suffix == f'-{encoding}"':
+            tags.append(tag[:-len(suffix)] + '"')
+    return ', '.join(tags)
+
+_COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/x-ndjson')
+
+# ASGI middleware compressing text, json and ndjson responses with the encoding negotiated from Accept-Encoding.
+# Bodies sent in one piece are compressed if they reach minimum_size. Streamed bodies are buffered until they
+# reach it, then compressed chunk by chunk, so they keep streaming. Each encoding gets its own strong ETag,
+# the app's tag with the encoding appended ("abc" -> "abc-gzip"), since the compressed bytes are not the ones
+# the app's tag was computed for. If-None-Match is rewritten on the way in so the app compares its own tags:
+# tags for the negotiated encoding lose their suffix, tags for another encoding are dropped.
+class ResponseCompressionMiddleware:
+
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        encoding = negotiate_encoding(headers.get('accept-encoding'))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        if_none_match = headers.get('if-none-match')
+        if if_none_match:
+            raw = [(name, value) for name, value in scope['headers'] if name != b'if-none-match']
+            decoded = decoded_if_none_match(if_none_match, encoding)
+            if decoded:
+                raw.append((b'if-none-match', decoded.encode('latin-1')))
+            # in place, so the route the router sets on the scope reaches the outer middlewares
+            scope['headers'] = raw
+        await self.app(scope, receive, _CompressingSend(send, encoding, self.minimum_size, if_none_match))
+
+class _CompressingSend:
+
+    def __init__(self, send, encoding, minimum_size, if_none_match=None):
+        self.send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.if_none_match = if_none_match
+        self.start = None
+        # None until decided, then the encoder or False to pass the body through
+        self.encoder = None
+        self.buffered = []
+        self.buffered_size = 0
+
+    async def __call__(self, message):
+        if message['type'] == 'http.response.start':
+            self.start = message
+            headers = Headers(raw=message['headers'])
+            content_type = headers.get('content-type', '')
+            if message['status'] != 200 or 'content-encoding' in headers or not content_type.startswith(_COMPRESSIBLE_TYPES):
+                self.encoder = False
+                if message['status'] == 304:
+                    # the 304 stands for the response that would have been sent, compressed or not
+                    headers = MutableHeaders(raw=message['headers'])
+                    headers.add_vary_header('Accept-Encoding')
+                    self._tag_not_modified(headers)
+                await self.send(message)
+            return
+        if message['type'] != 'http.response.body' or self.encoder is False:
+            await self.send(message)
+            return
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.encoder is None:
+            self.buffered.append(body)
+            self.buffered_size += len(body)
+            if more_body and self.buffered_size < self.minimum_size:
+                return
+            body = b''.join(self.buffered)
+            self.buffered = []
+            if self.buffered_size < self.minimum_size:
+                self.encoder = False
+                MutableHeaders(raw=self.start['headers']).add_vary_header('Accept-Encoding')
+                await self.send(self.start)
+                await self.send({'type': 'http.response.body', 'body': body, 'more_body': False})
+                return
+            self.encoder = ENCODERS[self.encoding]()
+            headers = MutableHeaders(raw=self.start['headers'])
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            if 'etag' in headers:
+                headers['ETag'] = encoded_etag(headers['etag'], self.encoding)
+            if not more_body:
+                compressed = self.encoder.compress(body) + self.encoder.finish()
+                headers['Content-Length'] = str(len(compressed))
+                await self.send(self.start)
+                await self.send({'type': 'http.response.body', 'body': compressed, 'more_body': False})
+                return
+            if 'content-length' in headers:
+                del headers['Content-Length']
+            await self.send(self.start)
+        if more_body:
+            compressed = self.encoder.compress(body, flush=True)
+            if compressed:
+                await self.send({'type': 'http.response.body', 'body': compressed, 'more_body': True})
+        else:
+            await self.send({'type': 'http.response.body', 'body': self.encoder.compress(body) + self.encoder.finish(), 'more_body': False})
+
+    #A 304 carries the tag the client matched: the encoded one if it sent that, the app's one otherwise
+    def _tag_not_modified(self, headers):
+        etag = headers.get('etag')
+        if not etag or not self.if_none_match:
+            return
+        encoded = encoded_etag(etag, self.encoding)
+        if any(tag.strip().removeprefix('W/') == encoded.removeprefix('W/') for tag in self.if_none_match.split(',')):
+            headers['ETag'] = encoded
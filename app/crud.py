@@ -1,23 +1,60 @@
+import os
 import json
+import uuid
+import random
 import csv
+import time
+import asyncio
+import threading
+import multiprocessing
+from operator import itemgetter
+from abc import ABC, abstractmethod
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_left
 from io import StringIO
-from database import Session
+from database import Session, AsyncSession
+from migrate import load_migration
+from sqlalchemy import insert, select, update, delete, func, text, literal_column, bindparam, Interval
+from sqlalchemy.dialects.postgresql import insert as pg_insert, aggregate_order_by, array as pg_array
+from sqlalchemy.orm import aliased
 from sqlalchemy.exc import IntegrityError
-from models.db_info import DBInfo, DBClass
+from pydantic import ValidationError
+from asyncpg.exceptions import IntegrityConstraintViolationError
+from models.db_info import DBInfo, DBClass, default_db_name
 from models.employee import Employee
+from models.notification_ledger import NotificationLedger
+from models.notification_outbox import NotificationOutbox
+from models.employee_closure import EmployeeClosure
+from models.db_info_summary import DBInfoSummary
 import schemas
+from schemas import DBInfoEntries
 import logging
-from notifier import send_email_notification
+import metrics
+from notifier import deliver_notifications, SENT, FAILED, REJECTED, DEFERRED, MAIL_TIMEOUT, MAIL_POOL_SIZE
+from streaming import CSVDictStream, JSONArrayStream, iter_parsed, aiter_parsed, iter_batches, aiter_batches, aiter_items, split_csv_shards, split_json_array_shards
 
 logger = logging.getLogger(__name__)
 
+# Rows committed per transaction when uploads are ingested in streaming mode
+DEFAULT_BATCH_SIZE = int(os.environ.get('UPLOAD_BATCH_SIZE', 5000))
+# Rejected db_info entries returned by a streaming upload, the rest are only counted
+DEFAULT_MAX_INVALID = int(os.environ.get('UPLOAD_MAX_INVALID', 1000))
+# Bulk writer used by the upload paths: auto, copy, insert or orm (see get_bulk_writer)
+BULK_WRITER = os.environ.get('BULK_WRITER', 'auto')
+# db_info entries validated together when streaming an upload
+VALIDATION_BATCH_SIZE = 1000
+
 #for testing only
 def create_employee(db:Session, employee: schemas.EmployeeCreate):
     db.add(employee)
     try:
         db.commit()
     except IntegrityError as e:
-        logger.error(f"Integrity Error creating employee: {repr(e)}")
+        logger.error('Integrity Error creating employee: %r', e)
         return False
     logger.debug('employee created')
     return True
@@ -30,21 +67,495 @@ def parse_employee_from_raw(raw_employee):
                 int(raw_employee['user_manager'])
     )
 
-def create_multiple_employees_from_raw(db: Session, raw_csv):
-    raw_emp_csv = StringIO(raw_csv)
-    csvReader = csv.DictReader(raw_emp_csv)
-    new_employees = []
-    for raw_employee in csvReader:
-        new_employees.append(parse_employee_from_raw(raw_employee))
-    db.add_all(new_employees)
-    try:
+#Same conversion as parse_employee_from_raw, but to a compact tuple laid out as EMPLOYEE_COLUMNS
+def employee_row_from_raw(raw_employee):
+    return (
+                int(raw_employee['user_id']),
+                raw_employee['user_state'].lower() == 'true',
+                str(raw_employee['user_mail']),
+                int(raw_employee['user_manager'])
+    )
+
+# With workers > 1 big uploads are parsed in that many processes (see parse_employees_sharded)
+def create_multiple_employees_from_raw(db: Session, raw_csv, writer=None, upsert=False, workers=1):
+    rows = parse_employees_sharded(raw_csv, workers) if workers > 1 else None
+    if rows is None:
+        rows = (employee_row_from_raw(raw_employee) for raw_employee in csv.DictReader(StringIO(raw_csv)))
+    user_ids = array('q')
+    result = commit_in_batches(db, recording_user_ids(rows, user_ids), writer or get_bulk_writer(db, Employee, upload_method(upsert)), batch_size=None, label='employee')
+    if rows_written(result):
+        refresh_employee_closure(db, user_ids)
+    if result['success']:
+        logger.info('Successfully added %d employees', result['total'])
+    return result
+
+# Streaming version of create_multiple_employees_from_raw: consumes text chunks as they are read
+# and commits every batch_size rows, so memory stays bounded by the batch and not by the file.
+def create_multiple_employees_from_stream(db: Session, text_chunks, batch_size=DEFAULT_BATCH_SIZE, on_batch=None, writer=None, upsert=False):
+    parser = CSVDictStream()
+    rows = (employee_row_from_raw(raw_employee) for raw_employee in iter_parsed(parser, text_chunks))
+    user_ids = array('q')
+    result = commit_in_batches(db, recording_user_ids(rows, user_ids), writer or get_bulk_writer(db, Employee, upload_method(upsert)), batch_size, on_batch, label='employee')
+    if rows_written(result):
+        refresh_employee_closure(db, user_ids)
+    if result['success']:
+        logger.info('Successfully added %d employees in %d batches', result['total'], len(result['batches']))
+    return result
+
+# Async version of create_multiple_employees_from_stream, text_chunks is an async iterable.
+# With batch_size None all the rows are committed in one transaction.
+async def create_multiple_employees_from_stream_async(db: AsyncSession, text_chunks, batch_size=DEFAULT_BATCH_SIZE, on_batch=None, writer=None, upsert=False):
+    parser = CSVDictStream()
+    rows = (employee_row_from_raw(raw_employee) async for raw_employee in aiter_parsed(parser, text_chunks))
+    user_ids = array('q')
+    result = await commit_in_batches_async(db, arecording_user_ids(rows, user_ids), writer or get_bulk_writer(db, Employee, upload_method(upsert)), batch_size, on_batch, label='employee')
+    if rows_written(result):
+        await refresh_employee_closure_async(db, user_ids)
+    if result['success']:
+        logger.info('Successfully added %d employees in %d batches', result['total'], len(result['batches']))
+    return result
+
+_closure_migration = load_migration(5)
+# Rebuilds the manager tree closure (models/employee_closure.py) from the whole employee table in one statement,
+# the same one the migration that created it ran
+EMPLOYEE_CLOSURE_REBUILD = text(_closure_migration.EMPLOYEE_CLOSURE_REBUILD)
+# The closure rows of the employees in :user_ids
+EMPLOYEE_CLOSURE_INSERT = text(_closure_migration.closure_insert('user_id = ANY(:user_ids)'))
+# Employees below (and including) those of :user_ids that are new or report to another manager than the closure
+# says, i.e. every employee whose chain of managers an upload changed
+EMPLOYEE_CLOSURE_CHANGED_SUBTREES = text("""
+    WITH RECURSIVE changed AS (
+        SELECT e.user_id FROM employee e
+        WHERE e.user_id = ANY(:user_ids) AND (
+            NOT EXISTS (SELECT 1 FROM employee_closure c WHERE c.ancestor_id = e.user_id AND c.descendant_id = e.user_id)
+            OR (SELECT c.ancestor_id FROM employee_closure c WHERE c.descendant_id = e.user_id AND c.depth = 1)
+               IS DISTINCT FROM nullif(e.user_manager, e.user_id)
+        )
+    ), subtree (user_id) AS (
+        SELECT user_id FROM changed
+        UNION
+        SELECT e.user_id FROM subtree JOIN employee e ON e.user_manager = subtree.user_id
+    )
+    SELECT user_id FROM subtree
+""")
+# Serializes concurrent refreshes, any value not used by another advisory lock
+EMPLOYEE_CLOSURE_LOCK_ID = 7364002
+# Uploads with more employees than this rebuild the whole closure, one statement beats looking up each of them
+EMPLOYEE_CLOSURE_INCREMENTAL_MAX = int(os.environ.get('EMPLOYEE_CLOSURE_INCREMENTAL_MAX', 50000))
+
+#Whether an upload wrote any row, upserts that found every row unchanged leave the tables as they were
+def rows_written(result):
+    if 'inserted' in result:
+        return result['inserted'] + result['updated'] > 0
+    return result['total'] > 0
+
+#Passes employee rows through, appending their user_id to `user_ids` as they are read
+def recording_user_ids(rows, user_ids):
+    for row in rows:
+        user_ids.append(row[0])
+        yield row
+
+async def arecording_user_ids(rows, user_ids):
+    async for row in rows:
+        user_ids.append(row[0])
+        yield row
+
+# Recomputes the whole closure from the employee table, for the repair script (rebuild_closure.py)
+def rebuild_employee_closure(db: Session):
+    started = time.perf_counter()
+    db.execute(select(func.pg_advisory_xact_lock(EMPLOYEE_CLOSURE_LOCK_ID)))
+    db.execute(delete(EmployeeClosure))
+    db.execute(EMPLOYEE_CLOSURE_REBUILD)
+    db.commit()
+    logger.info('Rebuilt employee closure in %.3fs', time.perf_counter() - started)
+
+# An upload can add employees anywhere in the tree or, with upserts, move whole subtrees. Once it is done the
+# closure rows of the uploaded employees whose manager changed, and of everyone below them, are replaced in
+# their own transaction; the rest of the tree keeps its rows. Readers see the previous closure until it commits.
+# The first load, or a very big upload, rebuilds it whole instead.
+def refresh_employee_closure(db: Session, user_ids):
+    started = time.perf_counter()
+    db.execute(select(func.pg_advisory_xact_lock(EMPLOYEE_CLOSURE_LOCK_ID)))
+    if len(user_ids) > EMPLOYEE_CLOSURE_INCREMENTAL_MAX or db.execute(select(EmployeeClosure.depth).limit(1)).first() is None:
+        db.execute(delete(EmployeeClosure))
+        db.execute(EMPLOYEE_CLOSURE_REBUILD)
         db.commit()
-    except IntegrityError as e:
-        logger.error(f"IntegrityError creating multiple employees from raw: {repr(e)}")
-        db.rollback()
-        return  {'success': False, 'error': repr(e).split('DETAIL')[1]}
-    logger.debug(f"Successfully added {len(new_employees)} employees")
-    return {'success': True}
+        logger.info('Rebuilt employee closure in %.3fs', time.perf_counter() - started)
+        return
+    subtrees = db.execute(EMPLOYEE_CLOSURE_CHANGED_SUBTREES, {'user_ids': list(user_ids)}).scalars().all()
+    if subtrees:
+        db.execute(delete(EmployeeClosure).where(EmployeeClosure.descendant_id.in_(subtrees)))
+        db.execute(EMPLOYEE_CLOSURE_INSERT, {'user_ids': subtrees})
+    db.commit()
+    logger.info('Refreshed employee closure of %d employees in %.3fs', len(subtrees), time.perf_counter() - started)
+
+async def refresh_employee_closure_async(db: AsyncSession, user_ids):
+    started = time.perf_counter()
+    await db.execute(select(func.pg_advisory_xact_lock(EMPLOYEE_CLOSURE_LOCK_ID)))
+    if len(user_ids) > EMPLOYEE_CLOSURE_INCREMENTAL_MAX or (await db.execute(select(EmployeeClosure.depth).limit(1))).first() is None:
+        await db.execute(delete(EmployeeClosure))
+        await db.execute(EMPLOYEE_CLOSURE_REBUILD)
+        await db.commit()
+        logger.info('Rebuilt employee closure in %.3fs', time.perf_counter() - started)
+        return
+    subtrees = (await db.execute(EMPLOYEE_CLOSURE_CHANGED_SUBTREES, {'user_ids': list(user_ids)})).scalars().all()
+    if subtrees:
+        await db.execute(delete(EmployeeClosure).where(EmployeeClosure.descendant_id.in_(subtrees)))
+        await db.execute(EMPLOYEE_CLOSURE_INSERT, {'user_ids': subtrees})
+    await db.commit()
+    logger.info('Refreshed employee closure of %d employees in %.3fs', len(subtrees), time.perf_counter() - started)
+
+# Writes row tuples coming from a generator every batch_size rows (all of them in one transaction if
+# batch_size is None). Batches committed before a failure are kept, 'total' reports how many rows
+# made it in and 'report' the writer used and its throughput. Writers that tell apart what they did
+# with the rows (upsert) add their counts to the result, e.g. 'inserted', 'updated' and 'unchanged'. `rejected` holds the RejectedEntries
+# filtered out of `rows`, counted in the ingest metrics once the upload ends.
+def commit_in_batches(db: Session, rows, writer, batch_size=DEFAULT_BATCH_SIZE, on_batch=None, label='rows', rejected=None):
+    progress = BatchProgress(writer, on_batch, label, rejected)
+    for batch in iter_batches(rows, batch_size):
+        write_started = time.perf_counter()
+        try:
+            changes = writer.write(db, batch)
+            db.commit()
+        except IntegrityError as e:
+            db.rollback()
+            progress.failed(batch, e)
+            break
+        progress.committed(batch, time.perf_counter() - write_started, changes)
+    return progress.finish()
+
+async def commit_in_batches_async(db: AsyncSession, rows, writer, batch_size=DEFAULT_BATCH_SIZE, on_batch=None, label='rows', rejected=None):
+    progress = BatchProgress(writer, on_batch, label, rejected)
+    async for batch in aiter_batches(rows, batch_size):
+        write_started = time.perf_counter()
+        try:
+            changes = await writer.write_async(db, batch)
+            await db.commit()
+        except IntegrityError as e:
+            await db.rollback()
+            progress.failed(batch, e)
+            break
+        progress.committed(batch, time.perf_counter() - write_started, changes)
+    return progress.finish()
+
+#Bookkeeping of commit_in_batches, shared by the sync and async versions
+class BatchProgress:
+
+    def __init__(self, writer, on_batch, label, rejected=None):
+        self.writer = writer
+        self.on_batch = on_batch
+        self.label = label
+        self.rejected = rejected
+        self.result = {'success': True, 'total': 0, 'batches': []}
+        self.result.update((key, 0) for key in writer.change_counts)
+        self.started = time.perf_counter()
+        self.write_seconds = 0.0
+        # rows that reached a batch, committed or not
+        self.validated = 0
+        self.rejected_so_far = 0
+        self.batch_seconds = metrics.INGEST_BATCH_SECONDS.labels(label, writer.method)
+
+    def committed(self, batch, write_seconds, changes=None):
+        written = len(batch)
+        if changes is not None:
+            for key, count in changes.items():
+                if key == 'skipped':
+                    # left out by the writer and recorded as rejected
+                    written -= count
+                else:
+                    self.result[key] += count
+        self.validated += written
+        self.write_seconds += write_seconds
+        self.batch_seconds.observe(write_seconds)
+        self.result['total'] += written
+        self.result['batches'].append(written)
+        if self.rejected is None:
+            logger.debug('Committed %s batch %d with %d rows, %d rows so far', self.label, len(self.result['batches']), len(batch), self.result['total'])
+        else:
+            # one summary line per batch instead of one per rejected entry
+            rejected_in_batch = self.rejected.total - self.rejected_so_far
+            self.rejected_so_far = self.rejected.total
+            logger.debug('Committed %s batch %d with %d rows, %d rows so far. Rejected %d entries in the batch (last reason: %s)',
+                         self.label, len(self.result['batches']), len(batch), self.result['total'], rejected_in_batch, self.rejected.last_reason)
+        if self.on_batch is not None:
+            self.on_batch(len(self.result['batches']), len(batch), self.result['total'])
+
+    def failed(self, batch, e: IntegrityError):
+        self.validated += len(batch)
+        metrics.INGEST_BATCH_FAILURES.labels(self.label).inc()
+        logger.error('IntegrityError committing %s batch %d: %r', self.label, len(self.result['batches']) + 1, e)
+        self.result.update(success=False, error=integrity_error_detail(e))
+
+    def finish(self):
+        seconds = time.perf_counter() - self.started
+        rejected = self.rejected.total if self.rejected is not None else 0
+        metrics.record_ingest(self.label, self.validated + rejected, self.validated, self.result['total'], rejected)
+        self.result['report'] = {
+            'writer': self.writer.method,
+            'rows': self.result['total'],
+            'seconds': round(seconds, 3),
+            'write_seconds': round(self.write_seconds, 3),
+            'rows_per_sec': round(self.result['total'] / seconds) if seconds > 0 else None,
+        }
+        return self.result
+
+#Extracts the postgres DETAIL line of an IntegrityError, which says which key failed
+def integrity_error_detail(e: IntegrityError):
+    parts = repr(e).split('DETAIL')
+    if len(parts) > 1:
+        return parts[1]
+    # asyncpg errors keep it apart from the message
+    return getattr(e.orig, 'detail', None) or str(e.orig)
+
+#Name of the constraint or unique index an IntegrityError broke, as postgres reports it
+def integrity_error_constraint(e: IntegrityError):
+    diag = getattr(e.orig, 'diag', None)
+    if diag is not None:
+        return diag.constraint_name
+    # sqlalchemy wraps asyncpg errors in its own, the original one is the cause
+    return getattr(e.orig.__cause__, 'constraint_name', None)
+
+# Bulk writers load validated row tuples, laid out as the model's bulk columns, into its table
+# without committing. 'copy' uses COPY FROM STDIN (postgres + psycopg2 only), 'insert' a Core
+# executemany (batched as multi-row INSERTs by insertmanyvalues) and 'orm' the regular unit of work.
+EMPLOYEE_COLUMNS = ('user_id', 'user_state', 'user_mail', 'user_manager')
+DB_INFO_COLUMNS = ('db_name', 'owner_id', 'classification')
+# row tuple of a validated db_info entry
+DB_INFO_ROW = itemgetter(*DB_INFO_COLUMNS)
+
+BULK_COLUMNS = {
+    Employee: EMPLOYEE_COLUMNS,
+    DBInfo: DB_INFO_COLUMNS,
+}
+
+#Builds the ORM object for a row tuple, used by the 'orm' writer
+ORM_FACTORIES = {
+    Employee: Employee,
+    DBInfo: lambda db_name, owner_id, classification: DBInfo(db_name, owner_id, DBClass(classification)),
+}
+
+class BulkWriter(ABC):
+    method = None
+    # counts returned by write, added to the upload result
+    change_counts = ()
+
+    def __init__(self, model):
+        self.model = model
+        self.table = model.__table__
+        self.columns = BULK_COLUMNS[model]
+
+    @abstractmethod
+    def write(self, db: Session, rows):
+        ...
+
+    @abstractmethod
+    async def write_async(self, db: AsyncSession, rows):
+        ...
+
+class OrmBulkWriter(BulkWriter):
+    method = 'orm'
+
+    def write(self, db: Session, rows):
+        factory = ORM_FACTORIES[self.model]
+        db.add_all([factory(*row) for row in rows])
+        db.flush()
+
+    async def write_async(self, db: AsyncSession, rows):
+        factory = ORM_FACTORIES[self.model]
+        db.add_all([factory(*row) for row in rows])
+        await db.flush()
+
+class InsertBulkWriter(BulkWriter):
+    method = 'insert'
+
+    def write(self, db: Session, rows):
+        if rows:
+            db.execute(insert(self.table), [dict(zip(self.columns, row)) for row in rows])
+
+    async def write_async(self, db: AsyncSession, rows):
+        if rows:
+            await db.execute(insert(self.table), [dict(zip(self.columns, row)) for row in rows])
+
+# A value as a COPY csv field. COPY reads an unquoted empty field as NULL, so everything but None is quoted
+# and an empty string is stored as one, like the other writers do
+def copy_csv_field(value):
+    if value is None:
+        return ''
+    return '"' + str(value).replace('"', '""') + '"'
+
+class CopyBulkWriter(BulkWriter):
+    method = 'copy'
+
+    def __init__(self, model):
+        super().__init__(model)
+        # columns left out of the row tuples but with a python side default (e.g. created_at)
+        self.default_columns = [
+            c for c in self.table.columns
+            if c.name not in self.columns and c.default is not None and not c.primary_key
+        ]
+        self.column_names = list(self.columns) + [c.name for c in self.default_columns]
+        self.statement = f"COPY {self.table.name} ({', '.join(self.column_names)}) FROM STDIN WITH (FORMAT csv)"
+
+    def _defaults(self):
+        return tuple(c.default.arg(None) if c.default.is_callable else c.default.arg for c in self.default_columns)
+
+    def write(self, db: Session, rows):
+        if not rows:
+            return
+        defaults = self._defaults()
+        buffer = StringIO()
+        for row in rows:
+            buffer.write(','.join(map(copy_csv_field, row + defaults)))
+            buffer.write('\n')
+        buffer.seek(0)
+        driver_connection = db.connection().connection.driver_connection
+        try:
+            with driver_connection.cursor() as cursor:
+                cursor.copy_expert(self.statement, buffer)
+        except driver_connection.IntegrityError as e:
+            raise IntegrityError(self.statement, None, e) from e
+
+    # asyncpg takes the records as they are, no need to go through csv
+    async def write_async(self, db: AsyncSession, rows):
+        if not rows:
+            return
+        defaults = self._defaults()
+        connection = await db.connection()
+        driver_connection = (await connection.get_raw_connection()).driver_connection
+        if not driver_connection.is_in_transaction():
+            # the asyncpg adapter opens the transaction lazily, on the first statement
+            await connection.exec_driver_sql('SELECT 1')
+        try:
+            await driver_connection.copy_records_to_table(self.table.name, records=[row + defaults for row in rows], columns=self.column_names)
+        except IntegrityConstraintViolationError as e:
+            raise IntegrityError(self.statement, None, e) from e
+
+# Inserts new rows and updates the existing ones, matched by UPSERT_KEYS. Rows whose content_hash
+# (computed by postgres from the non key columns) didn't change are left alone, so re-uploading a
+# mostly unchanged file only writes the delta. COPY can't resolve conflicts, so it goes through
+# multi-row INSERT ... ON CONFLICT DO UPDATE like the 'insert' writer.
+# A key repeated in the same batch is written once, with its last values.
+UPSERT_KEYS = {
+    Employee: ('user_id',),
+    # several owners can have a database with the same name
+    DBInfo: ('db_name', 'owner_id'),
+}
+
+class UpsertBulkWriter(BulkWriter):
+    method = 'upsert'
+    change_counts = ('inserted', 'updated', 'unchanged')
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.key = UPSERT_KEYS[model]
+        self.key_indexes = [self.columns.index(column) for column in self.key]
+        statement = pg_insert(self.table)
+        self.statement = statement.on_conflict_do_update(
+            index_elements=list(self.key),
+            set_={column: statement.excluded[column] for column in self.columns if column not in self.key},
+            where=self.table.c.content_hash.is_distinct_from(statement.excluded.content_hash),
+        # xmax is 0 for the row versions an INSERT created, and set for the ones it updated
+        ).returning(literal_column('xmax = 0'))
+
+    def _parameters(self, rows):
+        latest = {tuple(row[i] for i in self.key_indexes): row for row in rows}
+        return [dict(zip(self.columns, row)) for row in latest.values()]
+
+    @staticmethod
+    def _changes(parameters, inserted_flags):
+        inserted = sum(inserted_flags)
+        return {'inserted': inserted, 'updated': len(inserted_flags) - inserted, 'unchanged': len(parameters) - len(inserted_flags)}
+
+    def write(self, db: Session, rows):
+        if not rows:
+            return self._changes([], [])
+        parameters = self._parameters(rows)
+        return self._changes(parameters, db.execute(self.statement, parameters).scalars().all())
+
+    async def write_async(self, db: AsyncSession, rows):
+        if not rows:
+            return self._changes([], [])
+        parameters = self._parameters(rows)
+        return self._changes(parameters, (await db.execute(self.statement, parameters)).scalars().all())
+
+# Non upsert db_info uploads: rows whose (db_name, owner_id) is already loaded, or repeated in the upload, are
+# recorded in `rejected` instead of failing the upload. Each batch goes through the wrapped writer in a savepoint;
+# only if it hits the key is it written again with INSERT ... ON CONFLICT DO NOTHING, to tell which rows were left out.
+# Returns them counted as 'skipped'.
+DB_INFO_KEY_INDEX = 'ux_db_info_db_name_owner_id'
+
+class DuplicateSkippingWriter(BulkWriter):
+
+    def __init__(self, writer, rejected):
+        super().__init__(writer.model)
+        self.writer = writer
+        self.method = writer.method
+        self.change_counts = writer.change_counts
+        self.rejected = rejected
+        statement = pg_insert(self.table).on_conflict_do_nothing(index_elements=list(UPSERT_KEYS[DBInfo]))
+        self.statement = statement.returning(self.table.c.db_name, self.table.c.owner_id)
+
+    def _skipped(self, rows, written):
+        written = set(written)
+        skipped = 0
+        for row in rows:
+            key = (row[0], row[1])
+            if key in written:
+                # later rows with the same key are repeats
+                written.discard(key)
+                continue
+            self.rejected.add(dict(zip(self.columns, row)), f"db_name {row[0]} already exists for owner_id {row[1]}")
+            skipped += 1
+        return {'skipped': skipped}
+
+    def write(self, db: Session, rows):
+        savepoint = db.begin_nested()
+        try:
+            changes = self.writer.write(db, rows)
+            savepoint.commit()
+            return changes
+        except IntegrityError as e:
+            savepoint.rollback()
+            if integrity_error_constraint(e) != DB_INFO_KEY_INDEX:
+                raise
+        written = db.execute(self.statement, [dict(zip(self.columns, row)) for row in rows]).all()
+        return self._skipped(rows, [tuple(row) for row in written])
+
+    async def write_async(self, db: AsyncSession, rows):
+        savepoint = await db.begin_nested()
+        try:
+            changes = await self.writer.write_async(db, rows)
+            await savepoint.commit()
+            return changes
+        except IntegrityError as e:
+            await savepoint.rollback()
+            if integrity_error_constraint(e) != DB_INFO_KEY_INDEX:
+                raise
+        written = (await db.execute(self.statement, [dict(zip(self.columns, row)) for row in rows])).all()
+        return self._skipped(rows, [tuple(row) for row in written])
+
+#Writer of a db_info upload, see DuplicateSkippingWriter
+def db_info_writer(db, rejected, writer=None, upsert=False):
+    writer = writer or get_bulk_writer(db, DBInfo, upload_method(upsert))
+    return writer if writer.method == 'upsert' else DuplicateSkippingWriter(writer, rejected)
+
+BULK_WRITERS = {
+    'orm': OrmBulkWriter,
+    'insert': InsertBulkWriter,
+    'copy': CopyBulkWriter,
+    'upsert': UpsertBulkWriter,
+}
+
+#Writer method of the uploads, upsert=True updates the rows already loaded instead of failing on them
+def upload_method(upsert=False):
+    return 'upsert' if upsert else BULK_WRITER
+
+#'auto' uses COPY when the session is bound to postgres through psycopg2 or asyncpg and falls back to the ORM otherwise
+def get_bulk_writer(db, model, method=BULK_WRITER):
+    if method == 'auto':
+        dialect = db.get_bind().dialect
+        method = 'copy' if dialect.name == 'postgresql' and dialect.driver in ('psycopg2', 'asyncpg') else 'orm'
+    return BULK_WRITERS[method](model)
 
 #to facilitate testing
 # def create_employee(db:Session, employee: schemas.EmployeeCreate):
@@ -53,7 +564,7 @@ def create_DBInfo(db:Session, db_info: schemas.DBInfoCreate):
     try:
         db.commit()
     except IntegrityError as e:
-        logger.error(f"IntegrityError creating DBInfo: {repr(e)}")
+        logger.error('IntegrityError creating DBInfo: %r', e)
         db.rollback()
         return False
     logger.debug('adding db_info to db')
@@ -66,19 +577,122 @@ def create_DBInfo(db:Session, db_info: schemas.DBInfoCreate):
 # - owner_id is not empty nor negative int
 # - classification is withing valid range (currently: [0;3])
 def validate_db_fields(db_info):
-    required_fields = {'db_name': str, 'owner_id': int, 'classification': int}
-    #Check all the fields are in the info with their respective type and that they are not None
-    for key, expected_type in required_fields.items():
-        if key not in db_info or db_info[key] is None or not isinstance(db_info[key], expected_type):
-            logger.debug(f"entry missing key, key is none or is not the expected instance. Key: {key}")
-            return False
-    if db_info['owner_id'] <= 0:
-        logger.debug('owner_id is less than 0')
-        return False
-    if db_info['classification'] not in DBClass._value2member_map_:
-        logger.debug(f"classification outside boundaries. Original value was {db_info['classification']}")
-        return False
-    return db_info['owner_id'] != ''
+    return db_info_rejection_reason(db_info) is None
+
+#Returns why an entry is invalid, or None if it is valid (rules in validate_db_fields)
+def db_info_rejection_reason(db_info):
+    return db_info_rejection_reasons([db_info]).get(0)
+
+# Validates a list of entries with the compiled DBInfoEntries validator and returns {index: reason} for
+# the invalid ones. A valid list costs a single call into pydantic-core, the Python side only runs for errors.
+def db_info_rejection_reasons(entries):
+    try:
+        DBInfoEntries.validate_python(entries)
+    except ValidationError as e:
+        return rejection_reasons_from_errors(e)
+    return {}
+
+DB_INFO_FIELD_TYPES = {'db_name': 'str', 'owner_id': 'int', 'classification': 'int'}
+
+# Maps the validation errors of a list of entries to one reason per entry. When an entry has several
+# errors, a missing, null or mistyped field wins over an out of range value, and earlier fields over
+# later ones, so the reason is the first rule broken in the order listed in validate_db_fields.
+def rejection_reasons_from_errors(e: ValidationError):
+    reasons = {}
+    for error in e.errors(include_url=False, include_context=False):
+        index, field = error['loc'][0], error['loc'][1] if len(error['loc']) > 1 else None
+        value = error['input']
+        if field is None:
+            rank, reason = 0, 'entry is not a json object'
+        elif error['type'] == 'missing':
+            rank, reason = 1, f"missing field {field}"
+        elif value is None:
+            rank, reason = 1, f"{field} is null"
+        elif error['type'] == 'greater_than':
+            rank, reason = 2, 'owner_id is not a positive integer'
+        elif error['type'] == 'literal_error' and type(value) is int:
+            rank, reason = 2, f"classification {value} is outside boundaries"
+        else:
+            rank, reason = 1, f"{field} is not of type {DB_INFO_FIELD_TYPES[field]}"
+        # errors of an entry come in field order, so only a lower rank replaces the first one
+        if index not in reasons or rank < reasons[index][0]:
+            reasons[index] = (rank, reason)
+    return {index: reason for index, (rank, reason) in reasons.items()}
+
+# Sorted array of the existing employee.user_id values, loaded once per upload so entries with an
+# unknown owner are rejected up front instead of failing the whole batch on the foreign key.
+# Uses 8 bytes per employee.
+class OwnerIndex:
+
+    def __init__(self, user_ids):
+        self._ids = array('q', user_ids)
+
+    @staticmethod
+    def _query():
+        return select(Employee.user_id).where(Employee.user_id.is_not(None)).order_by(Employee.user_id)
+
+    @classmethod
+    def load(cls, db: Session):
+        return cls(db.execute(cls._query().execution_options(yield_per=10000)).scalars())
+
+    @classmethod
+    async def load_async(cls, db: AsyncSession):
+        user_ids = array('q')
+        result = await db.stream(cls._query().execution_options(yield_per=10000))
+        async for partition in result.scalars().partitions():
+            user_ids.extend(partition)
+        return cls(user_ids)
+
+    def __contains__(self, user_id):
+        i = bisect_left(self._ids, user_id)
+        return i < len(self._ids) and self._ids[i] == user_id
+
+    #The ones of `user_ids` that are not an employee
+    def missing(self, user_ids):
+        return {user_id for user_id in user_ids if user_id not in self}
+
+    def __len__(self):
+        return len(self._ids)
+
+#Rejected entries are returned as they came, along with the reason
+def rejected_entry(entry, reason):
+    return {'entry': entry, 'reason': reason}
+
+# Collects the rejected entries of an upload, keeping the first max_entries (all of them if None)
+# and counting the rest
+class RejectedEntries:
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.entries = []
+        self.total = 0
+        self.last_reason = None
+
+    def add(self, entry, reason):
+        self.total += 1
+        self.last_reason = reason
+        if self.max_entries is None or len(self.entries) < self.max_entries:
+            self.entries.append(rejected_entry(entry, reason))
+
+# Validates a batch of entries at once and returns the rows to insert for the valid ones whose owner
+# exists, recording the rest in `rejected`. Rows are picked out of the entries with an itemgetter and
+# owners are looked up once per distinct owner_id, so a valid batch has no per entry Python code.
+def db_info_rows_if_valid(entries, owners: OwnerIndex, rejected: RejectedEntries):
+    reasons = db_info_rejection_reasons(entries)
+    valid_entries = [entry for index, entry in enumerate(entries) if index not in reasons] if reasons else entries
+    rows = list(map(DB_INFO_ROW, valid_entries))
+    unknown = owners.missing(set(map(itemgetter(1), rows)))
+    if unknown:
+        reasons.update((index, f"owner_id {entry['owner_id']} does not exist") for index, entry in enumerate(entries)
+                       if index not in reasons and entry['owner_id'] in unknown)
+        rows = [row for row in rows if row[1] not in unknown]
+    # rejected in upload order
+    for index in sorted(reasons):
+        rejected.add(entries[index], reasons[index])
+    if '' in map(itemgetter(0), rows):
+        # validated entries already hold the right types, only a blank name needs filling in
+        rows = [row if row[0] else (default_db_name(row[1], row[2]), row[1], row[2]) for row in rows]
+    return rows
 
 #to simplify testing and creation
 def aux_parse_db_info(entry):
@@ -88,37 +702,655 @@ def aux_parse_db_info(entry):
                  DBClass(entry['classification']) if entry['classification'] is not None else DBClass.UNCLASSIFIED
     )
 
-# Will throw HTTP 409 if an entry uses an un-existent owner_id
-#Method will reject entries with missing or incorrect fields but will accept entries with correct fields and empty values
-def create_multiple_db_info_from_raw(db: Session, raw_json):
-    parsed_json = json.loads(raw_json)
-    valid_entries = []
-    invalid_entries = []
-    for rd in parsed_json:
-        if validate_db_fields(rd):
-            valid_entries.append(aux_parse_db_info(rd))
+#Same conversion as aux_parse_db_info, but to a compact tuple laid out as DB_INFO_COLUMNS
+def db_info_row_from_raw(entry):
+    owner_id = int(entry['owner_id']) if entry['owner_id'] is not None else 0
+    classification = entry['classification'] if entry['classification'] is not None else DBClass.UNCLASSIFIED.value
+    db_name = str(entry['db_name']) if entry['db_name'] is not None else ''
+    return (db_name or default_db_name(owner_id, classification), owner_id, classification)
+
+#Method will reject entries with missing or incorrect fields or an un-existent owner_id, but will accept
+#entries with correct fields and empty values. With workers > 1 big uploads are parsed and validated in that
+#many processes (see parse_db_info_sharded)
+def create_multiple_db_info_from_raw(db: Session, raw_json, writer=None, upsert=False, workers=1):
+    owners = OwnerIndex.load(db)
+    rejected = RejectedEntries()
+    valid_entries = db_info_rows_from_json(raw_json, owners, rejected, workers)
+    result = commit_in_batches(db, valid_entries, db_info_writer(db, rejected, writer, upsert), batch_size=None, label='db_info', rejected=rejected)
+    if not result['success']:
+        return result
+    logger.info('Added %d db_info entries. Rejected %d', result['total'], rejected.total)
+    result.update(valid_entries=valid_entries, invalid_entries=rejected.entries)
+    return result
+
+# Streaming version of create_multiple_db_info_from_raw: entries are parsed one at a time from the
+# text chunks and committed every batch_size valid entries. Only the first max_invalid rejected
+# entries are kept for the response, 'invalid_total' counts all of them.
+def create_multiple_db_info_from_stream(db: Session, text_chunks, batch_size=DEFAULT_BATCH_SIZE, max_invalid=DEFAULT_MAX_INVALID, on_batch=None, writer=None, upsert=False):
+    parser = JSONArrayStream()
+    owners = OwnerIndex.load(db)
+    rejected = RejectedEntries(max_invalid)
+    entries = iter_batches(iter_parsed(parser, text_chunks), VALIDATION_BATCH_SIZE)
+    rows = (row for batch in entries for row in db_info_rows_if_valid(batch, owners, rejected))
+    result = commit_in_batches(db, rows, db_info_writer(db, rejected, writer, upsert), batch_size, on_batch, label='db_info', rejected=rejected)
+    result.update(invalid_entries=rejected.entries, invalid_total=rejected.total)
+    if result['success']:
+        logger.info('Added %d db_info entries in %d batches. Rejected %d', result['total'], len(result['batches']), rejected.total)
+    return result
+
+# Async version of create_multiple_db_info_from_stream, text_chunks is an async iterable.
+# With batch_size None all the entries are committed in one transaction, with max_invalid None
+# every rejected entry is returned.
+async def create_multiple_db_info_from_stream_async(db: AsyncSession, text_chunks, batch_size=DEFAULT_BATCH_SIZE, max_invalid=DEFAULT_MAX_INVALID, on_batch=None, writer=None, upsert=False):
+    parser = JSONArrayStream()
+    owners = await OwnerIndex.load_async(db)
+    rejected = RejectedEntries(max_invalid)
+
+    async def rows():
+        async for batch in aiter_batches(aiter_parsed(parser, text_chunks), VALIDATION_BATCH_SIZE):
+            for row in db_info_rows_if_valid(batch, owners, rejected):
+                yield row
+
+    result = await commit_in_batches_async(db, rows(), db_info_writer(db, rejected, writer, upsert), batch_size, on_batch, label='db_info', rejected=rejected)
+    result.update(invalid_entries=rejected.entries, invalid_total=rejected.total)
+    if result['success']:
+        logger.info('Added %d db_info entries in %d batches. Rejected %d', result['total'], len(result['batches']), rejected.total)
+    return result
+
+# Async versions of the raw uploads for the endpoints, the parsing runs in a thread (and its processes)
+# so the event loop keeps serving other requests
+async def create_multiple_employees_from_raw_async(db: AsyncSession, raw_csv, workers=1, writer=None, upsert=False):
+    rows = await asyncio.to_thread(employee_rows_from_csv, raw_csv, workers)
+    result = await commit_in_batches_async(db, aiter_items(rows), writer or get_bulk_writer(db, Employee, upload_method(upsert)), batch_size=None, label='employee')
+    if rows_written(result):
+        await refresh_employee_closure_async(db, array('q', (row[0] for row in rows)))
+    if result['success']:
+        logger.info('Successfully added %d employees', result['total'])
+    return result
+
+async def create_multiple_db_info_from_raw_async(db: AsyncSession, raw_json, workers=1, writer=None, upsert=False):
+    owners = await OwnerIndex.load_async(db)
+    rejected = RejectedEntries()
+    valid_entries = await asyncio.to_thread(db_info_rows_from_json, raw_json, owners, rejected, workers)
+    result = await commit_in_batches_async(db, aiter_items(valid_entries), db_info_writer(db, rejected, writer, upsert), batch_size=None, label='db_info', rejected=rejected)
+    if not result['success']:
+        return result
+    logger.info('Added %d db_info entries. Rejected %d', result['total'], rejected.total)
+    result.update(valid_entries=valid_entries, invalid_entries=rejected.entries)
+    return result
+
+# Uploads smaller than this are parsed in the calling process even if workers were asked for,
+# starting the processes would take longer than the parsing
+PARSE_SHARD_MIN_SIZE = int(os.environ.get('UPLOAD_SHARD_MIN_SIZE', 4 * 1024 * 1024))
+# Most processes an upload can be parsed in
+MAX_PARSE_WORKERS = int(os.environ.get('UPLOAD_MAX_PARSE_WORKERS', os.cpu_count() or 1))
+
+# Parse processes come from a fork server (spawned where there's no fork), so they don't inherit the app's
+# threads and open connections. The pool is started on the first sharded upload and kept for the next ones,
+# so each process pays for importing the app only once.
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+def parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _parse_pool = ProcessPoolExecutor(MAX_PARSE_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _parse_pool
+
+# Parses the shards in the pool, results come back in the order of the shards.
+# A pool that lost a process can't be used again, the next upload starts a new one.
+def map_shards(parse_shard, shards):
+    global _parse_pool
+    pool = parse_pool()
+    try:
+        return list(pool.map(parse_shard, shards))
+    except BrokenProcessPool:
+        with _parse_pool_lock:
+            if _parse_pool is pool:
+                _parse_pool = None
+        raise
+
+def employee_rows_from_csv(raw_csv, workers=1):
+    rows = parse_employees_sharded(raw_csv, workers) if workers > 1 else None
+    if rows is None:
+        rows = [employee_row_from_raw(raw_employee) for raw_employee in csv.DictReader(StringIO(raw_csv))]
+    return rows
+
+#Runs in the parse processes: the row tuples of a CSV shard, its header given apart
+def employee_shard_rows(shard, fieldnames):
+    return [employee_row_from_raw(dict(zip(fieldnames, values))) for values in csv.reader(StringIO(shard)) if values]
+
+# Employee rows of a CSV upload parsed in `workers` processes, in file order. Returns None when the upload
+# is below PARSE_SHARD_MIN_SIZE, can't be split at line breaks or a shard fails, for the caller to parse
+# it serially (and report the error, if the upload is malformed).
+def parse_employees_sharded(raw_csv, workers):
+    if len(raw_csv) < PARSE_SHARD_MIN_SIZE:
+        return None
+    split = split_csv_shards(raw_csv, min(workers, MAX_PARSE_WORKERS))
+    if split is None or len(split[1]) < 2:
+        return None
+    header, shards = split
+    started = time.perf_counter()
+    try:
+        results = map_shards(partial(employee_shard_rows, fieldnames=next(csv.reader([header]))), shards)
+    except (ValueError, BrokenProcessPool) as e:
+        logger.warning('Could not parse employee shards (%r), parsing serially', e)
+        return None
+    rows = [row for shard_rows in results for row in shard_rows]
+    logger.info('Parsed %d employees in %d shards in %.3fs', len(rows), len(shards), time.perf_counter() - started)
+    return rows
+
+def db_info_rows_from_json(raw_json, owners: OwnerIndex, rejected: RejectedEntries, workers=1):
+    rows = parse_db_info_sharded(raw_json, owners, rejected, workers) if workers > 1 else None
+    if rows is None:
+        parsed_json = json.loads(raw_json)
+        if not isinstance(parsed_json, list):
+            raise ValueError('JSON upload must be an array')
+        rows = db_info_rows_if_valid(parsed_json, owners, rejected)
+    return rows
+
+#Runs in the parse processes: the rows of the valid entries of a JSON array shard and the (entry, reason)
+#of the rejected ones. Raises ValueError if the shard doesn't parse.
+def db_info_shard_rows(shard, owners: OwnerIndex):
+    entries = json.loads('[' + shard + ']')
+    rejected = RejectedEntries()
+    rows = []
+    for batch in iter_batches(entries, VALIDATION_BATCH_SIZE):
+        rows.extend(db_info_rows_if_valid(batch, owners, rejected))
+    return rows, [(rejected_entry['entry'], rejected_entry['reason']) for rejected_entry in rejected.entries]
+
+# db_info rows of a JSON array upload parsed and validated in `workers` processes. Shard results are
+# merged in file order, so rows and rejected entries come out as in a serial parse. Returns None, without
+# touching `rejected`, when the upload is below PARSE_SHARD_MIN_SIZE, can't be split between objects or
+# a shard fails (a cut inside a string or nested value, a malformed upload, which the serial parse then
+# reports, or a lost process).
+def parse_db_info_sharded(raw_json, owners: OwnerIndex, rejected: RejectedEntries, workers):
+    if len(raw_json) < PARSE_SHARD_MIN_SIZE:
+        return None
+    shards = split_json_array_shards(raw_json, min(workers, MAX_PARSE_WORKERS))
+    if shards is None or len(shards) < 2:
+        return None
+    started = time.perf_counter()
+    try:
+        results = map_shards(partial(db_info_shard_rows, owners=owners), shards)
+    except (ValueError, BrokenProcessPool) as e:
+        logger.warning('Could not parse db_info shards (%r), parsing serially', e)
+        return None
+    rows = []
+    for shard_rows, shard_rejected in results:
+        rows.extend(shard_rows)
+        for entry, reason in shard_rejected:
+            rejected.add(entry, reason)
+    logger.info('Parsed %d db_info entries in %d shards in %.3fs', len(rows) + rejected.total, len(shards), time.perf_counter() - started)
+    return rows
+
+# Unclassified dbs are paginated by keyset on id: a page holds the first `limit` ids greater than `after`
+def get_unclassified_dbs(db: Session, after=None, limit=None):
+    query = db.query(DBInfo).filter_by(classification=DBClass.UNCLASSIFIED.value)
+    if after is not None:
+        query = query.filter(DBInfo.id > after)
+    return query.order_by(DBInfo.id).limit(limit).all()
+
+# Same page as get_unclassified_dbs but only selecting the exposed columns, without building ORM objects.
+# Rows are fetched yield_per at a time through a server side cursor.
+def get_unclassified_db_rows(db: Session, after=None, limit=None, yield_per=1000):
+    return db.execute(unclassified_rows_query(after, limit).execution_options(yield_per=yield_per))
+
+async def get_unclassified_db_rows_async(db: AsyncSession, after=None, limit=None):
+    return (await db.execute(unclassified_rows_query(after, limit))).all()
+
+#Streams the rows through a server side cursor, returns an AsyncResult
+async def stream_unclassified_db_rows(db: AsyncSession, after=None, limit=None, yield_per=1000):
+    return await db.stream(unclassified_rows_query(after, limit).execution_options(yield_per=yield_per))
+
+def unclassified_rows_query(after=None, limit=None):
+    query = (
+        select(DBInfo.id, DBInfo.db_name, DBInfo.owner_id, DBInfo.classification)
+        .where(DBInfo.classification == DBClass.UNCLASSIFIED.value)
+        .order_by(DBInfo.id)
+        .limit(limit)
+    )
+    if after is not None:
+        query = query.where(DBInfo.id > after)
+    return query
+
+# Columns of the inventory export, in order. classification is the DBClass name.
+EXPORT_COLUMNS = ('id', 'db_name', 'classification', 'owner_id', 'owner_mail', 'manager_id', 'manager_mail')
+_CLASSIFICATION_NAMES = {db_class.value: db_class.name for db_class in DBClass}
+
+# Every database joined to its owner and the owner's manager, ordered by id, optionally only the given
+# classifications. The manager columns are null for owners without one.
+def inventory_export_query(classifications=None):
+    owner = aliased(Employee)
+    manager = aliased(Employee)
+    query = (
+        select(DBInfo.id, DBInfo.db_name, DBInfo.classification, owner.user_id, owner.user_mail, manager.user_id, manager.user_mail)
+        .join(owner, DBInfo.owner_id == owner.user_id)
+        .outerjoin(manager, owner.user_manager == manager.user_id)
+        .order_by(DBInfo.id)
+    )
+    if classifications:
+        query = query.where(DBInfo.classification.in_([db_class.value for db_class in classifications]))
+    return query
+
+#Row of the export laid out as EXPORT_COLUMNS
+def export_row(row):
+    db_id, db_name, classification, owner_id, owner_mail, manager_id, manager_mail = row
+    return db_id, db_name, _CLASSIFICATION_NAMES[classification], owner_id, owner_mail, manager_id, manager_mail
+
+def get_inventory_export_rows(db: Session, classifications=None, yield_per=1000):
+    return (export_row(row) for row in db.execute(inventory_export_query(classifications).execution_options(yield_per=yield_per)))
+
+#Streams the rows through a server side cursor, returns an AsyncResult of the raw rows (see export_row)
+async def stream_inventory_export(db: AsyncSession, classifications=None, yield_per=1000):
+    return await db.stream(inventory_export_query(classifications).execution_options(yield_per=yield_per))
+
+# Databases of a given classification owned by anyone in a manager's subtree, the manager included,
+# paginated by id like the unclassified ones. One join through the closure table, whatever the tree depth.
+def subtree_db_rows_query(manager_id, classification: DBClass, after=None, limit=None):
+    query = (
+        select(DBInfo.id, DBInfo.db_name, DBInfo.owner_id, DBInfo.classification)
+        .join(EmployeeClosure, EmployeeClosure.descendant_id == DBInfo.owner_id)
+        .where(EmployeeClosure.ancestor_id == manager_id, DBInfo.classification == classification.value)
+        .order_by(DBInfo.id)
+        .limit(limit)
+    )
+    if after is not None:
+        query = query.where(DBInfo.id > after)
+    return query
+
+def get_subtree_db_rows(db: Session, manager_id, classification: DBClass, after=None, limit=None):
+    return db.execute(subtree_db_rows_query(manager_id, classification, after, limit)).all()
+
+async def get_subtree_db_rows_async(db: AsyncSession, manager_id, classification: DBClass, after=None, limit=None):
+    return (await db.execute(subtree_db_rows_query(manager_id, classification, after, limit))).all()
+
+# Managers above an employee, closest first: (depth, user_id, user_mail) with depth 1 for its manager.
+# `levels` stops the chain that many managers up.
+def escalation_chain_query(user_id, levels=None):
+    query = (
+        select(EmployeeClosure.depth, Employee.user_id, Employee.user_mail)
+        .join(Employee, Employee.user_id == EmployeeClosure.ancestor_id)
+        .where(EmployeeClosure.descendant_id == user_id, EmployeeClosure.depth > 0)
+        .order_by(EmployeeClosure.depth)
+    )
+    if levels is not None:
+        query = query.where(EmployeeClosure.depth <= levels)
+    return query
+
+def get_escalation_chain(db: Session, user_id, levels=None):
+    return db.execute(escalation_chain_query(user_id, levels)).all()
+
+async def get_escalation_chain_async(db: AsyncSession, user_id, levels=None):
+    return (await db.execute(escalation_chain_query(user_id, levels))).all()
+
+#Whether the closure knows the employee, i.e. it was loaded
+async def employee_in_closure_async(db: AsyncSession, user_id):
+    query = select(EmployeeClosure.depth).where(EmployeeClosure.ancestor_id == user_id, EmployeeClosure.descendant_id == user_id)
+    return (await db.execute(query)).first() is not None
+
+# db_info_summary and table_version are kept by statement level triggers (migrations 0006 and 0009) rather than
+# by the upload code. They run in the transaction of every statement that writes db_info or employee, so every
+# write path (ORM, INSERT, COPY, upserts and writes made from outside the app) updates them once per statement
+# and every worker sees the result. The migrations export the trigger SQL (SUMMARY_TRIGGERS, VERSION_TRIGGERS)
+# so schemas built with create_all, like the tests', get them too. rebuild_summary.py and rebuild_closure.py
+# recompute the summary and the employee closure out of band, like the migrations.
+
+# Classification counts recomputed from db_info and employee, as the summary triggers keep them (same query as
+# the migration that created them)
+DB_INFO_SUMMARY_ROWS = load_migration(6).SUMMARY_ROWS
+
+# Recomputes db_info_summary from scratch. Uploads wait for it (and it for them) so no batch is counted
+# twice or missed. Returns the number of summary rows.
+def rebuild_db_info_summary(db: Session):
+    started = time.perf_counter()
+    db.execute(text('LOCK TABLE db_info, employee IN SHARE MODE'))
+    db.execute(delete(DBInfoSummary))
+    rows = db.execute(text(f"INSERT INTO db_info_summary (scope, key, classification, count) {DB_INFO_SUMMARY_ROWS}")).rowcount
+    db.commit()
+    logger.info('Rebuilt db_info summary (%d rows) in %.3fs', rows, time.perf_counter() - started)
+    return rows
+
+# (scope, key, classification, stored count, actual count) of every summary count that doesn't match the tables,
+# a zero or missing row being a count of 0. Empty if the summary is consistent.
+def check_db_info_summary(db: Session):
+    return db.execute(text(f"""
+        SELECT scope, key, classification, coalesce(s.count, 0) AS stored, coalesce(a.count, 0) AS actual
+        FROM db_info_summary s FULL OUTER JOIN ({DB_INFO_SUMMARY_ROWS}) a USING (scope, key, classification)
+        WHERE coalesce(s.count, 0) <> coalesce(a.count, 0)
+        ORDER BY scope, key, classification
+    """)).all()
+
+#Counts per DBClass name of a summary scope, a primary key lookup of at most one row per class
+def db_info_stats_query(scope=DBInfoSummary.TOTAL, key=0):
+    return select(DBInfoSummary.classification, DBInfoSummary.count).where(DBInfoSummary.scope == scope, DBInfoSummary.key == key)
+
+def db_info_stats_from_rows(rows):
+    counts = {db_class.name: 0 for db_class in DBClass}
+    for classification, count in rows:
+        counts[_CLASSIFICATION_NAMES[classification]] = count
+    return counts
+
+def get_db_info_stats(db: Session, scope=DBInfoSummary.TOTAL, key=0):
+    return db_info_stats_from_rows(db.execute(db_info_stats_query(scope, key)))
+
+async def get_db_info_stats_async(db: AsyncSession, scope=DBInfoSummary.TOTAL, key=0):
+    return db_info_stats_from_rows(await db.execute(db_info_stats_query(scope, key)))
+
+# /notify modes: 'all' notifies every HIGH database, 'incremental' the ones without a sent (or rejected for good)
+# ledger entry for their current owner, manager and classification, 'failed' only those whose last attempt
+# failed and can be retried
+NOTIFY_MODES = ('all', 'incremental', 'failed')
+
+# (db_id, owner_id, manager_id, db_name, owner_mail, manager_mail) of the HIGH databases to notify in `mode`,
+# joined in a single query instead of lazy loading the owner and its manager per database.
+# With exclude_queued, the databases already in an outbox email waiting to be delivered are left out.
+def high_classification_notifications_query(mode='all', exclude_queued=False):
+    if mode not in NOTIFY_MODES:
+        raise ValueError(f"unknown notify mode {mode}")
+    owner = aliased(Employee)
+    manager = aliased(Employee)
+    query = (
+        select(DBInfo.id, owner.user_id, manager.user_id, DBInfo.db_name, owner.user_mail, manager.user_mail)
+        .join(owner, DBInfo.owner_id == owner.user_id)
+        .join(manager, owner.user_manager == manager.user_id)
+        .where(DBInfo.classification == DBClass.HIGH.value)
+        .order_by(DBInfo.id)
+    )
+    if exclude_queued:
+        query = query.where(~select(NotificationOutbox.id).where(
+            NotificationOutbox.status.in_(OUTBOX_QUEUED),
+            NotificationOutbox.db_ids.contains(pg_array([DBInfo.id])),
+        ).exists())
+    if mode == 'all':
+        return query
+    ledger_entry = select(NotificationLedger.id).where(
+        NotificationLedger.db_id == DBInfo.id,
+        NotificationLedger.owner_id == owner.user_id,
+        NotificationLedger.manager_id == manager.user_id,
+        NotificationLedger.classification == DBInfo.classification,
+    )
+    if mode == 'incremental':
+        return query.where(~ledger_entry.where(NotificationLedger.status.in_((NotificationLedger.SENT, NotificationLedger.REJECTED))).exists())
+    return query.where(ledger_entry.where(NotificationLedger.status == NotificationLedger.FAILED).exists())
+
+# (db_name, owner_mail, manager_mail) of every HIGH database to notify in `mode`, streamed through a server side cursor
+def get_high_classification_notifications(db: Session, yield_per=1000, mode='all'):
+    query = high_classification_notifications_query(mode).execution_options(yield_per=yield_per)
+    for _, _, _, db_name, owner_mail, manager_mail in db.execute(query):
+        yield db_name, owner_mail, manager_mail
+
+def count_high_classification_dbs(db: Session, mode='all'):
+    return db.execute(select(func.count()).select_from(high_classification_notifications_query(mode).order_by(None).subquery())).scalar()
+
+# Most databases listed in one digest, managers with more get several messages
+DIGEST_MAX_DATABASES = int(os.environ.get('MAIL_DIGEST_MAX_DATABASES', 500))
+
+# One row per manager with HIGH databases to notify in `mode`: (manager_id, manager_mail, db_ids, owner_ids,
+# db_names, owner_mails), the last four being arrays aligned with each other and ordered by owner and database
+def high_classification_digests_query(mode='all', exclude_queued=False):
+    notifications = high_classification_notifications_query(mode, exclude_queued).order_by(None).subquery()
+    db_id, owner_id, manager_id, db_name, owner_mail, manager_mail = notifications.c
+    in_order = (owner_id, db_id)
+    return (
+        select(
+            manager_id, manager_mail,
+            func.array_agg(aggregate_order_by(db_id, *in_order)),
+            func.array_agg(aggregate_order_by(owner_id, *in_order)),
+            func.array_agg(aggregate_order_by(db_name, *in_order)),
+            func.array_agg(aggregate_order_by(owner_mail, *in_order)),
+        )
+        .group_by(manager_id, manager_mail)
+        .order_by(manager_id)
+    )
+
+# Records the outcome of each notification in the ledger, keeping the last attempt per key. Entries are
+# written every `batch_size` results in the notify session's transaction, committed by finish(), so the
+# server side cursor the notifications are read from stays open. If a run dies before finish(), its
+# notifications are sent again by the next incremental run.
+class LedgerWriter:
+
+    # ledger status of each deliver_notifications outcome
+    STATUSES = {SENT: NotificationLedger.SENT, FAILED: NotificationLedger.FAILED, REJECTED: NotificationLedger.REJECTED}
+
+    def __init__(self, db: Session, batch_size=500):
+        self.db = db
+        self.batch_size = batch_size
+        self.pending = []
+        statement = pg_insert(NotificationLedger.__table__)
+        self.statement = statement.on_conflict_do_update(
+            constraint='uq_notification_ledger_key',
+            set_={
+                'status': statement.excluded.status,
+                'sent_at': statement.excluded.sent_at,
+                'attempts': NotificationLedger.__table__.c.attempts + 1,
+            },
+        )
+
+    def record(self, key, outcome):
+        db_id, owner_id, manager_id = key
+        self.pending.append({
+            'db_id': db_id, 'owner_id': owner_id, 'manager_id': manager_id,
+            'classification': DBClass.HIGH.value,
+            'status': self.STATUSES[outcome],
+            'attempts': 1,
+            'sent_at': datetime.now(),
+        })
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            # a key can't be upserted twice in one statement, keep its last outcome
+            latest = {(e['db_id'], e['owner_id'], e['manager_id']): e for e in self.pending}
+            self.db.execute(self.statement, list(latest.values()))
+            self.pending = []
+
+    def finish(self):
+        self.flush()
+        self.db.commit()
+
+# Outbox rows with an email still to be delivered
+OUTBOX_QUEUED = (NotificationOutbox.PENDING, NotificationOutbox.SENDING)
+# Outbox rows claimed per delivery round
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 100))
+# Attempts before an email is given up, and the delay before the first retry, doubled on each retry up to the max
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8))
+OUTBOX_BACKOFF_BASE = float(os.environ.get('OUTBOX_BACKOFF_BASE', 30))
+OUTBOX_BACKOFF_MAX = float(os.environ.get('OUTBOX_BACKOFF_MAX', 3600))
+# Emails a delivery round sends at a time, one per pooled connection. The lease of the rows still to send is
+# renewed before each chunk
+OUTBOX_SEND_CHUNK = int(os.environ.get('OUTBOX_SEND_CHUNK', MAIL_POOL_SIZE))
+# Seconds a claimed row is held by its delivery, after them it can be claimed again (the delivery died).
+# It only has to outlast one chunk, and a send takes a dozen MAIL_TIMEOUTs at worst (connect, greeting,
+# the SMTP commands, all of it again on a dropped connection)
+OUTBOX_LEASE = float(os.environ.get('OUTBOX_LEASE', 30 * MAIL_TIMEOUT))
+# Serializes concurrent enqueue_notifications, any value not used by another advisory lock
+NOTIFICATION_ENQUEUE_LOCK_ID = 7364003
+
+#Seconds to wait before retrying an email that failed `attempts` times, with jitter so retries spread out
+def outbox_backoff(attempts):
+    return min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.5, 1)
+
+# Queues the emails of `mode` in the outbox under run_id, in a single transaction with the selection.
+# Databases already in a queued email are not queued again: those emails are made due now and moved to run_id.
+# With digest, each manager gets one email per DIGEST_MAX_DATABASES of their databases.
+# Concurrent runs, from any process, queue one after the other so each one sees the rows of the previous.
+def enqueue_notifications(db: Session, run_id, mode='all', digest=False, batch_size=1000):
+    outbox = NotificationOutbox.__table__
+    db.execute(select(func.pg_advisory_xact_lock(NOTIFICATION_ENQUEUE_LOCK_ID)))
+    selected = high_classification_notifications_query(mode).order_by(None).with_only_columns(DBInfo.id)
+    db.execute(
+        update(outbox)
+        .where(outbox.c.status == NotificationOutbox.PENDING, outbox.c.db_ids.overlap(func.array(selected.scalar_subquery())))
+        .values(next_attempt_at=func.now(), run_id=run_id)
+    )
+
+    def rows():
+        if not digest:
+            query = high_classification_notifications_query(mode, exclude_queued=True).execution_options(yield_per=batch_size)
+            for db_id, owner_id, manager_id, db_name, owner_mail, manager_mail in db.execute(query):
+                yield [db_id], [owner_id], manager_id, [db_name], [owner_mail], manager_mail
+            return
+        query = high_classification_digests_query(mode, exclude_queued=True).execution_options(yield_per=100)
+        for manager_id, manager_mail, db_ids, owner_ids, db_names, owner_mails in db.execute(query):
+            for start in range(0, len(db_ids), DIGEST_MAX_DATABASES):
+                end = start + DIGEST_MAX_DATABASES
+                yield db_ids[start:end], owner_ids[start:end], manager_id, db_names[start:end], owner_mails[start:end], manager_mail
+
+    queued = 0
+    for batch in iter_batches(rows(), batch_size):
+        db.execute(insert(outbox), [
+            {
+                'run_id': run_id, 'digest': digest, 'recipient': manager_mail, 'manager_id': manager_id,
+                'db_ids': db_ids, 'owner_ids': owner_ids, 'db_names': db_names, 'owner_mails': owner_mails,
+                'status': NotificationOutbox.PENDING, 'attempts': 0,
+            }
+            for db_ids, owner_ids, manager_id, db_names, owner_mails, manager_mail in batch
+        ])
+        queued += len(batch)
+    db.commit()
+    return queued
+
+# Claims up to `limit` due outbox rows (of run_id only, if given), skipping the ones another delivery holds.
+# They are held for OUTBOX_LEASE seconds and committed before sending, so a slow send doesn't keep locks open.
+# All of them get the same next_attempt_at, which tells this claim apart from a later one of the same rows.
+def claim_outbox_entries(db: Session, limit=OUTBOX_BATCH_SIZE, run_id=None):
+    outbox = NotificationOutbox.__table__
+    due = (
+        select(outbox.c.id)
+        .where(outbox.c.status.in_(OUTBOX_QUEUED), outbox.c.next_attempt_at <= func.now())
+        .order_by(outbox.c.next_attempt_at, outbox.c.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    if run_id is not None:
+        due = due.where(outbox.c.run_id == run_id)
+    entries = db.execute(
+        update(outbox)
+        .where(outbox.c.id.in_(due.scalar_subquery()))
+        .values(status=NotificationOutbox.SENDING, next_attempt_at=func.now() + timedelta(seconds=OUTBOX_LEASE))
+        .returning(outbox.c.id, outbox.c.digest, outbox.c.recipient, outbox.c.manager_id, outbox.c.db_ids,
+                   outbox.c.owner_ids, outbox.c.db_names, outbox.c.owner_mails, outbox.c.attempts, outbox.c.next_attempt_at)
+    ).all()
+    db.commit()
+    return sorted(entries, key=lambda entry: entry.id)
+
+# Extends the lease of the claimed rows `ids`, held until `held_until`, for another OUTBOX_LEASE seconds.
+# Rows claimed again by another delivery after the lease ran out are left alone.
+# Returns the ids still held and when they are held until, None if none is.
+def renew_outbox_lease(db: Session, ids, held_until):
+    outbox = NotificationOutbox.__table__
+    held = db.execute(
+        update(outbox)
+        .where(outbox.c.id.in_(ids), outbox.c.status == NotificationOutbox.SENDING, outbox.c.next_attempt_at == held_until)
+        .values(next_attempt_at=func.now() + timedelta(seconds=OUTBOX_LEASE))
+        .returning(outbox.c.id, outbox.c.next_attempt_at)
+    ).all()
+    db.commit()
+    if len(held) < len(ids):
+        logger.warning('%d outbox rows were claimed again by another delivery, skipping them', len(ids) - len(held))
+    return {row.id for row in held}, held[0].next_attempt_at if held else None
+
+# Stores the (outcome, detail) of each claimed entry and records the attempts in the ledger, in one transaction.
+# Failed emails are retried after outbox_backoff until OUTBOX_MAX_ATTEMPTS, rejected ones are given up at once
+# and deferred ones wait the seconds they were told to without spending an attempt.
+# Only the rows still held until `held_until` are written: a row claimed again by another delivery after the
+# lease ran out belongs to that one, which stores its own outcome. Returns the ids of the rows written.
+def finish_outbox_entries(db: Session, entries, outcomes, held_until):
+    outbox = NotificationOutbox.__table__
+    store = (
+        update(outbox)
+        .where(outbox.c.id == bindparam('b_id'), outbox.c.status == NotificationOutbox.SENDING, outbox.c.next_attempt_at == held_until)
+        .values(status=bindparam('b_status'), attempts=bindparam('b_attempts'), last_error=bindparam('b_error'),
+                sent_at=bindparam('b_sent_at'), next_attempt_at=func.now() + bindparam('b_delay', type_=Interval))
+        .returning(outbox.c.id)
+    )
+    ledger = LedgerWriter(db)
+    now = datetime.now()
+    held = set()
+    for entry, (outcome, detail) in zip(entries, outcomes):
+        change = {'b_id': entry.id, 'b_attempts': entry.attempts + 1, 'b_delay': timedelta(0), 'b_error': None, 'b_sent_at': None}
+        if outcome == SENT:
+            change.update(b_status=NotificationOutbox.SENT, b_sent_at=now)
+        elif outcome == DEFERRED:
+            change.update(b_status=NotificationOutbox.PENDING, b_attempts=entry.attempts, b_delay=timedelta(seconds=detail))
+        elif outcome == FAILED and entry.attempts + 1 < OUTBOX_MAX_ATTEMPTS:
+            change.update(b_status=NotificationOutbox.PENDING, b_error=detail, b_delay=timedelta(seconds=outbox_backoff(entry.attempts + 1)))
         else:
-            #invalids will be return as they came
-            logger.debug('rejecting db_info because it is invalid')
-            invalid_entries.append(rd)
-    db.add_all(valid_entries)
+            change.update(b_status=NotificationOutbox.DEAD, b_error=detail)
+        #the row lock taken by the update keeps it from being claimed again before the commit
+        if db.execute(store, change).scalar() is None:
+            continue
+        held.add(entry.id)
+        if change['b_status'] == NotificationOutbox.DEAD:
+            metrics.NOTIFICATION_OUTBOX.labels('dead').inc()
+        metrics.NOTIFICATION_OUTBOX.labels(outcome).inc()
+        if outcome != DEFERRED:
+            for key in zip(entry.db_ids, entry.owner_ids, [entry.manager_id] * len(entry.db_ids)):
+                ledger.record(key, outcome)
+    if len(held) < len(entries):
+        logger.warning('%d outbox rows were claimed again by another delivery, dropping their outcomes', len(entries) - len(held))
+    ledger.finish()
+    return held
+
+# One delivery round: claims the due outbox rows (of run_id only, if given), sends them OUTBOX_SEND_CHUNK at a
+# time and stores the outcomes of each chunk as it finishes, renewing the lease of the rest before the next one.
+# on_result(notification, outcome) is called for each email attempted or deferred, notification being (db_name,
+# owner_mail, manager_mail), or (databases, manager_mail) for a digest. Returns the number of rows claimed, 0 once none is due.
+def deliver_due_notifications(db: Session, run_id=None, on_result=None, breaker=None, limiter=None, limit=OUTBOX_BATCH_SIZE):
+    entries = claim_outbox_entries(db, limit, run_id)
+    if not entries:
+        return 0
+    held_until = entries[0].next_attempt_at
+    # the sending threads are shared by every chunk of the round
+    with ThreadPoolExecutor(MAIL_POOL_SIZE) as executor:
+        for start in range(0, len(entries), OUTBOX_SEND_CHUNK):
+            chunk = entries[start:start + OUTBOX_SEND_CHUNK]
+            if start:
+                held, held_until = renew_outbox_lease(db, [entry.id for entry in entries[start:]], held_until)
+                if not held:
+                    break
+                chunk = [entry for entry in chunk if entry.id in held]
+            if chunk:
+                _deliver_outbox_entries(db, chunk, held_until, on_result, breaker, limiter, executor)
+    return len(entries)
+
+def _deliver_outbox_entries(db: Session, entries, held_until, on_result, breaker, limiter, executor):
+    notifications = [(entry.digest, list(zip(entry.db_names, entry.owner_mails)), entry.recipient) for entry in entries]
     try:
-        db.commit()
-    except IntegrityError as e:
-        logger.error(f"DB IntegrityError creating multiple db_info from raw json: {repr(e)}")
-        db.rollback()
-        return {'success': False, 'total': 0, 'error': repr(e).split('DETAIL')[1]}
-    logger.debug(f"Adding {len(valid_entries)} db_info entries. Rejecting {len(invalid_entries)}")
-    return {'success': True, 'total': len(valid_entries), 'valid_entries': valid_entries, 'invalid_entries': invalid_entries}
-
-def get_unclassified_dbs(db: Session, response_model=list[schemas.DBInfo]):
-    return db.query(DBInfo).filter_by(classification=DBClass.UNCLASSIFIED.value).all()
-
-def notify_db_owners_manager(db: Session):
-    high_classification_dbs = db.query(DBInfo).filter_by(classification=DBClass.HIGH.value).all()
-    logger.debug('found len(high_classification_dbs) dbs to notify, starting sending mails')
-    emails_with_errors = []
-    for db_info in high_classification_dbs:
-        if not send_email_notification(db_info.db_name, db_info.is_owned.user_mail, db_info.is_owned.managed_by.user_mail):
-            emails_with_errors.append(db_info.is_owned.managed_by.user_mail)
-    return emails_with_errors
+        outcomes = deliver_notifications(notifications, breaker=breaker, limiter=limiter, executor=executor)
+    except Exception as e:
+        # e.g. no mail server configured, try again after the backoff instead of waiting for the lease
+        logger.error('Error delivering notifications: %r', e)
+        outcomes = [(FAILED, repr(e))] * len(entries)
+    held = finish_outbox_entries(db, entries, outcomes, held_until)
+    if on_result is not None:
+        for entry, (digest, databases, recipient), (outcome, _) in zip(entries, notifications, outcomes):
+            if entry.id in held:
+                on_result((databases, recipient) if digest else (*databases[0], recipient), outcome)
+
+# Queues the notifications of `mode` in the outbox and delivers them right away, recording each attempt in the
+# ledger. Returns the managers whose email failed in this run. Failed emails stay in the outbox to be retried
+# with backoff by the outbox worker, and so do the ones deferred by a recipient's rate limit or an open circuit,
+# which on_result gets with the DEFERRED outcome. With digest, each manager gets one email listing all their
+# databases ((databases, manager_mail) notifications) instead of one per database, and every database in it is
+# recorded with the outcome of that email.
+def notify_db_owners_manager(db: Session, on_result=None, mode='all', digest=False, breaker=None, limiter=None):
+    logger.debug('queueing high classification dbs in %s mode, starting sending mails', mode)
+    run_id = uuid.uuid4().hex
+    enqueue_notifications(db, run_id, mode, digest)
+    recipients_with_errors = []
+
+    def record(notification, outcome):
+        if outcome not in (SENT, DEFERRED):
+            recipients_with_errors.append(notification[-1])
+        if on_result is not None:
+            on_result(notification, outcome)
+
+    while deliver_due_notifications(db, run_id, record, breaker, limiter):
+        pass
+    logger.info('notify run %s: %d emails failed', run_id, len(recipients_with_errors))
+    return recipients_with_errors
@@ -1,6 +1,12 @@
 import os
+import time
+import threading
 from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, declarative_base
+from metrics import instrument_engine
 
 DB_USER = os.environ['DB_USER']
 DB_PASS = os.environ['DB_PASS']
@@ -8,8 +14,105 @@ DB_HOST = os.environ['DB_HOST']
 DB_PORT = os.environ['DB_PORT']
 DB_NAME = os.environ['DB_NAME']
 
-engine = create_engine("postgresql://%s:%s@%s:%s/%s" % (DB_USER, DB_PASS, DB_HOST, DB_PORT, DB_NAME))
+DATABASE_URL = "postgresql://%s:%s@%s:%s/%s" % (DB_USER, DB_PASS, DB_HOST, DB_PORT, DB_NAME)
+ASYNC_DATABASE_URL = "postgresql+asyncpg://%s:%s@%s:%s/%s" % (DB_USER, DB_PASS, DB_HOST, DB_PORT, DB_NAME)
+
+def _env_flag(name, default):
+    return os.environ.get(name, str(default)).strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Connections kept open per engine, and extra ones opened under bursts and closed when returned
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# Seconds to wait for a free connection before failing the request
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# Connections older than this many seconds are replaced on checkout (-1 keeps them forever)
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# Test connections on checkout, so the ones dropped by a failover are replaced instead of failing a request
+DB_POOL_PRE_PING = _env_flag('DB_POOL_PRE_PING', True)
+# Server side limit for every statement, in milliseconds (0 disables it)
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+
+# Adds checkout counters and wait times to a queue pool. The wait covers queueing for a free
+# connection and opening a new one when the pool grows into its overflow.
+class PoolStatsMixin:
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self._checkouts += 1
+                self._timeouts += timed_out
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+
+    def stats(self):
+        with self._stats_lock:
+            checkouts, timeouts, wait_total, wait_max = self._checkouts, self._timeouts, self._wait_total, self._wait_max
+        return {
+            'size': self.size(),
+            'max_overflow': self._max_overflow,
+            'checked_out': self.checkedout(),
+            'idle': self.checkedin(),
+            'overflow': max(self.overflow(), 0),
+            'checkouts': checkouts,
+            'timeouts': timeouts,
+            'wait_seconds_avg': round(wait_total / checkouts, 6) if checkouts else 0.0,
+            'wait_seconds_max': round(wait_max, 6),
+        }
+
+class InstrumentedQueuePool(PoolStatsMixin, QueuePool):
+    pass
+
+class InstrumentedAsyncQueuePool(PoolStatsMixin, AsyncAdaptedQueuePool):
+    pass
+
+#Keyword arguments for create_engine/create_async_engine with the pool settings above
+def engine_options(is_async=False, **overrides):
+    options = {
+        'poolclass': InstrumentedAsyncQueuePool if is_async else InstrumentedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT > 0:
+        if is_async:
+            options['connect_args'] = {'server_settings': {'statement_timeout': str(DB_STATEMENT_TIMEOUT)}}
+        else:
+            options['connect_args'] = {'options': f"-c statement_timeout={DB_STATEMENT_TIMEOUT}"}
+    options.update(overrides)
+    return options
+
+engine = create_engine(DATABASE_URL, **engine_options())
 
 Session = sessionmaker(bind=engine)
 
+# Used by the async endpoints, so database round trips don't block the event loop
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(is_async=True))
+
+AsyncSession = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
+instrument_engine(engine, 'sync')
+instrument_engine(async_engine.sync_engine, 'async')
+
+#Live stats of both connection pools
+def pool_stats():
+    return {'sync': engine.pool.stats(), 'async': async_engine.pool.stats()}
+
 Base = declarative_base()
@@ -0,0 +1,163 @@
+import os
+import uuid
+import logging
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from crud import count_high_classification_dbs, notify_db_owners_manager, deliver_due_notifications
+from notifier import SENT, DEFERRED
+
+logger = logging.getLogger(__name__)
+
+# Seconds the outbox worker sleeps when no email is due
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', 5))
+
+# Progress of one /notify run
+class NotificationJob:
+
+    def __init__(self, mode='all', digest=False):
+        self.id = uuid.uuid4().hex
+        self.mode = mode
+        self.digest = digest
+        self.status = 'queued'
+        self.total = None
+        self.sent = 0
+        self.failed = 0
+        self.recipients_with_errors = []
+        # notifications deferred by a rate limit or an open circuit and not attempted since, with their count
+        self._deferred = {}
+        self.error = None
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    #Progress is counted in databases, a digest notification (databases, manager_mail) counts all of its databases
+    def record(self, notification, outcome):
+        count = len(notification[0]) if self.digest else 1
+        key = (tuple(notification[0]), notification[1]) if self.digest else notification
+        with self._lock:
+            # a deferred email can still be sent later in the run
+            self._deferred.pop(key, None)
+            if outcome == SENT:
+                self.sent += count
+            elif outcome == DEFERRED:
+                self._deferred[key] = count
+            else:
+                self.failed += count
+                self.recipients_with_errors.append(notification[-1])
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'job_id': self.id,
+                'mode': self.mode,
+                'digest': self.digest,
+                'status': self.status,
+                'total': self.total,
+                'sent': self.sent,
+                'failed': self.failed,
+                'pending': self.total - self.sent - self.failed if self.total is not None else None,
+                'deferred': sum(self._deferred.values()),
+                'recipients_with_errors': list(self.recipients_with_errors),
+                'recipients_deferred': sorted({key[-1] for key in self._deferred}),
+                'error': self.error,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+
+# Runs notification jobs one at a time on a background thread, each with its own session.
+# Submitting while a job is queued or running returns that job instead of starting another one,
+# so concurrent /notify calls don't send the same emails twice. Keeps the last max_jobs jobs.
+# Jobs live in this process: with several workers each one has its own registry.
+class NotificationJobs:
+
+    def __init__(self, session_factory, max_jobs=100):
+        self._session_factory = session_factory
+        self._max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._current = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='notify')
+
+    #Returns the job and whether it was created by this call. A job already queued or running is returned even if its mode differs.
+    def submit(self, mode='all', digest=False):
+        with self._lock:
+            if self._current is not None and self._current.active:
+                return self._current, False
+            job = NotificationJob(mode, digest)
+            self._jobs[job.id] = job
+            while len(self._jobs) > self._max_jobs:
+                self._jobs.popitem(last=False)
+            self._current = job
+        self._executor.submit(self._run, job)
+        logger.debug('notification job %s queued', job.id)
+        return job, True
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def _run(self, job):
+        job.started_at = datetime.now()
+        job.status = 'running'
+        db = self._session_factory()
+        try:
+            job.total = count_high_classification_dbs(db, mode=job.mode)
+            notify_db_owners_manager(db, on_result=job.record, mode=job.mode, digest=job.digest)
+            job.status = 'finished'
+        except Exception as e:
+            logger.error('notification job %s failed: %r', job.id, e)
+            job.error = repr(e)
+            job.status = 'failed'
+        finally:
+            db.close()
+            job.finished_at = datetime.now()
+        logger.info('notification job %s %s: %d sent, %d failed', job.id, job.status, job.sent, job.failed)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+# Delivers the due outbox emails on a background thread: the retries of failed sends and the emails deferred
+# by a rate limit or an open circuit. Works in rounds of crud.OUTBOX_BATCH_SIZE emails, each with its own session,
+# and sleeps poll_interval seconds when a round finds nothing due. Several workers, in this or other processes,
+# can run at once, claimed rows are skipped by the others.
+class OutboxWorker:
+
+    def __init__(self, session_factory, poll_interval=OUTBOX_POLL_INTERVAL):
+        self._session_factory = session_factory
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+
+    #Runs a delivery round, returns the number of emails claimed
+    def run_once(self):
+        db = self._session_factory()
+        try:
+            return deliver_due_notifications(db)
+        except Exception as e:
+            logger.error('outbox delivery failed: %r', e)
+            return 0
+        finally:
+            db.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.run_once():
+                self._stop.wait(self.poll_interval)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,50 @@
+import os
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+# Lowest level written to the log (DEBUG, INFO, WARNING, ERROR)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# File the log is appended to, '-' (the default) writes to stderr instead
+LOG_FILE = os.environ.get('LOG_FILE', '-')
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+
+_listener = None
+_queue_handler = None
+
+# Routes every log record through an in-memory queue to a background thread that writes it, so request and
+# upload code doesn't wait on the disk. The message is merged with its arguments on the calling thread
+# (QueueHandler.prepare, so later changes to the arguments don't show up in the log) and the line is laid
+# out with LOG_FORMAT by the background thread. Records below `level` are
+# dropped before they are built. Calling it again replaces the previous setup.
+def configure_logging(level=LOG_LEVEL, filename=LOG_FILE):
+    global _listener, _queue_handler
+    stop_logging()
+    if filename == '-':
+        handler = logging.StreamHandler()
+    else:
+        handler = logging.FileHandler(filename, mode='a', encoding='utf-8')
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = queue.SimpleQueue()
+    _queue_handler = QueueHandler(records)
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+    _listener = QueueListener(records, handler)
+    _listener.start()
+    return _listener
+
+#Writes the records still queued and stops the writer thread
+def stop_logging():
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+atexit.register(stop_logging)
@@ -1,27 +1,63 @@
-from fastapi import Depends, FastAPI, HTTPException, File, UploadFile
-from database import Base, Session, engine
-from crud import create_multiple_employees_from_raw, create_multiple_db_info_from_raw, get_unclassified_dbs, notify_db_owners_manager
-from typing import List
+from fastapi import Depends, FastAPI, HTTPException, File, UploadFile, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from database import Session, AsyncSession, pool_stats
+from crud import create_multiple_employees_from_stream_async, create_multiple_db_info_from_stream_async, get_unclassified_db_rows_async, stream_unclassified_db_rows, DEFAULT_BATCH_SIZE
+from crud import get_subtree_db_rows_async, get_escalation_chain_async, employee_in_closure_async
+from crud import create_multiple_employees_from_raw_async, create_multiple_db_info_from_raw_async, MAX_PARSE_WORKERS
+from crud import stream_inventory_export, export_row, EXPORT_COLUMNS, get_db_info_stats_async
+from models.db_info_summary import DBInfoSummary
+from streaming import aiter_text_chunks, read_upload
+from compression import ResponseCompressionMiddleware, DecompressionError
+from jobs import NotificationJobs, OutboxWorker
+from notifier import mail_pool
+from metrics import RequestMetricsMiddleware, render_metrics, RESPONSE_CACHE
+from response_cache import ResponseCache, db_info_version, make_etag, etag_matches
+from logging_config import configure_logging
+from typing import List, Literal, Optional
+from contextlib import asynccontextmanager
+import io
+import os
+import csv
+import json
 import logging
-from schemas import DBInfo
+from schemas import DBInfo, EscalationLevel
+from models.db_info import DBClass
 
-Base.metadata.create_all(engine)
-app = FastAPI()
-logging.basicConfig(level=logging.DEBUG, filename='app.log', filemode='a', format='%(asctime)s - %(levelname)s - %(message)s')
+# Whether this process delivers the notification outbox in the background (one worker per process)
+OUTBOX_WORKER = os.environ.get('OUTBOX_WORKER', 'true').strip().lower() in ('1', 'true', 'yes', 'on')
+
+notification_jobs = NotificationJobs(Session)
+outbox_worker = OutboxWorker(Session)
+
+@asynccontextmanager
+async def lifespan(app):
+    if OUTBOX_WORKER:
+        outbox_worker.start()
+    yield
+    outbox_worker.stop()
+    mail_pool.close()
+
+app = FastAPI(lifespan=lifespan)
+# added first so the metrics middleware, the outer one, times the compression too
+app.add_middleware(ResponseCompressionMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
+configure_logging()
 logger = logging.getLogger(__name__)
+unclassified_cache = ResponseCache('db_info_unclassified')
 
-#Method to yield db session
-def get_db():
-    db = Session()
-    try:
+# Page sizes of /db_info/unclassified
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+#Method to yield async db session, used by the async endpoints
+async def get_async_db():
+    async with AsyncSession() as db:
         yield db
-    finally:
-        db.close()
 
 #Endpoint to upload csv of employees
 #assumes this file's data is correct
 @app.post('/employees/upload')
-async def upload_csv(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_csv(file: UploadFile = File(...), stream: bool = False, batch_size: int = Query(DEFAULT_BATCH_SIZE, gt=0), upsert: bool = False, workers: int = Query(1, ge=1, le=MAX_PARSE_WORKERS), db: AsyncSession = Depends(get_async_db)):
     """
     Upload a CSV file containing employee data.
 
@@ -31,11 +67,24 @@ async def upload_csv(file: UploadFile = File(...), db: Session = Depends(get_db)
 
     Parameters:
     - **file**: The CSV file to upload. The content should be properly formatted according to the expected schema.
+      It can be gzip or zstd compressed (`.csv.gz`, `.csv.zst`), it is decompressed as it is read.
+    - **stream** (bool): If true, the file is read in chunks and committed every `batch_size` rows, keeping memory flat
+      for big files. Batches committed before an error are kept.
+    - **batch_size** (int): Rows per transaction in streaming mode.
+    - **upsert** (bool): If true, employees already loaded (same `user_id`) are updated instead of failing the upload,
+      and the ones whose data didn't change are skipped.
+    - **workers** (int): If greater than 1, the whole file is read into memory, split at line breaks and parsed in
+      that many processes. Files under `UPLOAD_SHARD_MIN_SIZE` bytes are parsed in the request's process. Can't be
+      combined with `stream`.
 
     Returns:
-    - A dictionary with the result of the upload operation, including details such as the number of records added.
+    - A dictionary with the result of the upload operation, including details such as the number of records added
+      and a `report` with the bulk writer used (`copy`, `insert`, `orm` or `upsert`), elapsed seconds and rows per second.
+      In upsert mode it also has the `inserted`, `updated` and `unchanged` counts.
 
     Raises:
+    - **HTTPException (400)**: If the file is not valid utf-8 text, a compressed file is corrupt or truncated, or `workers` is
+      combined with `stream`.
     - **HTTPException (409)**: If there was an error processing the file, an exception is raised with details about the issue.
 
     Example:
@@ -45,6 +94,15 @@ async def upload_csv(file: UploadFile = File(...), db: Session = Depends(get_db)
         "success": true,
       }
       ```
+    - A successful streaming response also reports the rows committed per batch:
+      ```
+      {
+        "success": true,
+        "total": 12000,
+        "batches": [5000, 5000, 2000],
+        "report": {"writer": "copy", "rows": 12000, "seconds": 0.41, "write_seconds": 0.2, "rows_per_sec": 29268}
+      }
+      ```
     - If an error occurs, the response might look like:
       ```
       {
@@ -54,15 +112,24 @@ async def upload_csv(file: UploadFile = File(...), db: Session = Depends(get_db)
       ```
     """
     logger.debug('endpoint /employees/upload called, creating employees from csv')
-    content = await file.read()
-    result = create_multiple_employees_from_raw(db, content.decode('utf-8'))
+    if stream and workers > 1:
+        raise HTTPException(status_code=400, detail='workers can only be used without stream')
+    try:
+        if workers > 1:
+            result = await create_multiple_employees_from_raw_async(db, (await read_upload(file)).decode('utf-8'), workers, upsert=upsert)
+        else:
+            result = await create_multiple_employees_from_stream_async(db, aiter_text_chunks(file), batch_size if stream else None, upsert=upsert)
+    except UnicodeDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"File is not utf-8 text: {e}")
+    except DecompressionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if not result['success']:
-        raise HTTPException(status_code=409, detail=result['error'])
+        raise HTTPException(status_code=409, detail={'error': result['error'], 'total': result['total']} if stream else result['error'])
     return result
 
 #Endpoint to upload json with db data, data *can* be corrupted
 @app.post('/db_info/upload')
-async def upload_json(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_json(file: UploadFile = File(...), stream: bool = False, batch_size: int = Query(DEFAULT_BATCH_SIZE, gt=0), upsert: bool = False, workers: int = Query(1, ge=1, le=MAX_PARSE_WORKERS), db: AsyncSession = Depends(get_async_db)):
     """
     Upload a JSON file containing database information.
 
@@ -70,14 +137,34 @@ async def upload_json(file: UploadFile = File(...), db: Session = Depends(get_db
     The data in the file may contain corrupt entries. The endpoint will attempt to process as much valid data as possible.
 
     Parameters:
-    - **file**: The JSON file to upload. Must be in a valid JSON format.
+    - **file**: The JSON file to upload. Must be in a valid JSON format. It can be gzip or zstd compressed
+      (`.json.gz`, `.json.zst`), it is decompressed as it is read.
+    - **stream** (bool): If true, the array is parsed one entry at a time and valid entries are committed every
+      `batch_size` rows. Only the first `UPLOAD_MAX_INVALID` invalid entries are returned.
+    - **batch_size** (int): Rows per transaction in streaming mode.
+    - **upsert** (bool): If true, databases already loaded (same `db_name` and `owner_id`) are updated instead of
+      being rejected, and the ones whose classification didn't change are skipped. Entries without `db_name` get a new
+      generated name, so they are always inserted.
+    - **workers** (int): If greater than 1, the whole file is read into memory, split between entries and parsed and
+      validated in that many processes. The response is the same as parsing it in one. Files under
+      `UPLOAD_SHARD_MIN_SIZE` bytes, or that can't be split, are parsed in the request's process. Can't be combined
+      with `stream`.
 
     Returns:
     - **number_of_records_added** (int): The number of valid database records successfully added to the database.
-    - **invalid_entries** (int): The number of invalid entries in the JSON file that could not be processed.
+    - **invalid_entries** (List[dict]): The invalid entries in the JSON file that could not be processed, each one as
+      `{"entry": <entry as it came>, "reason": <why it was rejected>}`. Entries whose owner_id is not an existing
+      employee, or that repeat the `db_name` and `owner_id` of a database already loaded, are rejected here instead of
+      failing the whole upload.
+    - **invalid_total** (int): Streaming mode only, the number of invalid entries including the ones not returned.
+    - **batches** (List[int]): Streaming mode only, the rows committed per batch.
+    - **report** (dict): The bulk writer used (`copy`, `insert`, `orm` or `upsert`), rows written, elapsed seconds and rows per second.
+    - **inserted**, **updated**, **unchanged** (int): Upsert mode only, what was done with the valid entries.
 
     Raises:
-    - **HTTPException (409)**: If there was an error processing the file, an exception is raised with details about the issue.
+    - **HTTPException (409)**: If there was an error processing the file (e.g. an owner deleted during the upload), an exception is raised with details about the issue.
+    - **HTTPException (400)**: If the file is not a well formed JSON array, a compressed file is corrupt or truncated, or
+      `workers` is combined with `stream`.
 
     Example:
     - A successful response might look like:
@@ -86,7 +173,7 @@ async def upload_json(file: UploadFile = File(...), db: Session = Depends(get_db
         "success": true,
         "total": 10,
         "valid_entries": [...]
-        "invalid_entries": []
+        "invalid_entries": [{"entry": {"db_name": "x_db", "owner_id": 999, "classification": 3}, "reason": "owner_id 999 does not exist"}]
       }
       ```
     - If an error occurs, the response might look like:
@@ -100,23 +187,59 @@ async def upload_json(file: UploadFile = File(...), db: Session = Depends(get_db
       ```
     """
     logger.debug('endpoint /db_info/upload called, creating db_info from json')
-    content = await file.read()
-    result = create_multiple_db_info_from_raw(db, content)
+    if stream and workers > 1:
+        raise HTTPException(status_code=400, detail='workers can only be used without stream')
+    try:
+        if workers > 1:
+            result = await create_multiple_db_info_from_raw_async(db, (await read_upload(file)).decode('utf-8'), workers, upsert=upsert)
+        elif stream:
+            result = await create_multiple_db_info_from_stream_async(db, aiter_text_chunks(file), batch_size, upsert=upsert)
+        else:
+            result = await create_multiple_db_info_from_stream_async(db, aiter_text_chunks(file), batch_size=None, max_invalid=None, upsert=upsert)
+    except DecompressionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Malformed JSON array: {e}")
     if not result['success']:
-        raise HTTPException(status_code=409, detail=result['error'])
-    return {'number_of_records_added': result['total'], 'invalid_entries': result['invalid_entries']}
+        raise HTTPException(status_code=409, detail={'error': result['error'], 'total': result['total']} if stream else result['error'])
+    response = {'number_of_records_added': result['total'], 'invalid_entries': result['invalid_entries'], 'report': result['report']}
+    if stream:
+        response.update(batches=result['batches'], invalid_total=result['invalid_total'])
+    if upsert:
+        response.update(inserted=result['inserted'], updated=result['updated'], unchanged=result['unchanged'])
+    return response
 
 #Endpoint to get all unclassified dbs
 @app.get('/db_info/unclassified', response_model=List[DBInfo])
-def get_unclass_dbs(db: Session = Depends(get_db)):
+async def get_unclass_dbs(
+    request: Request,
+    after: Optional[int] = None,
+    limit: Optional[int] = Query(None, gt=0, le=MAX_PAGE_SIZE),
+    format: str = Query('json', pattern='^(json|ndjson)$'),
+    db: AsyncSession = Depends(get_async_db),
+):
     """
     Get all unclassified databases.
 
-    This endpoint retrieves a list of all databases that are currently unclassified.
+    This endpoint retrieves the databases that are currently unclassified, ordered by id.
     It's useful for identifying databases that haven't been categorized yet.
 
+    Parameters:
+    - **after** (int): Only return databases with an id greater than this one. Use the `X-Next-After` header of
+      the previous page to get the next one.
+    - **limit** (int): Page size. Without `limit` nor `after` all the databases are returned; with only `after`
+      the json page holds `1000` of them. In ndjson format all the databases after `after` are streamed unless
+      a limit is given.
+    - **format** (str): `json` for a json list or `ndjson` to stream one json object per line.
+
     Returns:
-    - A list of `DBInfo` objects representing unclassified databases.
+    - A list of `DBInfo` objects representing unclassified databases. If the page is full, the `X-Next-After` header
+      holds the `after` value for the next page.
+    - Responses are gzip or zstd compressed when the client accepts it (`Accept-Encoding`) and they are at least
+      `COMPRESSION_MIN_SIZE` bytes long.
+    - Responses carry an `ETag` that changes only when a db_info upload writes rows. Sending it back in
+      `If-None-Match` gets a `304 Not Modified` without running the query. json pages are also kept in memory
+      until the next upload.
 
     Example:
     - A successful response might look like:
@@ -133,29 +256,259 @@ def get_unclass_dbs(db: Session = Depends(get_db)):
       ```
     """
     logger.debug('endpoint /db_info/unclassified called')
-    return get_unclassified_dbs(db)
+    # json is paginated only when asked to, without limit or after all the databases are returned as before
+    if format == 'json' and after is not None:
+        limit = limit or DEFAULT_PAGE_SIZE
+    # the version is read before the query, so a page built while an upload commits is cached under the old one
+    version = await db_info_version.current_async(db)
+    key = (format, after, limit)
+    headers = {'ETag': make_etag(version, key), 'Cache-Control': 'no-cache'}
+    if etag_matches(request.headers.get('if-none-match'), headers['ETag']):
+        RESPONSE_CACHE.labels(unclassified_cache.name, 'not_modified').inc()
+        return Response(status_code=304, headers=headers)
+    if format == 'ndjson':
+        return StreamingResponse(_unclassified_ndjson(after, limit), media_type='application/x-ndjson', headers=headers)
+    cached = unclassified_cache.get(version, key)
+    if cached is None:
+        page = [row._asdict() for row in await get_unclassified_db_rows_async(db, after, limit)]
+        page_headers = {'X-Next-After': str(page[-1]['id'])} if len(page) == limit else {}
+        cached = (json.dumps(page).encode(), page_headers)
+        unclassified_cache.put(version, key, *cached)
+    body, page_headers = cached
+    return Response(body, media_type='application/json', headers={**headers, **page_headers})
+
+#The request session is closed before a streamed body is sent, so the stream opens its own
+async def _unclassified_ndjson(after, limit):
+    async with AsyncSession() as db:
+        result = await stream_unclassified_db_rows(db, after, limit)
+        async for rows in result.partitions():
+            yield ''.join(json.dumps(row._asdict()) + '\n' for row in rows)
+
+#Endpoint to count databases per classification
+@app.get('/db_info/stats')
+async def db_info_stats(owner_id: Optional[int] = None, manager_id: Optional[int] = None, db: AsyncSession = Depends(get_async_db)):
+    """
+    Count the databases per classification, for the whole inventory or for one owner or manager.
+
+    Counts are read from a summary kept up to date by every upload, so the answer doesn't depend on the
+    inventory size.
+
+    Parameters:
+    - **owner_id** (int): Only the databases owned by this employee.
+    - **manager_id** (int): Only the databases owned by the direct reports of this employee.
+
+    Returns:
+    - **scope** (str): `total`, `owner` or `manager`.
+    - **key** (int): The owner or manager id, null for the whole inventory.
+    - **counts** (dict): The number of databases per classification name.
+    - **total** (int): The number of databases.
+
+    Raises:
+    - **HTTPException (400)**: If both owner_id and manager_id are given.
+
+    Example:
+    - `{"scope": "total", "key": null, "counts": {"UNCLASSIFIED": 12, "LOW": 40, "MEDIUM": 31, "HIGH": 9}, "total": 92}`
+    """
+    logger.debug('endpoint /db_info/stats called')
+    if owner_id is not None and manager_id is not None:
+        raise HTTPException(status_code=400, detail='Use either owner_id or manager_id')
+    if owner_id is not None:
+        scope, key = DBInfoSummary.OWNER, owner_id
+    elif manager_id is not None:
+        scope, key = DBInfoSummary.MANAGER, manager_id
+    else:
+        scope, key = DBInfoSummary.TOTAL, 0
+    counts = await get_db_info_stats_async(db, scope, key)
+    return {'scope': scope, 'key': key if scope != DBInfoSummary.TOTAL else None, 'counts': counts, 'total': sum(counts.values())}
+
+#Endpoint to download the whole inventory with owners and managers
+@app.get('/db_info/export')
+async def export_db_info(
+    format: Literal['csv', 'ndjson'] = 'csv',
+    classification: List[Literal['unclassified', 'low', 'medium', 'high']] = Query(None),
+):
+    """
+    Export every database with its owner and the owner's manager.
+
+    The rows are read through a server side cursor and streamed as they come, so the inventory is never held in
+    memory, whatever its size.
+
+    Parameters:
+    - **format** (str): `csv` (with a header line) or `ndjson` (one json object per line).
+    - **classification** (List[str]): Only export these classifications (`unclassified`, `low`, `medium`, `high`).
+      Can be repeated, e.g. `?classification=medium&classification=high`. All of them by default.
+
+    Returns:
+    - One row per database, ordered by id, with `id`, `db_name`, `classification` (its name), `owner_id`,
+      `owner_mail`, `manager_id` and `manager_mail` (empty if the owner has no manager).
+
+    Example:
+    - `id,db_name,classification,owner_id,owner_mail,manager_id,manager_mail`
+    - `1,example_db,HIGH,21,owner@example.com,3,manager@example.com`
+    """
+    logger.debug('endpoint /db_info/export called')
+    classifications = [DBClass[name.upper()] for name in classification] if classification else None
+    if format == 'ndjson':
+        return StreamingResponse(_export_ndjson(classifications), media_type='application/x-ndjson')
+    headers = {'Content-Disposition': 'attachment; filename="db_info_export.csv"'}
+    return StreamingResponse(_export_csv(classifications), media_type='text/csv', headers=headers)
+
+#Each partition of the cursor is written as one chunk of the body
+async def _export_csv(classifications):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    async with AsyncSession() as db:
+        result = await stream_inventory_export(db, classifications)
+        async for rows in result.partitions():
+            writer.writerows(export_row(row) for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    # only the header if there were no rows
+    if buffer.tell():
+        yield buffer.getvalue()
+
+async def _export_ndjson(classifications):
+    async with AsyncSession() as db:
+        result = await stream_inventory_export(db, classifications)
+        async for rows in result.partitions():
+            yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, export_row(row)))) + '\n' for row in rows)
+
+#Endpoint to get the dbs of a classification owned by a manager's whole team
+@app.get('/employees/{user_id}/subtree/dbs', response_model=List[DBInfo])
+async def get_subtree_dbs(
+    user_id: int,
+    classification: Literal['high', 'unclassified'] = 'high',
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, gt=0, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Get the databases owned by an employee or by anyone reporting to them, directly or not.
+
+    Parameters:
+    - **user_id** (int): The manager at the top of the subtree.
+    - **classification** (str): `high` or `unclassified`.
+    - **after** (int), **limit** (int): Pagination by id, as in `/db_info/unclassified`.
+
+    Returns:
+    - A list of `DBInfo` objects ordered by id. If the page is full, the `X-Next-After` header holds the `after`
+      value for the next page.
+
+    Raises:
+    - **HTTPException (404)**: If the employee is not loaded.
+    """
+    logger.debug('endpoint /employees/%s/subtree/dbs called', user_id)
+    if not await employee_in_closure_async(db, user_id):
+        raise HTTPException(status_code=404, detail='Employee not found')
+    db_class = DBClass.HIGH if classification == 'high' else DBClass.UNCLASSIFIED
+    page = [row._asdict() for row in await get_subtree_db_rows_async(db, user_id, db_class, after, limit)]
+    headers = {'X-Next-After': str(page[-1]['id'])} if len(page) == limit else None
+    return Response(json.dumps(page), media_type='application/json', headers=headers)
+
+#Endpoint to get the managers above an employee
+@app.get('/employees/{user_id}/escalation', response_model=List[EscalationLevel])
+async def get_escalation(user_id: int, levels: Optional[int] = Query(None, gt=0), db: AsyncSession = Depends(get_async_db)):
+    """
+    Get the escalation chain of an employee: their manager, their manager's manager and so on up to the top.
+
+    Parameters:
+    - **levels** (int): Only return this many managers up.
+
+    Returns:
+    - A list of `{"depth", "user_id", "user_mail"}` ordered by depth, `1` being the employee's manager.
+
+    Raises:
+    - **HTTPException (404)**: If the employee is not loaded.
+    """
+    logger.debug('endpoint /employees/%s/escalation called', user_id)
+    if not await employee_in_closure_async(db, user_id):
+        raise HTTPException(status_code=404, detail='Employee not found')
+    return [row._asdict() for row in await get_escalation_chain_async(db, user_id, levels)]
 
 #Endpoint to notify high-classified-db owner's managers that they should review the db
-@app.post('/notify')
-def notify(db: Session = Depends(get_db)):
+@app.post('/notify', status_code=202)
+def notify(mode: Literal['all', 'incremental', 'failed'] = 'all', digest: bool = False):
     """
     Notify high-classified database owner's managers to review the database.
 
-    This endpoint sends notifications to the managers of owners of high-classified databases,
-    prompting them to review the respective databases. If there are any issues with the emails sent,
-    it returns a list of recipients with errors.
+    This endpoint queues a background job that sends notifications to the managers of owners of high-classified
+    databases, prompting them to review the respective databases, and returns right away with the job id.
+    The job progress can be followed with `GET /notify/{job_id}`. If a job is already queued or running,
+    that job is returned instead of starting a new one.
+
+    The emails are first written to an outbox, in the same transaction that selects the databases, and then
+    delivered by the job. Emails that fail, or that are held back by the per-recipient rate limit or because the
+    mail server keeps failing, stay in the outbox and are retried in the background with exponential backoff,
+    so calling `/notify` again is not needed to retry them. Databases whose email is still in the outbox are
+    not queued again, their email is retried right away instead.
+
+    Every attempt is recorded in a notification ledger, per database, owner, manager and classification.
+
+    Parameters:
+    - **mode** (str): `all` notifies every high-classified database, `incremental` only the ones without a
+      successful notification to their current owner's manager (new or changed since the last runs) and
+      `failed` only the ones whose last notification failed.
+    - **digest** (bool): If true, each manager gets a single email listing all of their databases, grouped by
+      owner, instead of one email per database.
 
     Returns:
-    - **success** (bool): Indicates whether all notifications were sent successfully.
-    - **recipients_with_errors** (Optional[List[str]]): A list of email addresses that encountered errors during notification.
+    - **job_id** (str): The id of the notification job.
+    - **status** (str): `queued`, `running`, `finished` or `failed`.
+    - **created** (bool): False if the call joined a job that was already queued or running.
 
     Example:
-    - A successful response: `{"success": true}`
-    - A failure response with errors: `{"success": false, "recipients_with_errors": ["email1@example.com", "email2@example.com"]}`
+    - `{"job_id": "5c0f3a9e0b7f4c6b8a0e6f0e7f1d2c3b", "mode": "incremental", "digest": false, "status": "queued", "created": true}`
     """
     logger.debug('endpoint /notify called')
-    emails_with_errors = notify_db_owners_manager(db)
-    if len(emails_with_errors) == 0:
-        return {'success': True}
-    else:
-        return {'success': False, 'recipients_with_errors': emails_with_errors}
+    job, created = notification_jobs.submit(mode, digest)
+    return {'job_id': job.id, 'mode': job.mode, 'digest': job.digest, 'status': job.status, 'created': created}
+
+#Endpoint to follow a notification job
+@app.get('/notify/{job_id}')
+def notify_status(job_id: str):
+    """
+    Get the progress of a notification job.
+
+    Returns:
+    - **status** (str): `queued`, `running`, `finished` or `failed`.
+    - **mode** (str), **digest** (bool): What the job was submitted with.
+    - **total** (int): The number of high-classified databases to notify, known once the job starts.
+    - **sent**, **failed**, **pending** (int): Databases notified, failed and not attempted by the job (in digest mode,
+      all the databases of a digest count as sent or failed with it). Failed and pending databases are left in the
+      outbox, whose retries are not counted here.
+    - **deferred** (int): Pending databases whose email was put off by a recipient's rate limit or an open circuit,
+      left in the outbox for the worker to send later.
+    - **recipients_with_errors** (List[str]): The email addresses that encountered errors during notification.
+    - **recipients_deferred** (List[str]): The email addresses with deferred emails.
+    - **error** (str): The error that stopped the job, if it failed.
+
+    Raises:
+    - **HTTPException (404)**: If there is no job with that id.
+
+    Example:
+    - `{"job_id": "5c0f...", "status": "finished", "total": 3, "sent": 2, "failed": 1, "pending": 0, "deferred": 0, "recipients_with_errors": ["email1@example.com"], "recipients_deferred": [], ...}`
+    """
+    job = notification_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Notification job {job_id} not found")
+    return job.to_dict()
+
+#Internal endpoint with the connection pool usage, to size workers and pools
+@app.get('/internal/pool', include_in_schema=False)
+def pool_status():
+    """
+    Get live stats of the sync and async database connection pools.
+
+    For each pool, returns its configured `size` and `max_overflow`, the connections `checked_out`, `idle` and in
+    `overflow` right now, and since startup the number of `checkouts`, of `timeouts` waiting for a connection and
+    the average and max seconds a checkout waited (`wait_seconds_avg`, `wait_seconds_max`).
+    """
+    return pool_stats()
+
+#Metrics in the Prometheus text format: request latency per route, upload rows and batches, SMTP sends and query times
+@app.get('/metrics', include_in_schema=False)
+def metrics():
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
@@ -0,0 +1,106 @@
+import re
+import time
+from sqlalchemy import event
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# Metrics are module level and pre-labelled where the labels are known up front, so the hot
+# paths only pay for a counter increment or a histogram observation, once per batch or request.
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time to serve a request, until the last byte of the body is sent',
+    ['method', 'route'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+REQUESTS = Counter('http_requests_total', 'Requests served', ['method', 'route', 'status'])
+
+# stage is one of: parsed (read from the upload), validated (passed validation), inserted (committed),
+# rejected (failed validation)
+INGEST_ROWS = Counter('ingest_rows_total', 'Rows processed by the uploads', ['kind', 'stage'])
+INGEST_BATCH_SECONDS = Histogram(
+    'ingest_batch_write_seconds', 'Time to write and commit a batch of an upload', ['kind', 'writer'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+INGEST_BATCH_FAILURES = Counter('ingest_batch_failures_total', 'Upload batches rolled back on an integrity error', ['kind'])
+
+SMTP_SEND_SECONDS = Histogram(
+    'smtp_send_seconds', 'Time to send a notification email, including getting a connection',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+SMTP_SEND_FAILURES = Counter('smtp_send_failures_total', 'Notification emails that could not be sent')
+MAIL_CIRCUIT_OPEN = Gauge('mail_circuit_open', 'Whether sends are paused after repeated mail server failures')
+# outcome is one of: sent, failed (to be retried), rejected, deferred (rate limit or open circuit) or dead (given up)
+NOTIFICATION_OUTBOX = Counter('notification_outbox_total', 'Outbox emails by delivery outcome', ['outcome'])
+
+DB_QUERY_SECONDS = Histogram(
+    'db_query_seconds', 'Time spent executing statements, by statement kind', ['engine', 'statement'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+# result is one of: hit, miss (the response was built and cached) or not_modified (answered with a 304)
+RESPONSE_CACHE = Counter('response_cache_total', 'Lookups in the response caches', ['cache', 'result'])
+
+def record_ingest(kind, parsed, validated, inserted, rejected):
+    INGEST_ROWS.labels(kind, 'parsed').inc(parsed)
+    INGEST_ROWS.labels(kind, 'validated').inc(validated)
+    INGEST_ROWS.labels(kind, 'inserted').inc(inserted)
+    INGEST_ROWS.labels(kind, 'rejected').inc(rejected)
+
+_STATEMENT_KIND = re.compile(r'\s*(\w+)')
+
+#Times every statement run by an engine (for an AsyncEngine, pass its sync_engine)
+def instrument_engine(engine, name):
+    observers = {}
+
+    def observer(statement):
+        # label by the leading keyword (SELECT, INSERT...), so the label set stays small
+        match = _STATEMENT_KIND.match(statement)
+        kind = match.group(1).upper() if match else 'OTHER'
+        if kind not in observers:
+            observers[kind] = DB_QUERY_SECONDS.labels(name, kind)
+        return observers[kind]
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        observer(statement).observe(time.perf_counter() - conn.info['query_start'].pop())
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        starts = exception_context.connection.info.get('query_start') if exception_context.connection is not None else None
+        if starts:
+            starts.pop()
+
+# ASGI middleware recording the latency of every request matched to a route, labelled by the route
+# path template. It wraps the whole response, so streamed bodies are timed until their end.
+class RequestMetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get('route')
+            if route is not None:
+                REQUEST_LATENCY.labels(scope['method'], route.path).observe(time.perf_counter() - start)
+                REQUESTS.labels(scope['method'], route.path, str(status)).inc()
+
+#Current value of every metric in the Prometheus text format, and its content type
+def render_metrics():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,62 @@
+import re
+import pkgutil
+import logging
+import importlib
+from sqlalchemy import text
+from database import engine
+import migrations
+
+logger = logging.getLogger(__name__)
+
+# Any value works as long as no other advisory lock in the app uses it
+MIGRATIONS_LOCK_ID = 7364001
+
+#Returns (version, module name) of every migration in the migrations package, in order
+def available_migrations():
+    found = []
+    for module in pkgutil.iter_modules(migrations.__path__):
+        match = re.match(r'^(\d+)_\w+$', module.name)
+        if match:
+            found.append((int(match.group(1)), module.name))
+    return sorted(found)
+
+#The module of migration `version`, for code that runs the same SQL as one of them
+def load_migration(version):
+    name = dict(available_migrations())[version]
+    return importlib.import_module(f"{migrations.__name__}.{name}")
+
+def applied_versions(connection):
+    return set(connection.execute(text('SELECT version FROM schema_version')).scalars())
+
+# Applies the pending migrations inside the connection's current transaction, holding an advisory
+# lock so concurrent runs wait for each other instead of applying the same migration twice.
+# Returns the versions applied.
+def run_migrations(connection):
+    connection.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': MIGRATIONS_LOCK_ID})
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR NOT NULL,
+            applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+        )
+    """))
+    applied = applied_versions(connection)
+    newly_applied = []
+    for version, name in available_migrations():
+        if version in applied:
+            continue
+        logger.info('applying migration %s', name)
+        load_migration(version).upgrade(connection)
+        connection.execute(text('INSERT INTO schema_version (version, name) VALUES (:version, :name)'), {'version': version, 'name': name})
+        newly_applied.append(version)
+    return newly_applied
+
+def migrate(bind=engine):
+    with bind.begin() as connection:
+        return run_migrations(connection)
+
+# Run out of band before starting the API: python app/migrate.py
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    applied = migrate()
+    print(f"applied migrations: {applied}" if applied else 'schema is up to date')
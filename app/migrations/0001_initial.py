@@ -0,0 +1,29 @@
+from sqlalchemy import text
+
+# Tables as created by Base.metadata.create_all before migrations existed,
+# IF NOT EXISTS adopts databases created that way
+def upgrade(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS employee (
+            id SERIAL NOT NULL,
+            user_id INTEGER,
+            user_state BOOLEAN NOT NULL,
+            user_manager INTEGER,
+            user_mail VARCHAR(100) NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE (id),
+            UNIQUE (user_id),
+            FOREIGN KEY(user_manager) REFERENCES employee (user_id)
+        )
+    """))
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS db_info (
+            id SERIAL NOT NULL,
+            db_name VARCHAR NOT NULL,
+            owner_id INTEGER NOT NULL,
+            classification INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(owner_id) REFERENCES employee (user_id)
+        )
+    """))
@@ -0,0 +1,11 @@
+from sqlalchemy import text
+
+# Indexes for the hot queries:
+# - /db_info/unclassified pages unclassified dbs by id
+# - /notify walks HIGH dbs by id and joins their owner and the owner's manager
+# - owner_id and user_manager back the foreign keys those joins use
+def upgrade(connection):
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_db_info_unclassified_id ON db_info (id) WHERE classification = 0"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_db_info_high_id ON db_info (id) INCLUDE (owner_id, db_name) WHERE classification = 3"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_db_info_owner_id ON db_info (owner_id)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_employee_user_manager ON employee (user_manager)"))
@@ -0,0 +1,21 @@
+from sqlalchemy import text
+
+# Upsert support for re-uploads:
+# - content_hash columns, computed by postgres from the non key columns, so an upsert can skip the
+#   rows that did not change
+# - (db_name, owner_id) becomes the key of db_info, which needs it to be unique
+def upgrade(connection):
+    connection.execute(text("""
+        ALTER TABLE employee ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32)
+            GENERATED ALWAYS AS (md5(user_state::text || '|' || user_mail || '|' || coalesce(user_manager::text, ''))) STORED
+    """))
+    connection.execute(text("""
+        ALTER TABLE db_info ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32)
+            GENERATED ALWAYS AS (md5(owner_id::text || '|' || classification::text)) STORED
+    """))
+    duplicated = connection.execute(text("""
+        SELECT db_name, owner_id FROM db_info GROUP BY db_name, owner_id HAVING count(*) > 1 ORDER BY db_name, owner_id LIMIT 10
+    """)).all()
+    if duplicated:
+        raise RuntimeError(f"db_info has repeated (db_name, owner_id) pairs, remove the duplicates before migrating: {[tuple(pair) for pair in duplicated]}")
+    connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_db_info_db_name_owner_id ON db_info (db_name, owner_id)"))
@@ -0,0 +1,20 @@
+from sqlalchemy import text
+
+# Ledger of the notifications sent by /notify, so incremental runs only contact managers
+# about new or changed HIGH databases
+def upgrade(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS notification_ledger (
+            id SERIAL NOT NULL,
+            db_id INTEGER NOT NULL,
+            owner_id INTEGER NOT NULL,
+            manager_id INTEGER NOT NULL,
+            classification INTEGER NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            attempts INTEGER NOT NULL,
+            sent_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (id),
+            CONSTRAINT uq_notification_ledger_key UNIQUE (db_id, owner_id, manager_id, classification),
+            FOREIGN KEY(db_id) REFERENCES db_info (id)
+        )
+    """))
@@ -0,0 +1,33 @@
+from sqlalchemy import text
+
+# Inserts the closure rows of the employees matching `where`: one per manager above each of them, with the
+# distance to it. The CYCLE clause stops at a manager loop instead of recursing forever, the top of the tree
+# manages itself. crud.py runs it too, for every employee or only for the subtrees an upload changed.
+def closure_insert(where):
+    return f"""
+        INSERT INTO employee_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE chain (ancestor_id, descendant_id, depth) AS (
+            SELECT user_id, user_id, 0 FROM employee WHERE {where}
+            UNION ALL
+            SELECT e.user_manager, chain.descendant_id, chain.depth + 1
+            FROM chain JOIN employee e ON e.user_id = chain.ancestor_id
+            WHERE e.user_manager IS NOT NULL AND e.user_manager <> e.user_id
+        ) CYCLE ancestor_id SET is_cycle USING path
+        SELECT ancestor_id, descendant_id, depth FROM chain WHERE NOT is_cycle
+    """
+
+EMPLOYEE_CLOSURE_REBUILD = closure_insert('user_id IS NOT NULL')
+
+# Closure table of the manager tree, filled from the employees already loaded
+def upgrade(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS employee_closure (
+            ancestor_id INTEGER NOT NULL,
+            descendant_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        )
+    """))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_employee_closure_descendant_depth ON employee_closure (descendant_id, depth)"))
+    connection.execute(text("DELETE FROM employee_closure"))
+    connection.execute(text(EMPLOYEE_CLOSURE_REBUILD))
@@ -0,0 +1,103 @@
+from sqlalchemy import text
+
+# Triggers on db_info and employee that add each statement's counts to db_info_summary (see crud.py)
+SUMMARY_TRIGGERS = """
+CREATE OR REPLACE FUNCTION db_info_summary_add(owner_ids integer[], classifications integer[], counts bigint[]) RETURNS void AS $$
+    WITH delta AS (
+        SELECT * FROM unnest(owner_ids, classifications, counts) AS d(owner_id, classification, n)
+    )
+    INSERT INTO db_info_summary (scope, key, classification, count)
+    SELECT scope, key, classification, sum(n) FROM (
+        SELECT 'total' AS scope, 0 AS key, classification, n FROM delta
+        UNION ALL
+        SELECT 'owner', owner_id, classification, n FROM delta
+        UNION ALL
+        SELECT 'manager', e.user_manager, delta.classification, delta.n
+        FROM delta JOIN employee e ON e.user_id = delta.owner_id
+        WHERE e.user_manager IS NOT NULL
+    ) deltas
+    GROUP BY scope, key, classification
+    -- a fixed order, so concurrent uploads lock the shared rows in the same order
+    ORDER BY scope, key, classification
+    ON CONFLICT (scope, key, classification) DO UPDATE SET count = db_info_summary.count + EXCLUDED.count
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION db_info_summary_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM db_info_summary_add(array_agg(owner_id), array_agg(classification), array_agg(n))
+        FROM (SELECT owner_id, classification, count(*) AS n FROM new_rows GROUP BY 1, 2) d;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM db_info_summary_add(array_agg(owner_id), array_agg(classification), array_agg(n))
+        FROM (SELECT owner_id, classification, -count(*) AS n FROM old_rows GROUP BY 1, 2) d;
+    ELSE
+        PERFORM db_info_summary_add(array_agg(owner_id), array_agg(classification), array_agg(n))
+        FROM (
+            SELECT owner_id, classification, sum(n)::bigint AS n FROM (
+                SELECT owner_id, classification, 1 AS n FROM new_rows
+                UNION ALL
+                SELECT owner_id, classification, -1 FROM old_rows
+            ) changes GROUP BY 1, 2 HAVING sum(n) <> 0
+        ) d;
+    END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+-- an owner moved to another manager takes their counts along
+CREATE OR REPLACE FUNCTION employee_summary_trigger() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO db_info_summary (scope, key, classification, count)
+    SELECT 'manager', manager, classification, sum(n) FROM (
+        SELECT old_rows.user_manager AS manager, s.classification, -s.count AS n
+        FROM old_rows JOIN new_rows USING (id)
+        JOIN db_info_summary s ON s.scope = 'owner' AND s.key = old_rows.user_id
+        WHERE old_rows.user_manager IS DISTINCT FROM new_rows.user_manager AND old_rows.user_manager IS NOT NULL
+        UNION ALL
+        SELECT new_rows.user_manager, s.classification, s.count
+        FROM old_rows JOIN new_rows USING (id)
+        JOIN db_info_summary s ON s.scope = 'owner' AND s.key = old_rows.user_id
+        WHERE old_rows.user_manager IS DISTINCT FROM new_rows.user_manager AND new_rows.user_manager IS NOT NULL
+    ) moves
+    GROUP BY manager, classification
+    ORDER BY manager, classification
+    ON CONFLICT (scope, key, classification) DO UPDATE SET count = db_info_summary.count + EXCLUDED.count;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER db_info_summary_insert AFTER INSERT ON db_info
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION db_info_summary_trigger();
+CREATE OR REPLACE TRIGGER db_info_summary_update AFTER UPDATE ON db_info
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION db_info_summary_trigger();
+CREATE OR REPLACE TRIGGER db_info_summary_delete AFTER DELETE ON db_info
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION db_info_summary_trigger();
+CREATE OR REPLACE TRIGGER employee_summary_update AFTER UPDATE ON employee
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION employee_summary_trigger();
+"""
+
+# The counts recomputed from db_info and employee, also used by crud.rebuild_db_info_summary and check_db_info_summary
+SUMMARY_ROWS = """
+    SELECT 'total' AS scope, 0 AS key, classification, count(*) AS count FROM db_info GROUP BY classification
+    UNION ALL
+    SELECT 'owner', owner_id, classification, count(*) FROM db_info GROUP BY owner_id, classification
+    UNION ALL
+    SELECT 'manager', e.user_manager, d.classification, count(*)
+    FROM db_info d JOIN employee e ON e.user_id = d.owner_id
+    WHERE e.user_manager IS NOT NULL
+    GROUP BY e.user_manager, d.classification
+"""
+
+# Classification counts per inventory, owner and manager (models/db_info_summary.py), kept by triggers on
+# db_info and employee and filled from the rows already loaded. crud.rebuild_db_info_summary recomputes it.
+def upgrade(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS db_info_summary (
+            scope VARCHAR(16) NOT NULL,
+            key INTEGER NOT NULL,
+            classification INTEGER NOT NULL,
+            count BIGINT NOT NULL,
+            PRIMARY KEY (scope, key, classification)
+        )
+    """))
+    connection.execute(text(SUMMARY_TRIGGERS))
+    connection.execute(text("DELETE FROM db_info_summary"))
+    connection.execute(text(f"INSERT INTO db_info_summary (scope, key, classification, count) {SUMMARY_ROWS}"))
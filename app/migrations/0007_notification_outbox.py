@@ -0,0 +1,27 @@
+from sqlalchemy import text
+
+# Outbox of the notification emails, delivered with retries apart from the /notify selection
+def upgrade(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id BIGSERIAL NOT NULL,
+            run_id VARCHAR(32) NOT NULL,
+            digest BOOLEAN NOT NULL,
+            recipient VARCHAR NOT NULL,
+            manager_id INTEGER NOT NULL,
+            db_ids INTEGER[] NOT NULL,
+            owner_ids INTEGER[] NOT NULL,
+            db_names VARCHAR[] NOT NULL,
+            owner_mails VARCHAR[] NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_attempt_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            last_error VARCHAR,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            sent_at TIMESTAMP WITHOUT TIME ZONE,
+            PRIMARY KEY (id)
+        )
+    """))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_notification_outbox_due ON notification_outbox (next_attempt_at) WHERE status IN ('pending', 'sending')"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_notification_outbox_run_id ON notification_outbox (run_id)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_notification_outbox_db_ids ON notification_outbox USING gin (db_ids) WHERE status IN ('pending', 'sending')"))
@@ -0,0 +1,7 @@
+from sqlalchemy import text
+
+# Databases migrated by an earlier 0003 got a key on db_name alone (ux_db_info_db_name), this moves them to
+# the (db_name, owner_id) key 0003 creates now. Nothing to do for the rest: the index already exists.
+def upgrade(connection):
+    connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_db_info_db_name_owner_id ON db_info (db_name, owner_id)"))
+    connection.execute(text("DROP INDEX IF EXISTS ux_db_info_db_name"))
@@ -0,0 +1,38 @@
+from sqlalchemy import text
+
+# Triggers on db_info that bump its row in table_version when a statement changed rows (see crud.py). A new row
+# starts at the current time in microseconds, so the versions of a recreated database don't repeat old ones.
+VERSION_TRIGGERS = """
+CREATE OR REPLACE FUNCTION table_version_bump() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (SELECT FROM changed_rows) THEN
+        INSERT INTO table_version (name, version)
+        VALUES (TG_TABLE_NAME, (extract(epoch FROM clock_timestamp()) * 1000000)::bigint)
+        ON CONFLICT (name) DO UPDATE SET version = table_version.version + 1;
+    END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER db_info_version_insert AFTER INSERT ON db_info
+    REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION table_version_bump();
+CREATE OR REPLACE TRIGGER db_info_version_update AFTER UPDATE ON db_info
+    REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION table_version_bump();
+CREATE OR REPLACE TRIGGER db_info_version_delete AFTER DELETE ON db_info
+    REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION table_version_bump();
+"""
+
+# Version of the db_info data kept in the database (models/table_version.py), so the ETags and cached pages
+# of /db_info/unclassified follow uploads handled by any worker
+def upgrade(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS table_version (
+            name VARCHAR(64) PRIMARY KEY,
+            version BIGINT NOT NULL
+        )
+    """))
+    connection.execute(text(VERSION_TRIGGERS))
+    connection.execute(text("""
+        INSERT INTO table_version (name, version)
+        VALUES ('db_info', (extract(epoch FROM clock_timestamp()) * 1000000)::bigint)
+        ON CONFLICT (name) DO NOTHING
+    """))
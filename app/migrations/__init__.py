@@ -0,0 +1,4 @@
+# Schema migrations, applied in order by migrate.py and recorded in the schema_version table.
+# Each one is a module named <version>_<description>.py with an upgrade(connection) function.
+# Migrations use plain SQL instead of the models, so they keep describing the schema as it was
+# when they were written.
@@ -1,5 +1,6 @@
 import hashlib
-from sqlalchemy import Integer, String, ForeignKey
+import uuid
+from sqlalchemy import Integer, String, ForeignKey, Index, Computed, text
 from sqlalchemy.orm import relationship, mapped_column, Mapped
 from enum import Enum
 from datetime import datetime
@@ -11,13 +12,29 @@ class DBClass(Enum):
     MEDIUM = 2
     HIGH = 3
 
+# Name given to a db_info entry that came without one: hash of (timestamp;owner_id;classification;random uuid).
+# (db_name, owner_id) is unique, so the uuid keeps entries with the same owner and classification apart.
+def default_db_name(owner_id, classification_value):
+    db_hash = "{0};{1};{2};{3}".format(int(datetime.timestamp(datetime.now())), owner_id, classification_value, uuid.uuid4().hex)
+    return str(hashlib.sha256(db_hash.encode('utf-8')).hexdigest())
+
 class DBInfo(Base):
     __tablename__ = 'db_info'
+    # indexes for the hot queries, created by migrations/0002_query_indexes.py, and the (db_name, owner_id)
+    # key used by upserts, created by migrations/0003_content_hash.py
+    __table_args__ = (
+        Index('ux_db_info_db_name_owner_id', 'db_name', 'owner_id', unique=True),
+        Index('ix_db_info_unclassified_id', 'id', postgresql_where=text(f"classification = {DBClass.UNCLASSIFIED.value}")),
+        Index('ix_db_info_high_id', 'id', postgresql_include=['owner_id', 'db_name'], postgresql_where=text(f"classification = {DBClass.HIGH.value}")),
+        Index('ix_db_info_owner_id', 'owner_id'),
+    )
 
     id : Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     db_name : Mapped[str] = mapped_column(String, nullable=False)
     owner_id : Mapped[int] = mapped_column(Integer, ForeignKey('employee.user_id'), nullable=False)
     classification : Mapped[DBClass] = mapped_column(Integer, nullable=False)
+    # kept by postgres, lets upserts skip unchanged rows
+    content_hash : Mapped[str] = mapped_column(String(32), Computed("md5(owner_id::text || '|' || classification::text)", persisted=True))
 
     #relationships
     is_owned : Mapped['Employee'] = relationship('Employee',  back_populates='owns')
@@ -26,8 +43,7 @@ class DBInfo(Base):
         super().__init__()
         # if db_name is empty, create it using hash of: (timestamp;owner_id;classification), all non-None values
         if db_name == '':
-            db_hash = f"{0};{1};{2}".format(int(datetime.timestamp(datetime.now())), owner_id, classification.value)
-            self.db_name = str(hashlib.sha256(db_hash.encode('utf-8')).hexdigest())
+            self.db_name = default_db_name(owner_id, classification.value)
         else:
             self.db_name = db_name
         self.owner_id = owner_id if owner_id is not None else 0
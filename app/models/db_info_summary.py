@@ -0,0 +1,21 @@
+from sqlalchemy import Integer, BigInteger, String
+from sqlalchemy.orm import mapped_column, Mapped
+from database import Base
+
+# Count of databases per classification for the whole inventory (scope 'total', key 0), per owner (scope
+# 'owner', key the owner's user_id) and per manager of their owners (scope 'manager', key the manager's
+# user_id). Kept up to date by triggers created by migrations/0006_db_info_summary.py.
+class DBInfoSummary(Base):
+    __tablename__ = 'db_info_summary'
+
+    TOTAL = 'total'
+    OWNER = 'owner'
+    MANAGER = 'manager'
+
+    scope : Mapped[str] = mapped_column(String(16), primary_key=True)
+    key : Mapped[int] = mapped_column(Integer, primary_key=True)
+    classification : Mapped[int] = mapped_column(Integer, primary_key=True)
+    count : Mapped[int] = mapped_column(BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f"<DBInfoSummary(scope={self.scope}, key={self.key}, classification={self.classification}, count={self.count})>"
@@ -1,4 +1,4 @@
-from sqlalchemy import Integer, String, DateTime, ForeignKey, Boolean
+from sqlalchemy import Integer, String, DateTime, ForeignKey, Boolean, Computed
 from sqlalchemy.orm import relationship, mapped_column, Mapped
 from datetime import datetime
 from database import Base
@@ -9,9 +9,11 @@ class Employee(Base):
     id : Mapped[int] = mapped_column(primary_key=True, unique=True)
     user_id : Mapped[int] = mapped_column(Integer, unique=True)
     user_state : Mapped[bool] = mapped_column(Boolean, nullable=False)
-    user_manager : Mapped[int] = mapped_column(Integer, ForeignKey('employee.user_id'), nullable=True)
+    user_manager : Mapped[int] = mapped_column(Integer, ForeignKey('employee.user_id'), nullable=True, index=True)
     user_mail : Mapped[str] = mapped_column(String(100), nullable=False)
     created_at : Mapped[datetime] = mapped_column(DateTime(), default=datetime.now, nullable=False)
+    # kept by postgres, lets upserts skip unchanged rows (migrations/0003_content_hash.py)
+    content_hash : Mapped[str] = mapped_column(String(32), Computed("md5(user_state::text || '|' || user_mail || '|' || coalesce(user_manager::text, ''))", persisted=True))
 
     #relationships
     managed_by : Mapped['Employee'] = relationship('Employee', remote_side='Employee.user_id', back_populates='manages')
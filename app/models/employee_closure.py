@@ -0,0 +1,20 @@
+from sqlalchemy import Integer, Index
+from sqlalchemy.orm import mapped_column, Mapped
+from database import Base
+
+# Transitive closure of the employee -> manager tree: one row per (ancestor, descendant) pair, with
+# depth 0 for every employee and itself, 1 for its manager and so on. Rebuilt after employee uploads
+# (crud.refresh_employee_closure), so subtree and escalation questions are a single indexed lookup.
+class EmployeeClosure(Base):
+    __tablename__ = 'employee_closure'
+    # the primary key serves subtree lookups by ancestor, this index the chain of managers of an employee
+    __table_args__ = (
+        Index('ix_employee_closure_descendant_depth', 'descendant_id', 'depth'),
+    )
+
+    ancestor_id : Mapped[int] = mapped_column(Integer, primary_key=True)
+    descendant_id : Mapped[int] = mapped_column(Integer, primary_key=True)
+    depth : Mapped[int] = mapped_column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<EmployeeClosure(ancestor_id={self.ancestor_id}, descendant_id={self.descendant_id}, depth={self.depth})>"
@@ -0,0 +1,30 @@
+from sqlalchemy import Integer, String, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy.orm import mapped_column, Mapped
+from datetime import datetime
+from database import Base
+
+# Outcome of the last attempt to tell a manager about one of their report's HIGH databases.
+# There is one row per (db, owner, manager, classification), so a notification is due again
+# when any of them changes, e.g. the owner moves to another manager.
+class NotificationLedger(Base):
+    __tablename__ = 'notification_ledger'
+    __table_args__ = (
+        UniqueConstraint('db_id', 'owner_id', 'manager_id', 'classification', name='uq_notification_ledger_key'),
+    )
+
+    SENT = 'sent'
+    FAILED = 'failed'
+    # refused for good by the mail server, retrying won't help
+    REJECTED = 'rejected'
+
+    id : Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    db_id : Mapped[int] = mapped_column(Integer, ForeignKey('db_info.id'), nullable=False)
+    owner_id : Mapped[int] = mapped_column(Integer, nullable=False)
+    manager_id : Mapped[int] = mapped_column(Integer, nullable=False)
+    classification : Mapped[int] = mapped_column(Integer, nullable=False)
+    status : Mapped[str] = mapped_column(String(16), nullable=False)
+    attempts : Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+    sent_at : Mapped[datetime] = mapped_column(DateTime(), default=datetime.now, nullable=False)
+
+    def __repr__(self):
+        return f"<NotificationLedger(db_id={self.db_id}, manager_id={self.manager_id}, status={self.status}, sent_at={self.sent_at})>"
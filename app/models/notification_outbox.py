@@ -0,0 +1,46 @@
+from sqlalchemy import BigInteger, Integer, String, Boolean, DateTime, Index, text, func
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import mapped_column, Mapped
+from datetime import datetime
+from database import Base
+
+# Notification emails waiting to be delivered. /notify writes one row per email in the same transaction
+# that selects the databases to notify, and the rows are delivered by crud.deliver_due_notifications,
+# from the /notify job and from the outbox worker (jobs.OutboxWorker), until they are sent or given up.
+# db_ids, owner_ids, db_names and owner_mails are aligned: one element per database in the email, a single
+# one unless it is a digest.
+class NotificationOutbox(Base):
+    __tablename__ = 'notification_outbox'
+    __table_args__ = (
+        Index('ix_notification_outbox_due', 'next_attempt_at', postgresql_where=text("status IN ('pending', 'sending')")),
+        Index('ix_notification_outbox_run_id', 'run_id'),
+        # finds the databases that already have an email on its way
+        Index('ix_notification_outbox_db_ids', 'db_ids', postgresql_using='gin', postgresql_where=text("status IN ('pending', 'sending')")),
+    )
+
+    # pending -> sending while a delivery holds it (until next_attempt_at, then it can be claimed again),
+    # -> sent, or dead once refused by the server or out of attempts. Failed attempts go back to pending.
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    DEAD = 'dead'
+
+    id : Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    # the /notify run that queued the email, or the last one that asked for it again
+    run_id : Mapped[str] = mapped_column(String(32), nullable=False)
+    digest : Mapped[bool] = mapped_column(Boolean, nullable=False)
+    recipient : Mapped[str] = mapped_column(String, nullable=False)
+    manager_id : Mapped[int] = mapped_column(Integer, nullable=False)
+    db_ids : Mapped[list] = mapped_column(ARRAY(Integer), nullable=False)
+    owner_ids : Mapped[list] = mapped_column(ARRAY(Integer), nullable=False)
+    db_names : Mapped[list] = mapped_column(ARRAY(String), nullable=False)
+    owner_mails : Mapped[list] = mapped_column(ARRAY(String), nullable=False)
+    status : Mapped[str] = mapped_column(String(16), nullable=False, default=PENDING)
+    attempts : Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    next_attempt_at : Mapped[datetime] = mapped_column(DateTime(), nullable=False, server_default=func.now())
+    last_error : Mapped[str] = mapped_column(String, nullable=True)
+    created_at : Mapped[datetime] = mapped_column(DateTime(), nullable=False, server_default=func.now())
+    sent_at : Mapped[datetime] = mapped_column(DateTime(), nullable=True)
+
+    def __repr__(self):
+        return f"<NotificationOutbox(id={self.id}, recipient={self.recipient}, status={self.status}, attempts={self.attempts})>"
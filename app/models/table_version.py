@@ -0,0 +1,14 @@
+from sqlalchemy import BigInteger, String
+from sqlalchemy.orm import mapped_column, Mapped
+from database import Base
+
+# Version of the data of a table, shared by every process of the API and bumped by triggers created by
+# migrations/0009_table_version.py. response_cache.DataVersion reads it.
+class TableVersion(Base):
+    __tablename__ = 'table_version'
+
+    name : Mapped[str] = mapped_column(String(64), primary_key=True)
+    version : Mapped[int] = mapped_column(BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f"<TableVersion(name={self.name}, version={self.version})>"
@@ -1,15 +1,31 @@
 import os
+import queue
 import logging
 import smtplib
+import threading
+import time
+import metrics
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 logger = logging.getLogger(__name__)
 
-def send_email_notification(db_name : str, owner_mail : str, owners_manager_mail : str):
-    logger.debug(f"sending email about {db_name} to {owners_manager_mail}, who is manager of {owner_mail}")
-    sender = 'noreply@meli.local'
-    receiver = owners_manager_mail
+SENDER = 'noreply@meli.local'
+# Seconds to wait on every SMTP operation before giving up on a message
+MAIL_TIMEOUT = float(os.environ.get('MAIL_TIMEOUT', 10))
+# Persistent SMTP connections, and threads sending through them
+MAIL_POOL_SIZE = int(os.environ.get('MAIL_POOL_SIZE', 4))
+# Seconds a pooled connection can stay idle and still be reused
+MAIL_POOL_MAX_IDLE = float(os.environ.get('MAIL_POOL_MAX_IDLE', 60))
+# Emails a single recipient can get per minute, in bursts of up to that many (0 disables the limit)
+MAIL_RECIPIENT_RATE = float(os.environ.get('MAIL_RECIPIENT_RATE', 60))
+# Consecutive failed sends that open the circuit, and seconds it stays open before a probe send
+MAIL_BREAKER_THRESHOLD = int(os.environ.get('MAIL_BREAKER_THRESHOLD', 5))
+MAIL_BREAKER_COOLDOWN = float(os.environ.get('MAIL_BREAKER_COOLDOWN', 60))
+
+def build_notification_message(db_name : str, owner_mail : str, owners_manager_mail : str):
     body = f"""
 Hola!
 
@@ -23,16 +39,288 @@ Equipo de MeLI :)
 """
     msg = MIMEMultipart()
     msg['Subject'] = f"Revisión de la DB {db_name}"
-    msg['From'] = sender
-    msg['To'] = receiver
+    msg['From'] = SENDER
+    msg['To'] = owners_manager_mail
+    msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+# One message for a manager listing every (db_name, owner_mail) of theirs, grouped by owner
+def build_digest_message(databases, owners_manager_mail : str):
+    by_owner = {}
+    for db_name, owner_mail in databases:
+        by_owner.setdefault(owner_mail, []).append(db_name)
+    listing = '\n'.join(
+        f"- {owner_mail}:\n" + '\n'.join(f"    - {db_name}" for db_name in db_names)
+        for owner_mail, db_names in by_owner.items()
+    )
+    body = f"""
+Hola!
+
+Este mail es enviado automáticamente para recordarle que revisar las siguientes bases de datos, actualmente clasificadas con criticidad ALTA, junto a sus dueños:
+
+{listing}
+
+Este correo lo recibió ya que usted está asignado como líder de los dueños de los activos.
+
+Muchas gracias por su colaboración!
+
+Equipo de MeLI :)
+"""
+    msg = MIMEMultipart()
+    msg['Subject'] = f"Revisión de {len(databases)} DBs con criticidad ALTA"
+    msg['From'] = SENDER
+    msg['To'] = owners_manager_mail
     msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+# Keeps up to `size` open SMTP connections and lends them to one sender at a time.
+# A connection that fails while in use is closed instead of being returned to the pool. Without host and port
+# the server is read from MAIL_SERVER and MAIL_PORT on every connect, and idle connections to another server,
+# or idle for more than `max_idle` seconds (servers drop quiet clients), are closed instead of lent.
+class SMTPConnectionPool:
+
+    def __init__(self, host=None, port=None, size=MAIL_POOL_SIZE, timeout=MAIL_TIMEOUT, max_idle=MAIL_POOL_MAX_IDLE, clock=time.monotonic):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._clock = clock
+        # (server, address, idle since)
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _address(self):
+        host = self.host if self.host is not None else os.environ['MAIL_SERVER']
+        port = int(self.port if self.port is not None else os.environ['MAIL_PORT'])
+        return host, port
+
+    def _take(self, address):
+        while True:
+            try:
+                server, server_address, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                return smtplib.SMTP(*address, timeout=self.timeout)
+            if server_address == address and self._clock() - idle_since <= self.max_idle:
+                return server
+            _quit_quietly(server)
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            address = self._address()
+            server = self._take(address)
+            try:
+                yield server
+            except Exception:
+                _close_quietly(server)
+                raise
+            self._idle.put((server, address, self._clock()))
+
+    def close(self):
+        while True:
+            try:
+                server, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _quit_quietly(server)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _close_quietly(server):
+    try:
+        server.close()
+    except Exception:
+        pass
+
+def _quit_quietly(server):
+    try:
+        server.quit()
+    except Exception:
+        _close_quietly(server)
+
+#Sends a message through a pooled connection, raising the error if it can't
+def _timed_send(msg, owners_manager_mail, pool):
+    start = time.perf_counter()
+    try:
+        _send_pooled(pool, owners_manager_mail, msg)
+    except Exception:
+        metrics.SMTP_SEND_SECONDS.observe(time.perf_counter() - start)
+        metrics.SMTP_SEND_FAILURES.inc()
+        raise
+    metrics.SMTP_SEND_SECONDS.observe(time.perf_counter() - start)
+
+def _send_pooled(pool, receiver, msg):
+    try:
+        with pool.connection() as server:
+            server.sendmail(SENDER, [receiver], msg.as_string())
+    except smtplib.SMTPServerDisconnected:
+        # the server may drop idle connections, retry once on a fresh one
+        with pool.connection() as server:
+            server.sendmail(SENDER, [receiver], msg.as_string())
+
+# Stops sending while the mail server is failing, so a run defers its emails at once instead of waiting for
+# every send to time out. Opens after `threshold` consecutive failures; once `cooldown` seconds went by a
+# single probe send is let through, which closes the circuit if it succeeds or opens it again if it fails.
+class CircuitBreaker:
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=MAIL_BREAKER_THRESHOLD, cooldown=MAIL_BREAKER_COOLDOWN, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    #Returns 0 if a send can go ahead, or the seconds to wait before trying again
+    def before_send(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0
+            if self.state == self.HALF_OPEN:
+                # the probe is still in flight
+                return self.cooldown
+            remaining = self._opened_at + self.cooldown - self._clock()
+            if remaining > 0:
+                return remaining
+            self.state = self.HALF_OPEN
+            return 0
+
+    #Seconds sends are still blocked for, like before_send but without letting the probe through
+    def blocked_for(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0
+            if self.state == self.HALF_OPEN:
+                return self.cooldown
+            return max(0, self._opened_at + self.cooldown - self._clock())
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state != self.CLOSED:
+                logger.info('mail server is back, closing the circuit')
+                self.state = self.CLOSED
+                metrics.MAIL_CIRCUIT_OPEN.set(0)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.threshold):
+                logger.warning('%d consecutive mail failures, pausing sends for %.0fs', self._failures, self.cooldown)
+                self.state = self.OPEN
+                self._opened_at = self._clock()
+                metrics.MAIL_CIRCUIT_OPEN.set(1)
+
+# Token bucket per recipient: up to `rate` emails per `per` seconds, refilled continuously.
+# The buckets live in this process, with several workers each one applies its own limit.
+class RecipientRateLimiter:
+
+    def __init__(self, rate=MAIL_RECIPIENT_RATE, per=60.0, clock=time.monotonic):
+        self.rate = rate
+        self.per = per
+        self._clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    #Takes a token of the recipient's bucket. Returns 0 if there was one, or the seconds until there is
+    def acquire(self, recipient):
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = self._clock()
+            tokens, updated = self._buckets.get(recipient, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - updated) * self.rate / self.per)
+            if tokens >= 1:
+                self._buckets[recipient] = (tokens - 1, now)
+                return 0
+            self._buckets[recipient] = (tokens, now)
+            return (1 - tokens) * self.per / self.rate
+
+    #Gives back a token taken for an email that was not sent after all
+    def release(self, recipient):
+        if not self.rate:
+            return
+        with self._lock:
+            if recipient in self._buckets:
+                tokens, updated = self._buckets[recipient]
+                self._buckets[recipient] = (min(self.rate, tokens + 1), updated)
+
+# Shared by every delivery of this process
+mail_pool = SMTPConnectionPool()
+mail_breaker = CircuitBreaker()
+recipient_limiter = RecipientRateLimiter()
+
+# Outcomes of deliver_notifications
+SENT = 'sent'
+# the server could not be reached or answered with a temporary error, the email can be retried
+FAILED = 'failed'
+# the server refused the email for good (5xx), retrying won't help
+REJECTED = 'rejected'
+# not attempted because of the recipient's rate limit or an open circuit
+DEFERRED = 'deferred'
+
+#Whether an SMTP error is a permanent refusal of the message rather than a problem of the server or the network
+def is_permanent_failure(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
 
+def _deliver(pool, breaker, limiter, digest, databases, owners_manager_mail):
+    wait = breaker.before_send()
+    if wait:
+        # the circuit opened after the send was queued
+        limiter.release(owners_manager_mail)
+        return DEFERRED, wait
+    if digest:
+        msg = build_digest_message(databases, owners_manager_mail)
+    else:
+        msg = build_notification_message(*databases[0], owners_manager_mail)
     try:
-        with smtplib.SMTP(os.environ['MAIL_SERVER'], os.environ['MAIL_PORT']) as server:
-            server.sendmail(sender, [receiver], msg.as_string())
-            logger.debug('mail sent successfully')
+        _timed_send(msg, owners_manager_mail, pool)
     except Exception as e:
-        logger.error(f"Error sending mail to {owners_manager_mail} : {repr(e)}")
-        return False
-    return True
+        logger.error('Error sending mail to %s : %r', owners_manager_mail, e)
+        if is_permanent_failure(e):
+            # the server is up and answering
+            breaker.record_success()
+            return REJECTED, repr(e)
+        breaker.record_failure()
+        return FAILED, repr(e)
+    breaker.record_success()
+    return SENT, None
 
+# Sends (digest, databases, owners_manager_mail) notifications, databases being (db_name, owner_mail) pairs
+# (a single one unless digest), through `workers` threads sharing the persistent connections of `pool`
+# (mail_pool, kept open between calls, by default). Callers sending several batches in a row can pass their
+# own `executor` instead, so its threads are reused.
+# Returns an (outcome, detail) per notification, in the same order: (SENT, None), (FAILED, error),
+# (REJECTED, error) or (DEFERRED, seconds to wait before trying again).
+def deliver_notifications(notifications, breaker=None, limiter=None, pool=None, workers=MAIL_POOL_SIZE, executor=None):
+    if executor is None:
+        with ThreadPoolExecutor(workers) as executor:
+            return deliver_notifications(notifications, breaker, limiter, pool, executor=executor)
+    breaker = mail_breaker if breaker is None else breaker
+    limiter = recipient_limiter if limiter is None else limiter
+    pool = mail_pool if pool is None else pool
+    outcomes = [None] * len(notifications)
+    futures = []
+    for i, (digest, databases, owners_manager_mail) in enumerate(notifications):
+        # an open circuit defers the email without spending the recipient's token
+        wait = breaker.blocked_for() or limiter.acquire(owners_manager_mail)
+        if wait:
+            outcomes[i] = (DEFERRED, wait)
+            continue
+        futures.append((i, executor.submit(_deliver, pool, breaker, limiter, digest, databases, owners_manager_mail)))
+    for i, future in futures:
+        outcomes[i] = future.result()
+    return outcomes
@@ -0,0 +1,16 @@
+import sys
+import logging
+from database import Session
+from crud import rebuild_employee_closure
+
+# Recomputes the closure behind /employees/<user_id>/subtree and /escalation, e.g. after employees were edited by hand
+def main():
+    with Session() as db:
+        rebuild_employee_closure(db)
+    print('employee closure rebuilt')
+    return 0
+
+# python app/rebuild_closure.py
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
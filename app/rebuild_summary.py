@@ -0,0 +1,26 @@
+import sys
+import logging
+import argparse
+from database import Session
+from crud import rebuild_db_info_summary, check_db_info_summary
+
+# Recomputes the counts behind /db_info/stats, or with --check only reports the ones that don't match (exit 1)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rebuild or check the db_info classification summary')
+    parser.add_argument('--check', action='store_true', help='report the counts that differ from the tables, without writing')
+    args = parser.parse_args(argv)
+    with Session() as db:
+        if not args.check:
+            rows = rebuild_db_info_summary(db)
+            print(f"summary rebuilt: {rows} rows")
+            return 0
+        differences = check_db_info_summary(db)
+    for scope, key, classification, stored, actual in differences:
+        print(f"{scope} {key} classification {classification}: stored {stored}, actual {actual}")
+    print(f"{len(differences)} counts differ" if differences else 'summary is consistent')
+    return 1 if differences else 0
+
+# python app/rebuild_summary.py [--check]
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from sqlalchemy import select
+from models.table_version import TableVersion
+import metrics
+
+# Memory the cached responses can take, and how many of them are kept
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 256))
+
+# Version of a table's data, read from table_version (models/table_version.py) so an upload handled by any
+# worker moves the ETags of all of them on. Reading it is a primary key lookup, done once per request.
+class DataVersion:
+
+    def __init__(self, table):
+        self.table = table
+        self._query = select(TableVersion.version).where(TableVersion.name == table)
+
+    #0 until the first write of a schema built with create_all
+    def current(self, db):
+        return db.execute(self._query).scalar() or 0
+
+    async def current_async(self, db):
+        return (await db.execute(self._query)).scalar() or 0
+
+# Moved on by every statement that wrote db_info rows
+db_info_version = DataVersion('db_info')
+
+#Strong ETag of the response to `key` at `version`, known without running the query
+def make_etag(version, key):
+    digest = hashlib.blake2b(repr((version, key)).encode(), digest_size=12).hexdigest()
+    return f'"{digest}"'
+
+#Whether an If-None-Match header value matches the etag ('*', a single tag or a comma separated list)
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.removeprefix('W/') == etag:
+            return True
+    return False
+
+# LRU of serialized responses for the current version of the data, bounded in entries and bytes.
+# Entries are (body, headers). The first access with a newer version drops everything cached, and requests
+# that read an older version (before an upload committed) miss and don't store their responses.
+class ResponseCache:
+
+    def __init__(self, name, max_bytes=RESPONSE_CACHE_MAX_BYTES, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._version = None
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = metrics.RESPONSE_CACHE.labels(name, 'hit')
+        self._misses = metrics.RESPONSE_CACHE.labels(name, 'miss')
+
+    #whether version is the newest seen, the entries of older ones are dropped
+    def _sync_version(self, version):
+        if self._version is None or version > self._version:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+        return version == self._version
+
+    def get(self, version, key):
+        with self._lock:
+            if not self._sync_version(version) or key not in self._entries:
+                self._misses.inc()
+                return None
+            self._entries.move_to_end(key)
+            self._hits.inc()
+            return self._entries[key]
+
+    def put(self, version, key, body, headers=None):
+        size = len(body)
+        with self._lock:
+            if not self._sync_version(version) or size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._bytes -= len(self._entries.pop(key)[0])
+            self._entries[key] = (body, headers)
+            self._bytes += size
+            while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {'version': self._version, 'entries': len(self._entries), 'bytes': self._bytes}
@@ -1,4 +1,7 @@
-from pydantic import BaseModel
+from typing import List, Literal
+from typing_extensions import TypedDict, Annotated
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+from models.db_info import DBClass
 
 class EmployeeBase(BaseModel):
     user_id: int
@@ -36,3 +39,19 @@ class DBInfo(DBInfoBase):
 
     class ConfigDict:
         from_attributes=True
+
+class EscalationLevel(BaseModel):
+    depth: int
+    user_id: int
+    user_mail: str
+
+# A db_info entry of an uploaded JSON, checked in strict mode so values are never coerced between types
+# (e.g. "1" or 1.0 are not a valid owner_id). Extra fields are ignored.
+class DBInfoEntry(TypedDict):
+    __pydantic_config__ = ConfigDict(strict=True)
+    db_name: str
+    owner_id: Annotated[int, Field(gt=0)]
+    classification: Literal[tuple(c.value for c in DBClass)]
+
+#Validates a whole list of entries in one call into pydantic-core
+DBInfoEntries = TypeAdapter(List[DBInfoEntry])
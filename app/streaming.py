@@ -0,0 +1,263 @@
+import os
+import csv
+import json
+import codecs
+import re
+from compression import iter_decompressed, aiter_decompressed
+from json.decoder import WHITESPACE as _WHITESPACE
+
+# Size of each read from an uploaded file, in bytes
+CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+
+#Reads a binary file object in chunks and yields them decoded, never holding more than one chunk.
+#gzip and zstd files are decompressed on the fly.
+def iter_text_chunks(fileobj, chunk_size=CHUNK_SIZE, encoding='utf-8'):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in iter_decompressed(iter_byte_chunks(fileobj, chunk_size)):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+def iter_byte_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+#Async version of iter_text_chunks, for an UploadFile read without blocking the event loop
+async def aiter_text_chunks(upload_file, chunk_size=CHUNK_SIZE, encoding='utf-8'):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    async for chunk in aiter_decompressed(aiter_byte_chunks(upload_file, chunk_size)):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+async def aiter_byte_chunks(upload_file, chunk_size=CHUNK_SIZE):
+    while True:
+        chunk = await upload_file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+#Whole content of an UploadFile, decompressed if it is a gzip or zstd file
+async def read_upload(upload_file, chunk_size=CHUNK_SIZE):
+    return b''.join([chunk async for chunk in aiter_decompressed(aiter_byte_chunks(upload_file, chunk_size))])
+
+#Groups items in lists of `size` items (a single list with all of them if size is None)
+def iter_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if size is not None and len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+#Async iterable over the items of a plain iterable, to feed the async writers from memory
+async def aiter_items(items):
+    for item in items:
+        yield item
+
+async def aiter_batches(items, size):
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if size is not None and len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+#Runs text chunks through a push parser (CSVDictStream, JSONArrayStream), yielding parsed items as they complete
+def iter_parsed(parser, text_chunks):
+    for chunk in text_chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+async def aiter_parsed(parser, text_chunks):
+    async for chunk in text_chunks:
+        for item in parser.feed(chunk):
+            yield item
+    for item in parser.close():
+        yield item
+
+# Splits text chunks into complete lines, keeping the trailing partial line until the next chunk.
+# Lines end at '\n' only ('\r\n' keeps its '\r'), like a file opened with newline='', so other line
+# break characters stay inside the line as the csv module expects.
+class LineSplitter:
+
+    def __init__(self):
+        self._tail = ''
+
+    def feed(self, chunk):
+        text = self._tail + chunk
+        end = text.rfind('\n') + 1
+        self._tail = text[end:]
+        return [line + '\n' for line in text[:end - 1].split('\n')] if end else []
+
+    def close(self):
+        tail, self._tail = self._tail, ''
+        return [tail] if tail else []
+
+# Push parser for CSV uploads: feed it text chunks and get back the complete rows as dicts,
+# keyed by the header line (same output as csv.DictReader).
+# A quoted field can hold line breaks: the lines of a record are held until its quotes are balanced.
+class CSVDictStream:
+
+    def __init__(self):
+        self._lines = LineSplitter()
+        self._fieldnames = None
+        # lines of a record whose quoted field goes on in the next line
+        self._record = []
+        self._quotes = 0
+
+    def feed(self, chunk):
+        return self._rows(self._records(self._lines.feed(chunk)))
+
+    def close(self):
+        lines = self._records(self._lines.close())
+        # an unterminated quoted field is left for the csv reader to handle
+        lines += self._record
+        self._record, self._quotes = [], 0
+        return self._rows(lines)
+
+    #Lines of the records completed by `lines`
+    def _records(self, lines):
+        complete = []
+        for line in lines:
+            self._record.append(line)
+            self._quotes += line.count('"')
+            if self._quotes % 2 == 0:
+                complete += self._record
+                self._record, self._quotes = [], 0
+        return complete
+
+    def _rows(self, lines):
+        rows = []
+        for values in csv.reader(lines):
+            if not values:
+                continue
+            if self._fieldnames is None:
+                self._fieldnames = values
+                continue
+            rows.append(dict(zip(self._fieldnames, values)))
+        return rows
+
+# Largest single array element the JSON parser will buffer while waiting for the rest of it
+MAX_ITEM_SIZE = int(os.environ.get('UPLOAD_MAX_ITEM_SIZE', 1024 * 1024))
+
+# Push parser for uploads holding a top-level JSON array: feed it text chunks and get back the
+# elements completed so far, so only the element being parsed is kept in memory.
+class JSONArrayStream:
+
+    def __init__(self, max_item_size=MAX_ITEM_SIZE):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        # 'start' -> expecting '[', 'first' -> first value or ']', 'value' -> a value, 'next' -> ',' or ']'
+        self._state = 'start'
+        self._max_item_size = max_item_size
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        return self._parse(final=False)
+
+    def close(self):
+        items = self._parse(final=True)
+        if self._state != 'done':
+            raise ValueError('JSON upload is not a complete array')
+        return items
+
+    def _parse(self, final):
+        items = []
+        buffer = self._buffer
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if self._state == 'done':
+                raise ValueError(f"unexpected data after the end of the JSON array at char {pos}")
+            if self._state == 'start':
+                if buffer[pos] != '[':
+                    raise ValueError('JSON upload must be an array')
+                self._state = 'first'
+                pos += 1
+            elif self._state in ('first', 'next') and buffer[pos] == ']':
+                self._state = 'done'
+                pos += 1
+            elif self._state == 'next':
+                if buffer[pos] != ',':
+                    raise ValueError(f"expected ',' or ']' between array elements at char {pos}")
+                self._state = 'value'
+                pos += 1
+            else:
+                try:
+                    item, end = self._decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if final or len(buffer) - pos > self._max_item_size:
+                        raise
+                    break
+                # a number or literal touching the end of the buffer could still continue in the next chunk
+                if end == len(buffer) and not final:
+                    break
+                items.append(item)
+                self._state = 'next'
+                pos = end
+        self._buffer = buffer[pos:]
+        return items
+
+# Record aligned shards of a whole upload, for parsing them in parallel (crud.parse_employees_sharded,
+# crud.parse_db_info_sharded). Cuts are placed near equal sizes and then moved forward to the next
+# record boundary, so a shard never holds part of a record. They can be fewer than asked for.
+
+#Splits CSV text after its header line at line breaks. Returns (header, shards), or None if a shard
+#would start inside a quoted field.
+def split_csv_shards(text, shards):
+    header_end = text.find('\n') + 1
+    if header_end == 0:
+        return None
+    bounds = [header_end]
+    size = (len(text) - header_end) / shards
+    for i in range(1, shards):
+        cut = text.find('\n', max(header_end + int(size * i), bounds[-1]))
+        if cut == -1:
+            break
+        bounds.append(cut + 1)
+    bounds.append(len(text))
+    pieces = [text[start:end] for start, end in zip(bounds, bounds[1:]) if start < end]
+    # an odd count of quotes means a cut landed inside a quoted field with a line break
+    if any(piece.count('"') % 2 for piece in pieces):
+        return None
+    return text[:header_end], pieces
+
+# A comma between two objects, the only place a top-level array of entries is cut
+_OBJECT_BOUNDARY = re.compile(r'\}\s*,\s*\{')
+
+#Splits the elements of a JSON array at commas between objects. Returns the shards, each one the text
+#between the brackets of a smaller array ('[' + shard + ']' parses), or None if the text is not an array.
+#A comma found inside a string or a nested value leaves shards that don't parse, which callers must check.
+def split_json_array_shards(text, shards):
+    stripped = text.strip()
+    if not stripped.startswith('[') or not stripped.endswith(']'):
+        return None
+    first = start = text.index('[') + 1
+    end = text.rindex(']')
+    pieces = []
+    size = (end - first) / shards
+    for i in range(1, shards):
+        match = _OBJECT_BOUNDARY.search(text, max(start, first + int(size * i)), end)
+        if match is None:
+            break
+        comma = text.index(',', match.start())
+        pieces.append(text[start:comma])
+        start = comma + 1
+    pieces.append(text[start:end])
+    return pieces
@@ -0,0 +1,82 @@
+import csv
+import json
+import pytest
+from io import StringIO
+from models.db_info import DBClass
+from crud import db_info_rejection_reason
+from benchmarks.generators import generate_employees_csv, generate_db_info_entries, generate_db_info_json
+from benchmarks.run import run_benchmarks, RSSSampler, check_scratch_database
+from database import Base, engine, Session
+from models.employee import Employee
+
+#Only for the tests that run against the database, the generators don't need it
+@pytest.fixture(scope='module')
+def tables():
+    Base.metadata.create_all(engine)
+
+class TestGenerators:
+
+    def test_employees_form_a_tree(self):
+        rows = list(csv.DictReader(StringIO(generate_employees_csv(500, first_id=100, fanout=5))))
+        assert len(rows) == 500
+        assert rows[0]['user_id'] == rows[0]['user_manager'] == '100'
+        for row in rows[1:]:
+            #managers are always hired before their reports
+            assert 100 <= int(row['user_manager']) < int(row['user_id'])
+        assert len({row['user_mail'] for row in rows}) == 500
+
+    def test_generators_are_deterministic(self):
+        assert generate_employees_csv(50, seed=3) == generate_employees_csv(50, seed=3)
+        assert generate_db_info_json(50, 10, seed=3) == generate_db_info_json(50, 10, seed=3)
+
+    def test_db_info_shares(self):
+        entries = list(generate_db_info_entries(5000, owners=100, first_owner_id=10, invalid_share=0.2, high_share=0.5))
+        invalid = [entry for entry in entries if db_info_rejection_reason(entry) is not None or entry['owner_id'] >= 110]
+        valid = [entry for entry in entries if entry not in invalid]
+        assert 0.15 < len(invalid) / len(entries) < 0.25
+        high = [entry for entry in valid if entry['classification'] == DBClass.HIGH.value]
+        assert 0.45 < len(high) / len(valid) < 0.55
+        assert all(10 <= entry['owner_id'] < 110 for entry in valid)
+
+class TestRSSSampler:
+
+    def test_peak_is_of_the_block_only(self):
+        with RSSSampler() as big:
+            data = bytearray(64 * 1024 * 1024)
+        del data
+        #a later, smaller step doesn't report the earlier peak
+        with RSSSampler() as small:
+            pass
+        assert big.peak - big.baseline > 32
+        assert small.peak - small.baseline < 32
+
+class TestRunBenchmarks:
+
+    def test_small_run(self, tables):
+        report = run_benchmarks(employees=50, dbs=200, invalid_share=0.1, high_share=0.2, first_id=900000)
+        results = {entry['name']: entry for entry in report['results']}
+        assert list(results) == ['create_multiple_employees_from_raw', 'create_multiple_db_info_from_raw', 'get_unclassified_dbs', 'notify_db_owners_manager', 'notify_db_owners_manager_digest']
+        assert results['create_multiple_employees_from_raw']['rows'] == 50
+        db_info = results['create_multiple_db_info_from_raw']
+        assert db_info['rows'] == 200
+        assert db_info['inserted'] + db_info['rejected'] == 200
+        assert db_info['rejected'] > 0
+        assert results['notify_db_owners_manager']['failed'] == 0
+        assert results['notify_db_owners_manager']['rows'] > 0
+        #one digest per manager instead of one email per database
+        assert 0 < results['notify_db_owners_manager_digest']['rows'] < results['notify_db_owners_manager']['rows']
+        assert all(entry['peak_rss_mb'] >= entry['rss_before_mb'] > 0 for entry in report['results'])
+        json.dumps(report)
+
+    def test_refuses_a_database_with_data(self, tables):
+        with engine.connect() as connection:
+            transaction = connection.begin()
+            try:
+                db = Session(bind=connection, join_transaction_mode='create_savepoint')
+                check_scratch_database(db)
+                db.add(Employee(user_id=990000, user_state=True, user_manager=None, user_mail='someone@company.com'))
+                db.flush()
+                with pytest.raises(RuntimeError):
+                    check_scratch_database(db)
+            finally:
+                transaction.rollback()
@@ -0,0 +1,254 @@
+import io
+import gzip
+import zlib
+import tracemalloc
+import json
+import asyncio
+import pytest
+import zstandard
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from fastapi.testclient import TestClient
+from compression import DECOMPRESS_PIECE_SIZE, encoded_etag, decoded_if_none_match, StreamDecoder, DecompressionError, iter_decompressed, aiter_decompressed, negotiate_encoding, detect_compression, ResponseCompressionMiddleware, GzipEncoder, ZstdEncoder
+from streaming import iter_text_chunks, iter_parsed, CSVDictStream, read_upload
+
+CSV = ''.join(f"{i},{i + 1000},True,1000,employee{i}@company.com\n" for i in range(2000)).encode()
+
+def gzip_members(*parts):
+    return b''.join(gzip.compress(part) for part in parts)
+
+def zstd_frames(*parts):
+    compressor = zstandard.ZstdCompressor()
+    return b''.join(compressor.compress(part) for part in parts)
+
+def chunks_of(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestUploadDecompression:
+
+    @pytest.mark.parametrize('compress', [gzip_members, zstd_frames])
+    @pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+    def test_decompress_in_chunks(self, compress, chunk_size):
+        #several members or frames back to back, split anywhere
+        data = compress(CSV[:30000], CSV[30000:])
+        assert b''.join(iter_decompressed(chunks_of(data, chunk_size))) == CSV
+
+    @pytest.mark.parametrize('chunk_size', [1, 100])
+    def test_plain_text_passes_through(self, chunk_size):
+        assert detect_compression(CSV) is None
+        assert b''.join(iter_decompressed(chunks_of(CSV, chunk_size))) == CSV
+        assert b''.join(iter_decompressed([b'ab'])) == b'ab'
+
+    @pytest.mark.parametrize('compress', [gzip_members, zstd_frames])
+    def test_truncated(self, compress):
+        data = compress(CSV)
+        with pytest.raises(DecompressionError, match='truncated'):
+            b''.join(iter_decompressed(chunks_of(data[:-10], 1024)))
+
+    @pytest.mark.parametrize('compress', [gzip_members, zstd_frames])
+    def test_corrupt(self, compress):
+        data = bytearray(compress(CSV))
+        data[20:40] = b'\xff' * 20
+        with pytest.raises(DecompressionError):
+            b''.join(iter_decompressed([bytes(data)]))
+
+    def test_max_decompressed_size(self):
+        decoder = StreamDecoder('gzip', max_size=1000)
+        with pytest.raises(DecompressionError, match='larger than 1000 bytes'):
+            b''.join(decoder.decompress(gzip.compress(b'a' * 100000)))
+
+    @pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+    def test_bomb_is_stopped_before_inflating(self, encoding):
+        #512 MiB of zeros in a few hundred KiB, sent as a single chunk
+        if encoding == 'gzip':
+            compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+            data = b''.join(compressor.compress(bytes(1 << 20)) for _ in range(512)) + compressor.flush()
+        else:
+            compressor = zstandard.ZstdCompressor().compressobj()
+            data = b''.join(compressor.compress(bytes(1 << 20)) for _ in range(512)) + compressor.flush()
+        assert len(data) < 1 << 20
+        tracemalloc.start()
+        try:
+            with pytest.raises(DecompressionError, match='larger than'):
+                for _ in iter_decompressed([data], max_size=10 * 1024 * 1024):
+                    pass
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        #a few pieces in flight instead of the 512 MiB
+        assert peak < 4 * DECOMPRESS_PIECE_SIZE
+
+    @pytest.mark.parametrize('compress', [gzip_members, zstd_frames])
+    def test_pieces_are_bounded(self, compress):
+        data = compress(bytes(3 * DECOMPRESS_PIECE_SIZE), CSV)
+        pieces = list(iter_decompressed([data]))
+        assert max(len(piece) for piece in pieces) <= DECOMPRESS_PIECE_SIZE + 128 * 1024
+        assert b''.join(pieces) == bytes(3 * DECOMPRESS_PIECE_SIZE) + CSV
+
+    def test_async(self):
+        async def chunks():
+            for chunk in chunks_of(zstd_frames(CSV), 512):
+                yield chunk
+
+        async def read():
+            return b''.join([chunk async for chunk in aiter_decompressed(chunks())])
+
+        assert asyncio.run(read()) == CSV
+
+    def test_text_chunks_feed_the_parsers(self):
+        data = gzip.compress(b'row_id,user_id,user_state,user_manager,user_mail\n' + CSV)
+        rows = list(iter_parsed(CSVDictStream(), iter_text_chunks(io.BytesIO(data), chunk_size=100)))
+        assert len(rows) == 2000
+        assert rows[-1]['user_mail'] == 'employee1999@company.com'
+
+    def test_read_upload(self):
+        class Upload:
+            def __init__(self, data):
+                self.file = io.BytesIO(data)
+
+            async def read(self, size=-1):
+                return self.file.read(size)
+
+        assert asyncio.run(read_upload(Upload(gzip.compress(CSV)), chunk_size=1000)) == CSV
+        assert asyncio.run(read_upload(Upload(CSV))) == CSV
+
+
+class TestNegotiation:
+
+    @pytest.mark.parametrize('header, expected', [
+        (None, None),
+        ('', None),
+        ('identity', None),
+        ('gzip', 'gzip'),
+        ('gzip, deflate, zstd', 'zstd'),
+        ('zstd;q=0.5, gzip', 'gzip'),
+        ('gzip;q=0, zstd;q=0', None),
+        ('*', 'zstd'),
+        ('*;q=0.1, gzip;q=0.5', 'gzip'),
+        ('GZIP', 'gzip'),
+        ('gzip;q=bad, zstd;q=0.2', 'zstd'),
+    ])
+    def test_negotiate_encoding(self, header, expected):
+        assert negotiate_encoding(header) == expected
+
+    @pytest.mark.parametrize('encoder, decompress', [(GzipEncoder, gzip.decompress), (ZstdEncoder, lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data))])
+    def test_flushed_chunks_decode_as_they_arrive(self, encoder, decompress):
+        compressor = encoder()
+        first = compressor.compress(b'{"id": 1}\n', flush=True)
+        assert first
+        rest = compressor.compress(b'{"id": 2}\n') + compressor.finish()
+        assert decompress(first + rest) == b'{"id": 1}\n{"id": 2}\n'
+
+
+@pytest.fixture(scope='module')
+def client():
+    app = FastAPI()
+    app.add_middleware(ResponseCompressionMiddleware, minimum_size=100)
+    page = [{'id': i, 'db_name': f"db_{i}", 'owner_id': 1000} for i in range(200)]
+
+    @app.get('/json')
+    def big_json(request: Request):
+        if request.headers.get('if-none-match') == '"abc"':
+            return Response(status_code=304, headers={'ETag': '"abc"'})
+        return Response(json.dumps(page), media_type='application/json', headers={'ETag': '"abc"'})
+
+    @app.get('/small')
+    def small_json():
+        return {'id': 1}
+
+    @app.get('/stream')
+    def stream():
+        async def lines():
+            for row in page:
+                yield json.dumps(row) + '\n'
+        return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+    @app.get('/short_stream')
+    def short_stream():
+        async def lines():
+            yield '{"id": 1}\n'
+        return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+    @app.get('/binary')
+    def binary():
+        return Response(b'\x00' * 1000, media_type='application/octet-stream')
+
+    @app.get('/not_modified')
+    def not_modified():
+        return Response(status_code=304, headers={'ETag': '"abc"'})
+
+    @app.get('/text')
+    def text():
+        return PlainTextResponse('x' * 1000)
+
+    return TestClient(app), page
+
+
+class TestResponseCompression:
+
+    @pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+    def test_compresses_big_responses(self, client, encoding):
+        client, page = client
+        response = client.get('/json', headers={'Accept-Encoding': encoding})
+        assert response.headers['content-encoding'] == encoding
+        assert response.headers['vary'] == 'Accept-Encoding'
+        assert response.headers['etag'] == f'"abc-{encoding}"'
+        assert int(response.headers['content-length']) < len(json.dumps(page)) / 5
+        assert response.json() == page
+
+    def test_no_accept_encoding(self, client):
+        client, page = client
+        response = client.get('/json', headers={'Accept-Encoding': 'identity'})
+        assert 'content-encoding' not in response.headers
+        assert response.headers['etag'] == '"abc"'
+        assert response.json() == page
+
+    def test_small_responses_are_sent_as_they_are(self, client):
+        client, _ = client
+        response = client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        assert 'content-encoding' not in response.headers
+        assert response.headers['vary'] == 'Accept-Encoding'
+        assert response.json() == {'id': 1}
+        response = client.get('/short_stream', headers={'Accept-Encoding': 'gzip'})
+        assert 'content-encoding' not in response.headers
+        assert response.text == '{"id": 1}\n'
+
+    @pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+    def test_streamed_responses(self, client, encoding):
+        client, page = client
+        response = client.get('/stream', headers={'Accept-Encoding': encoding})
+        assert response.headers['content-encoding'] == encoding
+        assert 'content-length' not in response.headers
+        assert [json.loads(line) for line in response.text.splitlines()] == page
+
+    def test_only_text_types_and_ok_responses(self, client):
+        client, _ = client
+        assert 'content-encoding' not in client.get('/binary', headers={'Accept-Encoding': 'gzip'}).headers
+        response = client.get('/not_modified', headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 304
+        assert response.headers['vary'] == 'Accept-Encoding'
+        assert client.get('/text', headers={'Accept-Encoding': 'gzip'}).headers['content-encoding'] == 'gzip'
+
+    @pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+    def test_conditional_requests_per_encoding(self, client, encoding):
+        client, _ = client
+        response = client.get('/json', headers={'Accept-Encoding': encoding, 'If-None-Match': f'"abc-{encoding}"'})
+        assert response.status_code == 304
+        assert response.headers['etag'] == f'"abc-{encoding}"'
+        assert response.headers['vary'] == 'Accept-Encoding'
+        other = 'zstd' if encoding == 'gzip' else 'gzip'
+        response = client.get('/json', headers={'Accept-Encoding': encoding, 'If-None-Match': f'"abc-{other}"'})
+        assert response.status_code == 200
+        assert response.headers['etag'] == f'"abc-{encoding}"'
+        response = client.get('/json', headers={'Accept-Encoding': 'identity', 'If-None-Match': f'"abc-{encoding}"'})
+        assert response.status_code == 200
+        assert response.headers['etag'] == '"abc"'
+        response = client.get('/json', headers={'Accept-Encoding': 'identity', 'If-None-Match': '"abc"'})
+        assert response.status_code == 304
+
+    def test_encoded_etags(self):
+        assert encoded_etag('"abc"', 'gzip') == '"abc-gzip"'
+        assert encoded_etag('W/"abc"', 'zstd') == 'W/"abc-zstd"'
+        assert decoded_if_none_match('"abc-gzip", "abc-zstd", "def", *', 'gzip') == '"abc", "def", *'
+        assert decoded_if_none_match('"abc-zstd"', 'gzip') == ''
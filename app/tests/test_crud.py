@@ -1,16 +1,37 @@
+import json
+import email
+import email.policy
 import pytest
+import crud
+from datetime import datetime
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import event
+from sqlalchemy import event, func, select, text
+from sqlalchemy.exc import IntegrityError, OperationalError
 from models.employee import Employee
-from models.db_info import DBClass, DBInfo
+from models.notification_ledger import NotificationLedger
+from models.notification_outbox import NotificationOutbox
+from models.employee_closure import EmployeeClosure
+from models.db_info import DBClass, DBInfo, default_db_name
 from database import Base, engine
-from crud import create_multiple_employees_from_raw, create_multiple_db_info_from_raw, aux_parse_db_info, validate_db_fields, create_DBInfo, get_unclassified_dbs, create_employee
+from migrate import load_migration
+from crud import create_multiple_employees_from_raw, create_multiple_employees_from_stream, create_multiple_db_info_from_raw, create_multiple_db_info_from_stream, aux_parse_db_info, validate_db_fields, create_DBInfo, get_unclassified_dbs, create_employee, get_bulk_writer, OwnerIndex, notify_db_owners_manager, get_high_classification_notifications, count_high_classification_dbs, get_unclassified_db_rows, db_info_rejection_reason, db_info_rejection_reasons, db_info_rows_if_valid, RejectedEntries, get_subtree_db_rows, get_escalation_chain, high_classification_digests_query
+from crud import employee_rows_from_csv, db_info_rows_from_json, parse_employees_sharded, parse_db_info_sharded
+from crud import get_inventory_export_rows, EXPORT_COLUMNS, get_db_info_stats, check_db_info_summary, rebuild_db_info_summary
+from crud import deliver_due_notifications, claim_outbox_entries, enqueue_notifications, rebuild_employee_closure, integrity_error_constraint
+from models.db_info_summary import DBInfoSummary
+from benchmarks.generators import generate_employees_csv, generate_db_info_json
+from benchmarks.smtp_sink import SMTPSink
+from notifier import SENT, FAILED, REJECTED, DEFERRED
 
 Session = sessionmaker(bind=engine)
 
 @pytest.fixture(scope='class')
 def db_session():
     Base.metadata.create_all(engine)
+    #the summary and version triggers come with the migrations, not with the models
+    with engine.begin() as connection:
+        connection.execute(text(load_migration(6).SUMMARY_TRIGGERS))
+        connection.execute(text(load_migration(9).VERSION_TRIGGERS))
     connection = engine.connect()
     transaction = connection.begin()
     session = Session(bind=connection)
@@ -95,6 +116,36 @@ class TestCrud:
         assert employee_2.managed_by == manager
         assert employee_2 in manager.manages
 
+    def test_crud_create_multiple_employees_from_stream(self, db_session):
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+4000,4000,True,4000,stream40@company.com
+4001,4001,False,4000,stream41@company.com
+4002,4002,True,4001,stream42@company.com
+"""
+        #feed the csv in small chunks so rows get split between them
+        chunks = [raw_csv[i:i + 7] for i in range(0, len(raw_csv), 7)]
+        progress = []
+        result = create_multiple_employees_from_stream(db_session, chunks, batch_size=2, on_batch=lambda *args: progress.append(args))
+        assert result['success']
+        assert result['total'] == 3
+        assert result['batches'] == [2, 1]
+        assert progress == [(1, 2, 2), (2, 1, 3)]
+        employee = db_session.query(Employee).filter_by(user_id=4002).first()
+        assert employee.user_mail == 'stream42@company.com'
+        assert employee.managed_by.user_id == 4001
+
+    def test_crud_create_multiple_employees_from_stream_keeps_committed_batches(self, db_session):
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+4100,4100,True,4100,stream50@company.com
+4101,4101,True,4100,stream51@company.com
+4102,4100,True,4100,duplicated@company.com
+"""
+        result = create_multiple_employees_from_stream(db_session, [raw_csv], batch_size=2)
+        assert not result['success']
+        assert result['total'] == 2
+        assert 'error' in result
+        assert db_session.query(Employee).filter_by(user_id=4101).first() is not None
+
     def test_crud_create_multiple_db_info_from_raw(self, db_session, valid_db_info_raw_entry):
         #create employee owner of db
         create_employee(db_session, Employee(3000, True, 'db_owner@company.com', 3000))
@@ -114,6 +165,49 @@ class TestCrud:
         assert db_info_from_db.owner_id == db_owner.user_id
         assert DBClass(db_info_from_db.classification) == DBClass.MEDIUM
 
+    def test_crud_create_multiple_db_info_from_stream(self, db_session):
+        create_employee(db_session, Employee(3100, True, 'stream_owner@company.com', 3100))
+        raw_json = json.dumps([
+            {'db_name': 'stream_db_1', 'owner_id': 3100, 'classification': 1},
+            {'db_name': 'stream_db_2', 'owner_id': -1, 'classification': 1},
+            {'db_name': 'stream_db_3', 'owner_id': 3100, 'classification': 3},
+            {'db_name': 'stream_db_4', 'owner_id': 3100, 'classification': 9},
+            {'db_name': 'stream_db_5', 'owner_id': 3100, 'classification': 2},
+        ])
+        chunks = [raw_json[i:i + 11] for i in range(0, len(raw_json), 11)]
+        result = create_multiple_db_info_from_stream(db_session, chunks, batch_size=2, max_invalid=1)
+        assert result['success']
+        assert result['total'] == 3
+        assert result['batches'] == [2, 1]
+        assert result['invalid_total'] == 2
+        assert result['invalid_entries'] == [{'entry': {'db_name': 'stream_db_2', 'owner_id': -1, 'classification': 1}, 'reason': 'owner_id is not a positive integer'}]
+        stored = db_session.query(DBInfo).filter(DBInfo.db_name.like('stream_db_%')).all()
+        assert sorted(d.db_name for d in stored) == ['stream_db_1', 'stream_db_3', 'stream_db_5']
+
+    def test_crud_create_multiple_db_info_from_raw_unknown_owner(self, db_session):
+        create_employee(db_session, Employee(3200, True, 'owner_3200@company.com', 3200))
+        raw_json = json.dumps([
+            {'db_name': 'owned_db', 'owner_id': 3200, 'classification': 1},
+            {'db_name': 'orphan_db', 'owner_id': 999999, 'classification': 1},
+        ])
+        result = create_multiple_db_info_from_raw(db_session, raw_json)
+        assert result['success']
+        assert result['total'] == 1
+        assert result['invalid_entries'] == [{'entry': {'db_name': 'orphan_db', 'owner_id': 999999, 'classification': 1}, 'reason': 'owner_id 999999 does not exist'}]
+        assert db_session.query(DBInfo).filter_by(db_name='owned_db').first() is not None
+        assert db_session.query(DBInfo).filter_by(db_name='orphan_db').first() is None
+
+    def test_owner_index(self, db_session):
+        owners = OwnerIndex.load(db_session)
+        assert 3200 in owners
+        assert 999999 not in owners
+        assert len(owners) == db_session.query(Employee).count()
+        owners = OwnerIndex([1, 5, 9])
+        assert 5 in owners
+        assert 4 not in owners
+        assert 10 not in owners
+        assert owners.missing({1, 4, 5, 10}) == {4, 10}
+
     def test_crud_aux_parse_db_info(self, db_session, valid_db_info_object):
         parsed = aux_parse_db_info(valid_db_info_object)
         assert parsed is not None
@@ -198,6 +292,54 @@ class TestCrud:
         invalid_fields = {'db_name' : 'test', 'owner_id': 3000, 'classification': 'invalid'}
         assert not validate_db_fields(invalid_fields)
 
+    def test_validate_db_fields_bool_and_float_are_not_coerced(self):
+        assert not validate_db_fields({'db_name' : 'test', 'owner_id': True, 'classification': 3})
+        assert not validate_db_fields({'db_name' : 'test', 'owner_id': 3000, 'classification': 1.0})
+
+    @pytest.mark.parametrize('entry, reason', [
+        ('not an object', 'entry is not a json object'),
+        ({'owner_id': 3000, 'classification': 1}, 'missing field db_name'),
+        ({'db_name': 'test', 'owner_id': None, 'classification': 1}, 'owner_id is null'),
+        ({'db_name': 1, 'owner_id': 3000, 'classification': 1}, 'db_name is not of type str'),
+        ({'db_name': 'test', 'owner_id': '3000', 'classification': 1}, 'owner_id is not of type int'),
+        ({'db_name': 'test', 'owner_id': 3000, 'classification': '1'}, 'classification is not of type int'),
+        ({'db_name': 'test', 'owner_id': 0, 'classification': 1}, 'owner_id is not a positive integer'),
+        ({'db_name': 'test', 'owner_id': 3000, 'classification': 4}, 'classification 4 is outside boundaries'),
+        #type rules are checked before value rules, fields in order
+        ({'db_name': 'test', 'owner_id': -1}, 'missing field classification'),
+        ({'db_name': 'test', 'owner_id': -1, 'classification': 9}, 'owner_id is not a positive integer'),
+        ({'db_name': None, 'owner_id': None}, 'db_name is null'),
+    ])
+    def test_db_info_rejection_reason(self, entry, reason):
+        assert db_info_rejection_reason(entry) == reason
+
+    def test_db_info_rejection_reasons_for_a_batch(self):
+        entries = [
+            {'db_name': 'ok', 'owner_id': 1, 'classification': 0},
+            {'db_name': 'ok', 'owner_id': 1},
+            {'db_name': 'ok', 'owner_id': 1, 'classification': 3, 'extra': True},
+            {'db_name': 'ok', 'owner_id': -5, 'classification': 3},
+        ]
+        assert db_info_rejection_reasons(entries) == {1: 'missing field classification', 3: 'owner_id is not a positive integer'}
+        assert db_info_rejection_reasons(entries[:1]) == {}
+
+    def test_db_info_rows_if_valid(self):
+        rejected = RejectedEntries()
+        entries = [
+            {'db_name': 'ok', 'owner_id': 1, 'classification': 0},
+            {'db_name': '', 'owner_id': 2, 'classification': 3},
+            {'db_name': 'orphan', 'owner_id': 3, 'classification': 1},
+            {'db_name': 'bad', 'owner_id': 1, 'classification': 8},
+        ]
+        rows = db_info_rows_if_valid(entries, OwnerIndex([1, 2]), rejected)
+        assert rows[0] == ('ok', 1, 0)
+        #blank names are filled in
+        assert len(rows[1][0]) == 64 and rows[1][1:] == (2, 3)
+        assert [entry['reason'] for entry in rejected.entries] == ['owner_id 3 does not exist', 'classification 8 is outside boundaries']
+
+    def test_default_db_name_is_unique(self):
+        assert default_db_name(1, 3) != default_db_name(1, 3)
+
     def test_get_unclassified_db_info(self, db_session):
         unclassified_db = DBInfo('unclass_test', 3000, DBClass.UNCLASSIFIED)
         classified_db = DBInfo('class_test', 3000, DBClass.LOW)
@@ -234,3 +376,620 @@ class TestCrudQueries:
         assert classified_db not in query_result
         for qr in query_result:
             assert DBClass(qr.classification) == DBClass.UNCLASSIFIED
+
+
+    def test_get_unclassified_dbs_keyset_pages(self, db_session):
+        for i in range(5):
+            create_DBInfo(db_session, DBInfo(f"page_test_{i}", 3000, DBClass.UNCLASSIFIED))
+        all_unclassified = get_unclassified_dbs(db_session)
+        first_page = get_unclassified_dbs(db_session, limit=3)
+        assert first_page == all_unclassified[:3]
+        second_page = get_unclassified_dbs(db_session, after=first_page[-1].id, limit=3)
+        assert second_page == all_unclassified[3:6]
+        assert [qr.id for qr in first_page + second_page] == sorted(qr.id for qr in first_page + second_page)
+
+    def test_get_unclassified_db_rows(self, db_session):
+        all_unclassified = get_unclassified_dbs(db_session)
+        rows = list(get_unclassified_db_rows(db_session, after=all_unclassified[0].id, limit=2))
+        assert [row._asdict() for row in rows] == [
+            {'id': qr.id, 'db_name': qr.db_name, 'owner_id': qr.owner_id, 'classification': qr.classification}
+            for qr in all_unclassified[1:3]
+        ]
+
+
+class TestBulkWriters:
+
+    @pytest.mark.parametrize('method', ['copy', 'insert', 'orm'])
+    def test_bulk_writers_upload(self, db_session, method):
+        base = {'copy': 5000, 'insert': 5100, 'orm': 5200}[method]
+        raw_csv = f"""row_id,user_id,user_state,user_manager,user_mail
+1,{base},True,{base},boss{base}@company.com
+2,{base + 1},False,{base},emp{base}@company.com
+3,{base + 2},True,{base},
+"""
+        result = create_multiple_employees_from_raw(db_session, raw_csv, writer=get_bulk_writer(db_session, Employee, method))
+        assert result['success']
+        assert result['report']['writer'] == method
+        assert result['report']['rows'] == 3
+        #every writer stores an empty value as an empty string, not NULL
+        assert db_session.query(Employee).filter_by(user_id=base + 2).one().user_mail == ''
+        employee = db_session.query(Employee).filter_by(user_id=base + 1).first()
+        assert not employee.user_state
+        assert employee.user_mail == f"emp{base}@company.com"
+        assert employee.created_at is not None
+        assert employee.managed_by.user_id == base
+        raw_json = json.dumps([
+            {'db_name': f"bulk_{method}", 'owner_id': base + 1, 'classification': 3},
+            {'db_name': '', 'owner_id': base, 'classification': 1},
+        ])
+        result = create_multiple_db_info_from_raw(db_session, raw_json, writer=get_bulk_writer(db_session, DBInfo, method))
+        assert result['success']
+        assert result['total'] == 2
+        stored = db_session.query(DBInfo).filter_by(owner_id=base + 1).one()
+        assert stored.db_name == f"bulk_{method}"
+        assert DBClass(stored.classification) == DBClass.HIGH
+        unnamed = db_session.query(DBInfo).filter_by(owner_id=base).one()
+        assert len(unnamed.db_name) == 64
+
+    @pytest.mark.parametrize('method', ['copy', 'insert', 'orm'])
+    def test_bulk_writers_integrity_error(self, db_session, method):
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+1,5300,True,5300,first@company.com
+2,5300,True,5300,duplicated@company.com
+"""
+        result = create_multiple_employees_from_raw(db_session, raw_csv, writer=get_bulk_writer(db_session, Employee, method))
+        assert not result['success']
+        assert 'user_id' in result['error']
+        assert db_session.query(Employee).filter_by(user_id=5300).first() is None
+
+    def test_bulk_writer_auto_uses_copy_on_psycopg2(self, db_session):
+        assert get_bulk_writer(db_session, Employee).method == 'copy'
+
+
+class TestNotifyQueries:
+
+    @pytest.fixture(scope='class')
+    def high_dbs(self, db_session):
+        create_multiple_employees_from_raw(db_session, """row_id,user_id,user_state,user_manager,user_mail
+1,6000,True,6000,boss@company.com
+2,6001,True,6000,manager@company.com
+3,6002,True,6001,owner_a@company.com
+4,6003,True,6001,owner_b@company.com
+""")
+        create_multiple_db_info_from_raw(db_session, json.dumps(
+            [{'db_name': f"high_{i}", 'owner_id': 6002 + i % 2, 'classification': 3} for i in range(10)]
+            + [{'db_name': 'medium_db', 'owner_id': 6002, 'classification': 2}]
+        ))
+
+    def test_get_high_classification_notifications(self, db_session, high_dbs):
+        notifications = list(get_high_classification_notifications(db_session))
+        assert len(notifications) == 10
+        assert notifications[0] == ('high_0', 'owner_a@company.com', 'manager@company.com')
+        assert notifications[1] == ('high_1', 'owner_b@company.com', 'manager@company.com')
+
+    def test_notify_db_owners_manager_single_query(self, db_session, high_dbs, monkeypatch):
+        sent = []
+
+        def fake_deliver_notifications(notifications, breaker=None, limiter=None, executor=None):
+            sent.extend(notifications)
+            return [(FAILED, 'error') if databases[0][0] == 'high_0' else (SENT, None) for _, databases, _ in notifications]
+
+        monkeypatch.setattr(crud, 'deliver_notifications', fake_deliver_notifications)
+        statements = []
+        connection = db_session.connection()
+        listener = lambda *args: statements.append(args[2])
+        event.listen(connection, 'before_cursor_execute', listener)
+        try:
+            errors = notify_db_owners_manager(db_session)
+        finally:
+            event.remove(connection, 'before_cursor_execute', listener)
+        assert errors == ['manager@company.com']
+        assert len(sent) == 10
+        #one query no matter how many databases are notified, the outbox and ledger are written with INSERT and UPDATE
+        assert len([statement for statement in statements if statement.startswith('SELECT')]) == 1
+        #the next tests start with nothing notified
+        db_session.query(NotificationLedger).delete()
+        db_session.query(NotificationOutbox).delete()
+        db_session.commit()
+
+    def test_notification_ledger_modes(self, db_session, high_dbs, monkeypatch):
+        failing = {'high_3', 'high_7'}
+        rejected = {'high_5'}
+
+        def fake_deliver_notifications(notifications, breaker=None, limiter=None, executor=None):
+            return [(FAILED, 'error') if databases[0][0] in failing else (REJECTED, 'refused') if databases[0][0] in rejected else (SENT, None)
+                    for _, databases, _ in notifications]
+
+        monkeypatch.setattr(crud, 'deliver_notifications', fake_deliver_notifications)
+        assert count_high_classification_dbs(db_session, mode='incremental') == 10
+        assert len(notify_db_owners_manager(db_session, mode='incremental')) == 3
+        ledger = db_session.query(NotificationLedger).all()
+        assert len(ledger) == 10
+        assert sorted(entry.db_id for entry in ledger if entry.status == NotificationLedger.FAILED) == sorted(
+            db_info.id for db_info in db_session.query(DBInfo).filter(DBInfo.db_name.in_(failing)))
+        assert [entry.db_id for entry in ledger if entry.status == NotificationLedger.REJECTED] == [
+            db_info.id for db_info in db_session.query(DBInfo).filter(DBInfo.db_name.in_(rejected))]
+        #only the failed ones are due, both for incremental and failed-only runs, the rejected one isn't retried
+        assert [n[0] for n in get_high_classification_notifications(db_session, mode='incremental')] == ['high_3', 'high_7']
+        assert [n[0] for n in get_high_classification_notifications(db_session, mode='failed')] == ['high_3', 'high_7']
+        failing.clear()
+        assert notify_db_owners_manager(db_session, mode='failed') == []
+        assert count_high_classification_dbs(db_session, mode='incremental') == 0
+        assert count_high_classification_dbs(db_session, mode='failed') == 0
+        assert count_high_classification_dbs(db_session) == 10
+        db_session.expire_all()
+        assert sorted(entry.attempts for entry in db_session.query(NotificationLedger)) == [1] * 8 + [2] * 2
+        #moving an owner to another manager makes their databases due again
+        db_session.query(Employee).filter_by(user_id=6003).update({'user_manager': 6000})
+        db_session.commit()
+        assert count_high_classification_dbs(db_session, mode='incremental') == 5
+
+    def test_high_classification_digests(self, db_session, high_dbs):
+        digests = db_session.execute(high_classification_digests_query()).all()
+        #6003 was moved under the boss by the previous test
+        assert [(digest[1], digest[4]) for digest in digests] == [
+            ('boss@company.com', ['high_1', 'high_3', 'high_5', 'high_7', 'high_9']),
+            ('manager@company.com', ['high_0', 'high_2', 'high_4', 'high_6', 'high_8']),
+        ]
+        assert set(digests[0][5]) == {'owner_b@company.com'}
+
+    def test_notify_digest(self, db_session, high_dbs, monkeypatch):
+        with SMTPSink(reject={'boss@company.com'}) as sink:
+            monkeypatch.setenv('MAIL_SERVER', sink.host)
+            monkeypatch.setenv('MAIL_PORT', str(sink.port))
+            #only the boss has databases due, one email for all five
+            assert notify_db_owners_manager(db_session, mode='incremental', digest=True) == ['boss@company.com']
+            assert count_high_classification_dbs(db_session, mode='failed') == 5
+            sink.reject.clear()
+            assert notify_db_owners_manager(db_session, mode='failed', digest=True) == []
+            assert count_high_classification_dbs(db_session, mode='incremental') == 0
+            monkeypatch.setattr(crud, 'DIGEST_MAX_DATABASES', 3)
+            assert notify_db_owners_manager(db_session, digest=True) == []
+        #messages are sent in parallel, their order is not fixed
+        assert sorted(recipients for _, recipients, _ in sink.messages) == [['boss@company.com']] * 3 + [['manager@company.com']] * 2
+        body = email.message_from_string(sink.messages[0][2], policy=email.policy.default).get_body().get_content()
+        assert 'owner_b@company.com' in body and all(f"high_{i}" in body for i in (1, 3, 5, 7, 9))
+
+class TestNotificationOutbox:
+
+    @pytest.fixture(scope='class')
+    def high_dbs(self, db_session):
+        create_multiple_employees_from_raw(db_session, """row_id,user_id,user_state,user_manager,user_mail
+1,6100,True,6100,outbox_manager@company.com
+2,6101,True,6100,outbox_owner@company.com
+""")
+        create_multiple_db_info_from_raw(db_session, json.dumps(
+            [{'db_name': f"outbox_{i}", 'owner_id': 6101, 'classification': 3} for i in range(3)]
+        ))
+
+    @pytest.fixture()
+    def outcomes(self, monkeypatch):
+        #outcome per db_name, sent unless set
+        outcomes = {}
+        attempted = []
+
+        def fake_deliver_notifications(notifications, breaker=None, limiter=None, executor=None):
+            attempted.extend(databases[0][0] for _, databases, _ in notifications)
+            return [outcomes.get(databases[0][0], (SENT, None)) for _, databases, _ in notifications]
+
+        monkeypatch.setattr(crud, 'deliver_notifications', fake_deliver_notifications)
+        yield outcomes, attempted
+
+    def make_due(self, db_session):
+        db_session.query(NotificationOutbox).filter(NotificationOutbox.status == NotificationOutbox.PENDING).update({'next_attempt_at': datetime(2000, 1, 1)})
+        db_session.commit()
+
+    def entries(self, db_session):
+        db_session.expire_all()
+        return {entry.db_names[0]: entry for entry in db_session.query(NotificationOutbox)}
+
+    def test_failed_emails_are_retried_with_backoff(self, db_session, high_dbs, outcomes):
+        results, attempted = outcomes
+        results['outbox_1'] = (FAILED, 'timed out')
+        assert notify_db_owners_manager(db_session) == ['outbox_manager@company.com']
+        entries = self.entries(db_session)
+        assert [entries[f"outbox_{i}"].status for i in range(3)] == ['sent', 'pending', 'sent']
+        failed = entries['outbox_1']
+        assert (failed.attempts, failed.last_error) == (1, 'timed out')
+        assert failed.next_attempt_at > datetime.now()
+        #not due until the backoff is over
+        assert deliver_due_notifications(db_session) == 0
+        self.make_due(db_session)
+        results.clear()
+        assert deliver_due_notifications(db_session) == 1
+        failed = self.entries(db_session)['outbox_1']
+        assert (failed.status, failed.attempts) == ('sent', 2)
+        assert attempted == ['outbox_0', 'outbox_1', 'outbox_2', 'outbox_1']
+        ledger = db_session.query(NotificationLedger).join(DBInfo, DBInfo.id == NotificationLedger.db_id).filter(DBInfo.db_name == 'outbox_1').one()
+        assert (ledger.status, ledger.attempts) == (NotificationLedger.SENT, 2)
+
+    def test_gives_up_after_max_attempts(self, db_session, high_dbs, outcomes, monkeypatch):
+        results, attempted = outcomes
+        monkeypatch.setattr(crud, 'OUTBOX_MAX_ATTEMPTS', 2)
+        results['outbox_0'] = (FAILED, 'timed out')
+        results['outbox_2'] = (REJECTED, 'mailbox unavailable')
+        db_session.query(NotificationOutbox).delete()
+        db_session.commit()
+        assert len(notify_db_owners_manager(db_session)) == 2
+        entries = self.entries(db_session)
+        #a refused email is not retried
+        assert (entries['outbox_2'].status, entries['outbox_2'].attempts) == ('dead', 1)
+        assert entries['outbox_0'].status == 'pending'
+        self.make_due(db_session)
+        assert deliver_due_notifications(db_session) == 1
+        assert self.entries(db_session)['outbox_0'].status == 'dead'
+        self.make_due(db_session)
+        assert deliver_due_notifications(db_session) == 0
+
+    def test_deferred_emails_are_not_queued_twice(self, db_session, high_dbs, outcomes):
+        results, attempted = outcomes
+        db_session.query(NotificationOutbox).delete()
+        db_session.commit()
+        results['outbox_0'] = (DEFERRED, 60)
+        assert notify_db_owners_manager(db_session) == []
+        deferred = self.entries(db_session)['outbox_0']
+        assert (deferred.status, deferred.attempts) == ('pending', 0)
+        assert deferred.next_attempt_at > datetime.now()
+        #a new run asks for the queued email again instead of adding another one
+        results.clear()
+        assert notify_db_owners_manager(db_session) == []
+        db_session.expire_all()
+        #outbox_1 and outbox_2 were sent, so they get new emails
+        assert db_session.query(NotificationOutbox).count() == 5
+        assert [entry.status for entry in db_session.query(NotificationOutbox).filter(NotificationOutbox.db_names.any('outbox_0'))] == ['sent']
+
+    def test_claimed_entries_are_held(self, db_session, high_dbs, outcomes):
+        db_session.query(NotificationOutbox).delete()
+        db_session.commit()
+        queued = enqueue_notifications(db_session, 'held', digest=True)
+        assert queued == 1
+        claimed = claim_outbox_entries(db_session, run_id='held')
+        assert [entry.db_names for entry in claimed] == [['outbox_0', 'outbox_1', 'outbox_2']]
+        #held by the claim until its lease runs out
+        assert claim_outbox_entries(db_session) == []
+        assert enqueue_notifications(db_session, 'again', digest=True) == 0
+        assert self.entries(db_session)['outbox_0'].status == NotificationOutbox.SENDING
+
+    def test_concurrent_enqueues_wait_for_each_other(self, db_session, high_dbs):
+        #another process queueing notifications holds the lock until it commits
+        with engine.connect() as other, other.begin():
+            other.execute(select(func.pg_advisory_xact_lock(crud.NOTIFICATION_ENQUEUE_LOCK_ID)))
+            db_session.execute(text("SET LOCAL lock_timeout = '100ms'"))
+            with pytest.raises(OperationalError):
+                enqueue_notifications(db_session, 'blocked')
+            db_session.rollback()
+
+    def test_lease_is_renewed_between_chunks(self, db_session, high_dbs, monkeypatch):
+        db_session.query(NotificationOutbox).delete()
+        db_session.commit()
+        monkeypatch.setattr(crud, 'OUTBOX_SEND_CHUNK', 1)
+        assert enqueue_notifications(db_session, 'chunks') == 3
+        attempted = []
+        leases = []
+
+        def fake_deliver_notifications(notifications, breaker=None, limiter=None, executor=None):
+            attempted.extend(databases[0][0] for _, databases, _ in notifications)
+            leases.append(db_session.query(func.max(NotificationOutbox.next_attempt_at)).filter(NotificationOutbox.status == NotificationOutbox.SENDING).scalar())
+            if len(attempted) == 1:
+                #renewals from now on hold the rows longer, so they can be told apart from the claim
+                monkeypatch.setattr(crud, 'OUTBOX_LEASE', crud.OUTBOX_LEASE + 3600)
+                #another delivery claims outbox_2 again, as if its lease had run out
+                db_session.query(NotificationOutbox).filter(NotificationOutbox.db_names.any('outbox_2')).update({'next_attempt_at': datetime(2000, 1, 1)}, synchronize_session=False)
+                db_session.commit()
+            return [(SENT, None)] * len(notifications)
+
+        monkeypatch.setattr(crud, 'deliver_notifications', fake_deliver_notifications)
+        assert deliver_due_notifications(db_session, run_id='chunks') == 3
+        assert attempted == ['outbox_0', 'outbox_1']
+        assert (leases[1] - leases[0]).total_seconds() == pytest.approx(3600, abs=60)
+        entries = self.entries(db_session)
+        assert [entries[f"outbox_{i}"].status for i in range(3)] == ['sent', 'sent', 'sending']
+
+    def test_outcomes_of_entries_claimed_again_are_dropped(self, db_session, high_dbs, monkeypatch):
+        db_session.query(NotificationOutbox).delete()
+        db_session.commit()
+        assert enqueue_notifications(db_session, 'lost') == 3
+        retaken = datetime(2100, 1, 1)
+
+        def slow_deliver_notifications(notifications, breaker=None, limiter=None, executor=None):
+            #the lease of outbox_1 runs out during the send and another delivery claims it
+            db_session.query(NotificationOutbox).filter(NotificationOutbox.db_names.any('outbox_1')).update({'next_attempt_at': retaken}, synchronize_session=False)
+            db_session.commit()
+            return [(FAILED, 'timed out')] * len(notifications)
+
+        monkeypatch.setattr(crud, 'deliver_notifications', slow_deliver_notifications)
+        assert deliver_due_notifications(db_session, run_id='lost') == 3
+        entries = self.entries(db_session)
+        assert (entries['outbox_0'].status, entries['outbox_0'].attempts) == ('pending', 1)
+        #left as the other delivery holds it
+        assert (entries['outbox_1'].status, entries['outbox_1'].attempts, entries['outbox_1'].next_attempt_at) == ('sending', 0, retaken)
+        ledger = db_session.query(NotificationLedger).join(DBInfo, DBInfo.id == NotificationLedger.db_id).filter(DBInfo.db_name == 'outbox_1')
+        assert ledger.count() == 0
+
+class TestUpsert:
+
+    def test_upsert_employees(self, db_session):
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+1,9000,True,9000,upsert0@company.com
+2,9001,True,9000,upsert1@company.com
+3,9002,True,9001,upsert2@company.com
+"""
+        assert create_multiple_employees_from_raw(db_session, raw_csv)['success']
+        #a plain re-upload fails on the existing user_id
+        assert not create_multiple_employees_from_raw(db_session, raw_csv)['success']
+        changed_csv = raw_csv.replace('3,9002,True,9001,upsert2', '3,9002,False,9001,upsert2') + '4,9003,True,9002,upsert3@company.com\n'
+        result = create_multiple_employees_from_stream(db_session, [changed_csv], batch_size=2, upsert=True)
+        assert result['success']
+        assert result['report']['writer'] == 'upsert'
+        assert (result['inserted'], result['updated'], result['unchanged']) == (1, 1, 2)
+        assert result['total'] == 4
+        db_session.expire_all()
+        assert db_session.query(Employee).filter_by(user_id=9002).first().user_state is False
+        assert db_session.query(Employee).filter_by(user_id=9003).first().user_manager == 9002
+
+    def test_upsert_db_info(self, db_session):
+        raw_json = json.dumps([
+            {'db_name': 'upsert_a', 'owner_id': 9000, 'classification': 1},
+            {'db_name': 'upsert_b', 'owner_id': 9001, 'classification': 2},
+        ])
+        result = create_multiple_db_info_from_raw(db_session, raw_json, upsert=True)
+        assert (result['inserted'], result['updated'], result['unchanged']) == (2, 0, 0)
+        #a plain re-upload leaves out the databases already loaded
+        result = create_multiple_db_info_from_raw(db_session, raw_json)
+        assert result['success']
+        assert result['total'] == 0
+        assert [rejected['reason'] for rejected in result['invalid_entries']] == ['db_name upsert_a already exists for owner_id 9000', 'db_name upsert_b already exists for owner_id 9001']
+        raw_json = json.dumps([
+            {'db_name': 'upsert_a', 'owner_id': 9000, 'classification': 1},
+            {'db_name': 'upsert_b', 'owner_id': 9001, 'classification': 1},
+            {'db_name': 'upsert_b', 'owner_id': 9002, 'classification': 2},
+            {'db_name': 'upsert_b', 'owner_id': 9002, 'classification': 3},
+            {'db_name': 'upsert_c', 'owner_id': 999999, 'classification': 3},
+        ])
+        result = create_multiple_db_info_from_raw(db_session, raw_json, upsert=True)
+        assert result['success']
+        #upsert_b of 9002 is a new database, written once with its last values, the orphan is rejected
+        assert (result['inserted'], result['updated'], result['unchanged']) == (1, 1, 1)
+        assert len(result['invalid_entries']) == 1
+        db_session.expire_all()
+        upsert_b = db_session.query(DBInfo).filter_by(db_name='upsert_b').order_by(DBInfo.owner_id).all()
+        assert [(db.owner_id, db.classification) for db in upsert_b] == [(9001, 1), (9002, 3)]
+
+    @pytest.mark.parametrize('batch_size, method', [(None, 'copy'), (2, 'copy'), (2, 'insert'), (2, 'orm')])
+    def test_same_name_for_several_owners(self, db_session, batch_size, method):
+        prefix = f"shared_{batch_size}_{method}"
+        raw_json = json.dumps([
+            {'db_name': f"{prefix}_prod", 'owner_id': 9000, 'classification': 1},
+            {'db_name': f"{prefix}_prod", 'owner_id': 9001, 'classification': 2},
+            {'db_name': f"{prefix}_other", 'owner_id': 9000, 'classification': 3},
+        ])
+        result = create_multiple_db_info_from_stream(db_session, [raw_json], batch_size=batch_size, writer=crud.BULK_WRITERS[method](DBInfo))
+        assert (result['success'], result['total'], result['invalid_entries']) == (True, 3, [])
+        #only the pairs already loaded, or repeated in the upload, are left out
+        raw_json = json.dumps([
+            {'db_name': f"{prefix}_prod", 'owner_id': 9001, 'classification': 1},
+            {'db_name': f"{prefix}_prod", 'owner_id': 9002, 'classification': 1},
+            {'db_name': f"{prefix}_new", 'owner_id': 9002, 'classification': 1},
+            {'db_name': f"{prefix}_new", 'owner_id': 9002, 'classification': 2},
+        ])
+        result = create_multiple_db_info_from_stream(db_session, [raw_json], batch_size=batch_size, writer=crud.BULK_WRITERS[method](DBInfo))
+        assert (result['success'], result['total'], result['invalid_total']) == (True, 2, 2)
+        assert result['invalid_entries'] == [
+            {'entry': {'db_name': f"{prefix}_prod", 'owner_id': 9001, 'classification': 1}, 'reason': f"db_name {prefix}_prod already exists for owner_id 9001"},
+            {'entry': {'db_name': f"{prefix}_new", 'owner_id': 9002, 'classification': 2}, 'reason': f"db_name {prefix}_new already exists for owner_id 9002"},
+        ]
+        db_session.expire_all()
+        owners = db_session.query(DBInfo.owner_id, DBInfo.classification).filter_by(db_name=f"{prefix}_prod").order_by(DBInfo.owner_id).all()
+        assert [tuple(row) for row in owners] == [(9000, 1), (9001, 2), (9002, 1)]
+
+    def test_integrity_error_constraint(self):
+        #psycopg2 errors carry it in diag, asyncpg ones come wrapped by sqlalchemy's adapter
+        psycopg2_error = type('UniqueViolation', (Exception,), {'diag': type('Diagnostics', (), {'constraint_name': 'ux_db_info_db_name_owner_id'})()})()
+        assert integrity_error_constraint(IntegrityError('INSERT', None, psycopg2_error)) == 'ux_db_info_db_name_owner_id'
+        asyncpg_error = Exception('wrapped')
+        asyncpg_error.__cause__ = type('UniqueViolationError', (Exception,), {'constraint_name': 'employee_user_id_key'})()
+        assert integrity_error_constraint(IntegrityError('INSERT', None, asyncpg_error)) == 'employee_user_id_key'
+        assert integrity_error_constraint(IntegrityError('INSERT', None, Exception('ux_db_info_db_name_owner_id'))) is None
+
+    def test_upsert_of_empty_upload(self, db_session):
+        result = create_multiple_db_info_from_raw(db_session, '[]', upsert=True)
+        assert (result['inserted'], result['updated'], result['unchanged']) == (0, 0, 0)
+
+class TestEmployeeClosure:
+
+    @pytest.fixture(scope='class')
+    def tree(self, db_session):
+        #9100 tops the tree, 9101 and 9102 report to it, 9103 to 9101 and 9104 to 9103
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+1,9100,True,9100,tree0@company.com
+2,9101,True,9100,tree1@company.com
+3,9102,True,9100,tree2@company.com
+4,9103,True,9101,tree3@company.com
+5,9104,True,9103,tree4@company.com
+"""
+        assert create_multiple_employees_from_raw(db_session, raw_csv)['success']
+        raw_json = json.dumps([
+            {'db_name': 'tree_a', 'owner_id': 9100, 'classification': 3},
+            {'db_name': 'tree_b', 'owner_id': 9103, 'classification': 3},
+            {'db_name': 'tree_c', 'owner_id': 9104, 'classification': 0},
+            {'db_name': 'tree_d', 'owner_id': 9102, 'classification': 3},
+            {'db_name': 'tree_e', 'owner_id': 9104, 'classification': 3},
+        ])
+        assert create_multiple_db_info_from_raw(db_session, raw_json)['success']
+
+    def closure(self, db_session, ancestor_id):
+        rows = db_session.query(EmployeeClosure).filter_by(ancestor_id=ancestor_id)
+        return {(row.descendant_id, row.depth) for row in rows}
+
+    def test_closure_is_rebuilt_on_upload(self, db_session, tree):
+        assert self.closure(db_session, 9100) == {(9100, 0), (9101, 1), (9102, 1), (9103, 2), (9104, 3)}
+        assert self.closure(db_session, 9103) == {(9103, 0), (9104, 1)}
+        assert self.closure(db_session, 9104) == {(9104, 0)}
+
+    def test_subtree_db_rows(self, db_session, tree):
+        names = lambda rows: [row.db_name for row in rows]
+        assert names(get_subtree_db_rows(db_session, 9100, DBClass.HIGH)) == ['tree_a', 'tree_b', 'tree_d', 'tree_e']
+        assert names(get_subtree_db_rows(db_session, 9101, DBClass.HIGH)) == ['tree_b', 'tree_e']
+        assert names(get_subtree_db_rows(db_session, 9101, DBClass.UNCLASSIFIED)) == ['tree_c']
+        first_page = get_subtree_db_rows(db_session, 9100, DBClass.HIGH, limit=2)
+        assert names(get_subtree_db_rows(db_session, 9100, DBClass.HIGH, after=first_page[-1].id)) == ['tree_d', 'tree_e']
+
+    def test_escalation_chain(self, db_session, tree):
+        chain = get_escalation_chain(db_session, 9104)
+        assert [(row.depth, row.user_id, row.user_mail) for row in chain] == [
+            (1, 9103, 'tree3@company.com'), (2, 9101, 'tree1@company.com'), (3, 9100, 'tree0@company.com')]
+        assert [row.user_id for row in get_escalation_chain(db_session, 9104, levels=2)] == [9103, 9101]
+        #the top of the tree manages itself and has nobody above
+        assert get_escalation_chain(db_session, 9100) == []
+
+    def test_upsert_moves_subtree(self, db_session, tree):
+        #9101 (with 9103 and 9104 below) now reports to 9102
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+2,9101,True,9102,tree1@company.com
+"""
+        assert create_multiple_employees_from_raw(db_session, raw_csv, upsert=True)['success']
+        assert self.closure(db_session, 9102) == {(9102, 0), (9101, 1), (9103, 2), (9104, 3)}
+        assert [row.user_id for row in get_escalation_chain(db_session, 9104)] == [9103, 9101, 9102, 9100]
+
+    def test_refresh_only_rewrites_changed_subtrees(self, db_session, tree):
+        versions = lambda: dict(db_session.execute(text("SELECT (ancestor_id, descendant_id)::text, xmin::text FROM employee_closure WHERE descendant_id BETWEEN 9100 AND 9199")).all())
+        before = versions()
+        #a new employee under 9103 and 9104 uploaded again as it was
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+5,9104,True,9103,tree4@company.com
+6,9105,True,9103,tree5@company.com
+"""
+        assert create_multiple_employees_from_raw(db_session, raw_csv, upsert=True)['success']
+        after = versions()
+        assert {key for key in after if after[key] != before.get(key)} == {f"({ancestor},9105)" for ancestor in (9100, 9101, 9102, 9103, 9105)}
+        #the same closure a full rebuild gives
+        closure = set(db_session.execute(text("SELECT ancestor_id, descendant_id, depth FROM employee_closure")).all())
+        rebuild_employee_closure(db_session)
+        assert set(db_session.execute(text("SELECT ancestor_id, descendant_id, depth FROM employee_closure")).all()) == closure
+
+    def test_cycle_does_not_loop(self, db_session):
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+1,9200,True,9201,cycle0@company.com
+2,9201,True,9200,cycle1@company.com
+"""
+        assert create_multiple_employees_from_raw(db_session, raw_csv)['success']
+        assert self.closure(db_session, 9200) == {(9200, 0), (9201, 1)}
+        assert [row.user_id for row in get_escalation_chain(db_session, 9200)] == [9201]
+
+class TestInventoryExport:
+
+    @pytest.fixture(scope='class')
+    def inventory(self, db_session):
+        #9500 manages itself, 9501 reports to it
+        assert create_multiple_employees_from_raw(db_session, """row_id,user_id,user_state,user_manager,user_mail
+1,9500,True,9500,export_boss@company.com
+2,9501,True,9500,export_owner@company.com
+""")['success']
+        raw_json = json.dumps([
+            {'db_name': 'export_a', 'owner_id': 9501, 'classification': 3},
+            {'db_name': 'export_b', 'owner_id': 9500, 'classification': 0},
+            {'db_name': 'export_c', 'owner_id': 9501, 'classification': 2},
+        ])
+        assert create_multiple_db_info_from_raw(db_session, raw_json)['success']
+
+    def test_export_rows(self, db_session, inventory):
+        rows = [dict(zip(EXPORT_COLUMNS, row)) for row in get_inventory_export_rows(db_session, yield_per=2) if row[1].startswith('export_')]
+        assert [(row['db_name'], row['classification'], row['owner_mail'], row['manager_mail']) for row in rows] == [
+            ('export_a', 'HIGH', 'export_owner@company.com', 'export_boss@company.com'),
+            ('export_b', 'UNCLASSIFIED', 'export_boss@company.com', 'export_boss@company.com'),
+            ('export_c', 'MEDIUM', 'export_owner@company.com', 'export_boss@company.com'),
+        ]
+        assert [row['id'] for row in rows] == sorted(row['id'] for row in rows)
+
+    def test_export_rows_by_classification(self, db_session, inventory):
+        rows = get_inventory_export_rows(db_session, [DBClass.HIGH, DBClass.MEDIUM])
+        assert [row[1] for row in rows if row[1].startswith('export_')] == ['export_a', 'export_c']
+
+class TestDBInfoSummary:
+
+    @pytest.fixture(scope='class')
+    def inventory(self, db_session):
+        assert create_multiple_employees_from_raw(db_session, """row_id,user_id,user_state,user_manager,user_mail
+1,9600,True,9600,stats_boss@company.com
+2,9601,True,9600,stats_manager@company.com
+3,9602,True,9601,stats_owner_a@company.com
+4,9603,True,9601,stats_owner_b@company.com
+""")['success']
+        raw_json = json.dumps(
+            [{'db_name': f"stats_high_{i}", 'owner_id': 9602 + i % 2, 'classification': 3} for i in range(6)]
+            + [{'db_name': f"stats_low_{i}", 'owner_id': 9602, 'classification': 1} for i in range(3)]
+        )
+        assert create_multiple_db_info_from_stream(db_session, [raw_json], batch_size=4)['success']
+
+    def test_counts_follow_uploads(self, db_session, inventory):
+        assert get_db_info_stats(db_session, DBInfoSummary.OWNER, 9602) == {'UNCLASSIFIED': 0, 'LOW': 3, 'MEDIUM': 0, 'HIGH': 3}
+        assert get_db_info_stats(db_session, DBInfoSummary.MANAGER, 9601) == {'UNCLASSIFIED': 0, 'LOW': 3, 'MEDIUM': 0, 'HIGH': 6}
+        assert get_db_info_stats(db_session, DBInfoSummary.MANAGER, 9600) == {'UNCLASSIFIED': 0, 'LOW': 0, 'MEDIUM': 0, 'HIGH': 0}
+        assert get_db_info_stats(db_session)['HIGH'] >= 6
+        assert check_db_info_summary(db_session) == []
+
+    def test_counts_follow_upserts_and_moves(self, db_session, inventory):
+        raw_json = json.dumps([
+            {'db_name': 'stats_high_0', 'owner_id': 9602, 'classification': 2},
+            {'db_name': 'stats_high_1', 'owner_id': 9602, 'classification': 3},
+            {'db_name': 'stats_new', 'owner_id': 9603, 'classification': 0},
+        ])
+        result = create_multiple_db_info_from_raw(db_session, raw_json, upsert=True)
+        #stats_high_1 of 9602 is a new database, 9603 keeps its own
+        assert (result['inserted'], result['updated']) == (2, 1)
+        assert get_db_info_stats(db_session, DBInfoSummary.OWNER, 9602) == {'UNCLASSIFIED': 0, 'LOW': 3, 'MEDIUM': 1, 'HIGH': 3}
+        assert get_db_info_stats(db_session, DBInfoSummary.OWNER, 9603) == {'UNCLASSIFIED': 1, 'LOW': 0, 'MEDIUM': 0, 'HIGH': 3}
+        #9603 now reports to the boss and takes their counts along
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+4,9603,True,9600,stats_owner_b@company.com
+"""
+        assert create_multiple_employees_from_raw(db_session, raw_csv, upsert=True)['success']
+        assert get_db_info_stats(db_session, DBInfoSummary.MANAGER, 9600) == {'UNCLASSIFIED': 1, 'LOW': 0, 'MEDIUM': 0, 'HIGH': 3}
+        assert get_db_info_stats(db_session, DBInfoSummary.MANAGER, 9601) == {'UNCLASSIFIED': 0, 'LOW': 3, 'MEDIUM': 1, 'HIGH': 3}
+        assert check_db_info_summary(db_session) == []
+
+    def test_check_and_rebuild(self, db_session, inventory):
+        db_session.query(DBInfoSummary).filter_by(scope=DBInfoSummary.OWNER, key=9602).delete()
+        db_session.commit()
+        assert {(row.scope, row.key, row.stored) for row in check_db_info_summary(db_session)} == {('owner', 9602, 0)}
+        assert rebuild_db_info_summary(db_session) > 0
+        assert check_db_info_summary(db_session) == []
+        assert get_db_info_stats(db_session, DBInfoSummary.OWNER, 9602)['LOW'] == 3
+
+class TestShardedParsing:
+
+    @pytest.fixture(autouse=True)
+    def sharded(self, monkeypatch):
+        monkeypatch.setattr(crud, 'PARSE_SHARD_MIN_SIZE', 0)
+        monkeypatch.setattr(crud, 'MAX_PARSE_WORKERS', 2)
+
+    def test_employee_rows_sharded(self):
+        raw_csv = generate_employees_csv(300, 9400, 4, 0)
+        assert parse_employees_sharded(raw_csv, 2) == employee_rows_from_csv(raw_csv)
+        #lines end at '\n' only, like the serial path
+        raw_csv = 'row_id,user_id,user_state,user_manager,user_mail\n' + ''.join(f"{i},{9500 + i},True,9500,\"a\x0bb\u2028{i}@company.com\"\n" for i in range(20))
+        assert parse_employees_sharded(raw_csv, 2) == employee_rows_from_csv(raw_csv)
+
+    def test_db_info_rows_sharded(self, db_session):
+        assert create_multiple_employees_from_raw(db_session, generate_employees_csv(300, 9400, 4, 0))['success']
+        raw_json = generate_db_info_json(1000, 300, 9400, 0.1, 0.2, 0)
+        owners = OwnerIndex.load(db_session)
+        serial, sharded = RejectedEntries(), RejectedEntries()
+        #the same rows and rejected entries, in the same order
+        assert parse_db_info_sharded(raw_json, owners, sharded, 2) == db_info_rows_from_json(raw_json, owners, serial)
+        assert sharded.entries == serial.entries
+        assert sharded.total > 0
+        result = create_multiple_db_info_from_raw(db_session, raw_json, workers=2)
+        assert result['success']
+        assert (result['total'], len(result['invalid_entries'])) == (len(result['valid_entries']), sharded.total)
+
+    def test_db_info_sharded_falls_back_to_serial(self):
+        owners = OwnerIndex([1])
+        rejected = RejectedEntries()
+        #the only boundary lookalikes are inside a string
+        raw_json = json.dumps([{'db_name': '},{' * 50, 'owner_id': 1, 'classification': 3}])
+        assert parse_db_info_sharded(raw_json, owners, rejected, 2) is None
+        assert rejected.total == 0
+        assert len(db_info_rows_from_json(raw_json, owners, rejected, workers=2)) == 1
+        with pytest.raises(ValueError):
+            db_info_rows_from_json('[{"db_name": "a"}, {"db_name": ]', owners, rejected, workers=2)
@@ -0,0 +1,139 @@
+import json
+import asyncio
+import pytest
+from sqlalchemy import select
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine
+from models.employee import Employee
+from models.db_info import DBInfo, DBClass
+from database import Base, engine, AsyncSession, ASYNC_DATABASE_URL
+from crud import create_multiple_employees_from_stream_async, create_multiple_db_info_from_stream_async, get_unclassified_db_rows_async, stream_unclassified_db_rows, get_bulk_writer, get_subtree_db_rows_async, get_escalation_chain_async, employee_in_closure_async
+from crud import stream_inventory_export, export_row
+
+#Runs `test(session)` with an async session whose changes are rolled back at the end
+def run_in_transaction(test):
+    async def run():
+        async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=NullPool)
+        try:
+            async with async_engine.connect() as connection:
+                transaction = await connection.begin()
+                session = AsyncSession(bind=connection, join_transaction_mode='create_savepoint')
+                try:
+                    return await test(session)
+                finally:
+                    await session.close()
+                    await transaction.rollback()
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(run())
+
+async def chunks_of(text, size):
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+@pytest.fixture(scope='module', autouse=True)
+def tables():
+    Base.metadata.create_all(engine)
+
+EMPLOYEES_CSV = """row_id,user_id,user_state,user_manager,user_mail
+1,7000,True,7000,async_boss@company.com
+2,7001,False,7000,async_a@company.com
+3,7002,True,7001,async_b@company.com
+"""
+
+
+class TestCrudAsync:
+
+    @pytest.mark.parametrize('method', ['copy', 'insert', 'orm'])
+    def test_create_employees_and_db_info_async(self, method):
+        async def test(db):
+            result = await create_multiple_employees_from_stream_async(db, chunks_of(EMPLOYEES_CSV, 9), batch_size=2, writer=get_bulk_writer(db, Employee, method))
+            assert result['success']
+            assert result['batches'] == [2, 1]
+            assert result['report']['writer'] == method
+            employee = (await db.execute(select(Employee).filter_by(user_id=7002))).scalar_one()
+            assert employee.user_mail == 'async_b@company.com'
+            assert employee.created_at is not None
+            raw_json = json.dumps([
+                {'db_name': 'async_high', 'owner_id': 7002, 'classification': 3},
+                {'db_name': 'async_orphan', 'owner_id': 999999, 'classification': 3},
+                {'db_name': 'async_unclassified', 'owner_id': 7001, 'classification': 0},
+                {'db_name': None, 'owner_id': 7001, 'classification': 0},
+            ])
+            result = await create_multiple_db_info_from_stream_async(db, chunks_of(raw_json, 13), batch_size=None, max_invalid=None, writer=get_bulk_writer(db, DBInfo, method))
+            assert result['success']
+            assert result['total'] == 2
+            assert result['batches'] == [2]
+            assert [rejected['reason'] for rejected in result['invalid_entries']] == ['owner_id 999999 does not exist', 'db_name is null']
+            stored = (await db.execute(select(DBInfo.db_name).where(DBInfo.owner_id.in_([7001, 7002])).order_by(DBInfo.id))).scalars().all()
+            assert stored == ['async_high', 'async_unclassified']
+        run_in_transaction(test)
+
+    def test_failed_batch_keeps_previous_batches_async(self):
+        async def test(db):
+            raw_csv = EMPLOYEES_CSV + '4,7001,True,7000,duplicated@company.com\n'
+            result = await create_multiple_employees_from_stream_async(db, chunks_of(raw_csv, 50), batch_size=2)
+            assert not result['success']
+            assert result['total'] == 2
+            assert 'user_id' in result['error']
+            user_ids = (await db.execute(select(Employee.user_id).where(Employee.user_id >= 7000).order_by(Employee.user_id))).scalars().all()
+            assert user_ids == [7000, 7001]
+        run_in_transaction(test)
+
+    def test_get_unclassified_db_rows_async(self):
+        async def test(db):
+            await create_multiple_employees_from_stream_async(db, chunks_of(EMPLOYEES_CSV, 50))
+            raw_json = json.dumps([{'db_name': f"async_page_{i}", 'owner_id': 7000, 'classification': i % 2} for i in range(6)])
+            await create_multiple_db_info_from_stream_async(db, chunks_of(raw_json, 50))
+            rows = await get_unclassified_db_rows_async(db)
+            mine = [row for row in rows if row.owner_id == 7000]
+            assert [row.db_name for row in mine] == ['async_page_0', 'async_page_2', 'async_page_4']
+            page = await get_unclassified_db_rows_async(db, after=mine[0].id, limit=1)
+            assert [row.db_name for row in page] == ['async_page_2']
+            streamed = await stream_unclassified_db_rows(db, after=mine[0].id)
+            assert [row.db_name async for row in streamed if row.owner_id == 7000] == ['async_page_2', 'async_page_4']
+        run_in_transaction(test)
+
+    def test_upsert_async(self):
+        async def test(db):
+            await create_multiple_employees_from_stream_async(db, chunks_of(EMPLOYEES_CSV, 50))
+            changed_csv = EMPLOYEES_CSV.replace('async_b@', 'async_b2@')
+            result = await create_multiple_employees_from_stream_async(db, chunks_of(changed_csv, 50), batch_size=2, upsert=True)
+            assert result['success']
+            assert (result['inserted'], result['updated'], result['unchanged']) == (0, 1, 2)
+            raw_json = json.dumps([{'db_name': 'async_upsert', 'owner_id': 7000, 'classification': 3}])
+            result = await create_multiple_db_info_from_stream_async(db, chunks_of(raw_json, 50), upsert=True)
+            assert (result['inserted'], result['updated'], result['unchanged']) == (1, 0, 0)
+            result = await create_multiple_db_info_from_stream_async(db, chunks_of(raw_json.replace('"classification": 3', '"classification": 2'), 50), upsert=True)
+            assert (result['inserted'], result['updated'], result['unchanged']) == (0, 1, 0)
+            #without upsert the database already loaded is left out
+            result = await create_multiple_db_info_from_stream_async(db, chunks_of(raw_json, 50))
+            assert (result['success'], result['total']) == (True, 0)
+            assert [rejected['reason'] for rejected in result['invalid_entries']] == ['db_name async_upsert already exists for owner_id 7000']
+        run_in_transaction(test)
+
+    def test_employee_closure_async(self):
+        async def test(db):
+            await create_multiple_employees_from_stream_async(db, chunks_of(EMPLOYEES_CSV, 50))
+            raw_json = json.dumps([{'db_name': 'async_subtree', 'owner_id': 7002, 'classification': 3}])
+            await create_multiple_db_info_from_stream_async(db, chunks_of(raw_json, 50))
+            assert [row.db_name for row in await get_subtree_db_rows_async(db, 7000, DBClass.HIGH)] == ['async_subtree']
+            assert [row.user_id for row in await get_escalation_chain_async(db, 7002)] == [7001, 7000]
+            assert await employee_in_closure_async(db, 7002)
+            assert not await employee_in_closure_async(db, 7999)
+        run_in_transaction(test)
+
+    def test_stream_inventory_export_async(self):
+        async def test(db):
+            await create_multiple_employees_from_stream_async(db, chunks_of(EMPLOYEES_CSV, 50))
+            raw_json = json.dumps([{'db_name': f"async_export_{i}", 'owner_id': 7001 + i % 2, 'classification': i % 4} for i in range(5)])
+            await create_multiple_db_info_from_stream_async(db, chunks_of(raw_json, 50))
+            result = await stream_inventory_export(db, [DBClass.HIGH, DBClass.UNCLASSIFIED], yield_per=2)
+            rows = [export_row(row) async for partition in result.partitions() for row in partition]
+            rows = [row for row in rows if row[1].startswith('async_export_')]
+            assert [(row[1], row[2], row[6]) for row in rows] == [
+                ('async_export_0', 'UNCLASSIFIED', 'async_boss@company.com'),
+                ('async_export_3', 'HIGH', 'async_a@company.com'),
+                ('async_export_4', 'UNCLASSIFIED', 'async_boss@company.com'),
+            ]
+        run_in_transaction(test)
@@ -0,0 +1,58 @@
+import threading
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from database import DATABASE_URL, InstrumentedQueuePool, engine_options, pool_stats
+
+
+class TestPoolStats:
+
+    def test_engine_options(self):
+        assert engine_options()['poolclass'] is InstrumentedQueuePool
+        options = engine_options(is_async=True, pool_size=2)
+        assert options['poolclass'].__name__ == 'InstrumentedAsyncQueuePool'
+        assert options['pool_size'] == 2
+
+    def test_checkouts_and_waits_are_counted(self):
+        engine = create_engine(DATABASE_URL, **engine_options(pool_size=1, max_overflow=1))
+        try:
+            with engine.connect() as first, engine.connect() as second:
+                stats = engine.pool.stats()
+                assert stats['checked_out'] == 2
+                assert stats['overflow'] == 1
+            stats = engine.pool.stats()
+            assert stats['checked_out'] == 0
+            assert stats['idle'] == 1
+            assert stats['checkouts'] == 2
+            assert stats['timeouts'] == 0
+            assert stats['wait_seconds_max'] >= stats['wait_seconds_avg'] > 0
+        finally:
+            engine.dispose()
+
+    def test_exhausted_pool_counts_timeouts(self):
+        engine = create_engine(DATABASE_URL, **engine_options(pool_size=1, max_overflow=0, pool_timeout=0.1))
+        try:
+            with engine.connect():
+                with pytest.raises(PoolTimeoutError):
+                    engine.connect()
+            stats = engine.pool.stats()
+            assert stats['timeouts'] == 1
+            assert stats['wait_seconds_max'] >= 0.1
+        finally:
+            engine.dispose()
+
+    def test_waiting_checkout_gets_returned_connection(self):
+        engine = create_engine(DATABASE_URL, **engine_options(pool_size=1, max_overflow=0, pool_timeout=5))
+        try:
+            holder = engine.connect()
+            threading.Timer(0.2, holder.close).start()
+            with engine.connect() as connection:
+                assert connection.execute(text('SELECT 1')).scalar() == 1
+            assert engine.pool.stats()['wait_seconds_max'] >= 0.2
+        finally:
+            engine.dispose()
+
+    def test_pool_stats_covers_both_engines(self):
+        stats = pool_stats()
+        assert set(stats) == {'sync', 'async'}
+        assert {'size', 'checked_out', 'overflow', 'wait_seconds_avg'} <= set(stats['sync'])
@@ -0,0 +1,169 @@
+import threading
+import pytest
+import jobs
+from jobs import NotificationJobs, OutboxWorker
+from notifier import SENT, FAILED, DEFERRED
+
+
+class FakeSession:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture()
+def notifications(monkeypatch):
+    release = threading.Event()
+    sessions = []
+    calls = []
+
+    def fake_notify(db, on_result=None, mode='all', digest=False):
+        calls.append((db, mode))
+        release.wait(5)
+        if digest:
+            on_result(([('db_1', 'owner1@company.com'), ('db_2', 'owner1@company.com')], 'manager1@company.com'), SENT)
+            on_result(([('db_3', 'owner2@company.com')], 'manager2@company.com'), FAILED)
+        else:
+            on_result(('db_1', 'owner1@company.com', 'manager1@company.com'), SENT)
+            on_result(('db_2', 'owner2@company.com', 'manager2@company.com'), FAILED)
+        return ['manager2@company.com']
+
+    monkeypatch.setattr(jobs, 'count_high_classification_dbs', lambda db, mode='all': 3)
+    monkeypatch.setattr(jobs, 'notify_db_owners_manager', fake_notify)
+
+    def session_factory():
+        sessions.append(FakeSession())
+        return sessions[-1]
+
+    registry = NotificationJobs(session_factory)
+    yield registry, release, calls, sessions
+    release.set()
+    registry.shutdown()
+
+
+class TestNotificationJobs:
+
+    def test_job_progress(self, notifications):
+        registry, release, calls, sessions = notifications
+        job, created = registry.submit()
+        assert created
+        assert registry.get(job.id) is job
+        release.set()
+        registry.shutdown()
+        status = job.to_dict()
+        assert status['status'] == 'finished'
+        assert status['total'] == 3
+        assert status['sent'] == 1
+        assert status['failed'] == 1
+        assert status['pending'] == 1
+        assert status['recipients_with_errors'] == ['manager2@company.com']
+        assert sessions[0].closed
+
+    def test_concurrent_submits_share_the_job(self, notifications):
+        registry, release, calls, sessions = notifications
+        first, created = registry.submit()
+        second, created_again = registry.submit()
+        assert created
+        assert not created_again
+        assert first is second
+        release.set()
+        registry.shutdown()
+        assert len(calls) == 1
+
+    def test_new_job_after_finished(self, notifications, monkeypatch):
+        registry, release, calls, sessions = notifications
+        release.set()
+        first, _ = registry.submit()
+        registry._executor.submit(lambda: None).result()
+        second, created = registry.submit()
+        assert created
+        assert first is not second
+
+    def test_failed_job(self, notifications, monkeypatch):
+        registry, release, calls, sessions = notifications
+
+        def broken_count(db, mode='all'):
+            raise RuntimeError('database is down')
+
+        monkeypatch.setattr(jobs, 'count_high_classification_dbs', broken_count)
+        job, _ = registry.submit()
+        registry.shutdown()
+        assert job.status == 'failed'
+        assert 'database is down' in job.error
+        assert sessions[0].closed
+
+    def test_job_mode_is_passed_on(self, notifications):
+        registry, release, calls, sessions = notifications
+        release.set()
+        job, _ = registry.submit(mode='incremental')
+        registry.shutdown()
+        assert job.to_dict()['mode'] == 'incremental'
+        assert calls[0][1] == 'incremental'
+
+    def test_deferred_emails_are_reported(self, notifications, monkeypatch):
+        registry, release, calls, sessions = notifications
+
+        def deferring_notify(db, on_result=None, mode='all', digest=False):
+            on_result(('db_1', 'owner1@company.com', 'manager1@company.com'), DEFERRED)
+            on_result(('db_2', 'owner1@company.com', 'manager1@company.com'), DEFERRED)
+            on_result(('db_3', 'owner2@company.com', 'manager2@company.com'), DEFERRED)
+            #sent once the rate limit let it through
+            on_result(('db_3', 'owner2@company.com', 'manager2@company.com'), SENT)
+            return []
+
+        monkeypatch.setattr(jobs, 'notify_db_owners_manager', deferring_notify)
+        job, _ = registry.submit()
+        registry.shutdown()
+        status = job.to_dict()
+        assert (status['sent'], status['failed'], status['pending'], status['deferred']) == (1, 0, 2, 2)
+        assert status['recipients_deferred'] == ['manager1@company.com']
+        assert status['recipients_with_errors'] == []
+
+    def test_digest_job_counts_databases(self, notifications):
+        registry, release, calls, sessions = notifications
+        release.set()
+        job, _ = registry.submit(digest=True)
+        registry.shutdown()
+        status = job.to_dict()
+        assert status['digest']
+        assert (status['sent'], status['failed'], status['pending']) == (2, 1, 0)
+        assert status['recipients_with_errors'] == ['manager2@company.com']
+
+    def test_unknown_job(self, notifications):
+        registry, *_ = notifications
+        assert registry.get('missing') is None
+
+
+class TestOutboxWorker:
+
+    def test_delivers_until_nothing_is_due(self, monkeypatch):
+        rounds = [3, 1, 0]
+        done = threading.Event()
+        sessions = []
+
+        def fake_deliver(db):
+            if not rounds:
+                done.set()
+                return 0
+            return rounds.pop(0)
+
+        def session_factory():
+            sessions.append(FakeSession())
+            return sessions[-1]
+
+        monkeypatch.setattr(jobs, 'deliver_due_notifications', fake_deliver)
+        worker = OutboxWorker(session_factory, poll_interval=0.01)
+        worker.start()
+        assert done.wait(5)
+        worker.stop()
+        assert not rounds
+        assert all(session.closed for session in sessions)
+
+    def test_errors_dont_stop_the_worker(self, monkeypatch):
+        def broken_deliver(db):
+            raise RuntimeError('database is down')
+
+        monkeypatch.setattr(jobs, 'deliver_due_notifications', broken_deliver)
+        worker = OutboxWorker(FakeSession)
+        assert worker.run_once() == 0
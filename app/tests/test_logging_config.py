@@ -0,0 +1,50 @@
+import logging
+import threading
+from logging.handlers import QueueHandler
+from logging_config import configure_logging, stop_logging
+
+class TestLoggingConfig:
+
+    def test_records_are_written_by_a_background_thread(self, tmp_path):
+        log_file = tmp_path / 'app.log'
+        root = logging.getLogger()
+        previous_level = root.level
+        writer_threads = []
+
+        class RecordingHandler(logging.Handler):
+            def emit(self, record):
+                writer_threads.append(threading.current_thread())
+
+        try:
+            listener = configure_logging('INFO', str(log_file))
+            listener.handlers = listener.handlers + (RecordingHandler(),)
+            assert any(isinstance(handler, QueueHandler) for handler in root.handlers)
+            logger = logging.getLogger('test_logging_config')
+            logger.debug('not written %s', 'debug')
+            logger.info('written %d rows', 42)
+        finally:
+            stop_logging()
+            root.setLevel(previous_level)
+        content = log_file.read_text()
+        assert 'INFO - test_logging_config - written 42 rows' in content
+        assert 'not written' not in content
+        assert writer_threads and threading.current_thread() not in writer_threads
+        assert not any(isinstance(handler, QueueHandler) for handler in root.handlers)
+
+    def test_message_arguments_are_not_formatted_below_the_level(self, tmp_path):
+        root = logging.getLogger()
+        previous_level = root.level
+        formatted = []
+
+        class Expensive:
+            def __str__(self):
+                formatted.append(True)
+                return 'expensive'
+
+        try:
+            configure_logging('WARNING', str(tmp_path / 'app.log'))
+            logging.getLogger('test_logging_config').info('value: %s', Expensive())
+        finally:
+            stop_logging()
+            root.setLevel(previous_level)
+        assert formatted == []
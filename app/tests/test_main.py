@@ -0,0 +1,194 @@
+import io
+import csv
+import json
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, select, text, or_
+from database import Base, engine, Session, async_engine
+from migrate import load_migration
+from models.db_info import DBInfo
+from models.employee import Employee
+from models.employee_closure import EmployeeClosure
+from crud import create_multiple_employees_from_raw, create_multiple_db_info_from_raw, EXPORT_COLUMNS
+import main
+
+BOSS, OWNER_A, OWNER_B, LONER = 8800, 8801, 8802, 8803
+EMPLOYEE_IDS = (BOSS, OWNER_A, OWNER_B, LONER)
+EMPLOYEES_CSV = f"""row_id,user_id,user_state,user_manager,user_mail
+1,{BOSS},True,{BOSS},main_boss@company.com
+2,{OWNER_A},True,{BOSS},main_a@company.com
+3,{OWNER_B},True,{OWNER_A},main_b@company.com
+4,{LONER},True,{LONER},main_loner@company.com
+"""
+DB_INFO = [
+    {'db_name': 'main_unclassified_0', 'owner_id': OWNER_A, 'classification': 0},
+    {'db_name': 'main_unclassified_1', 'owner_id': OWNER_B, 'classification': 0},
+    {'db_name': 'main_unclassified_2', 'owner_id': OWNER_B, 'classification': 0},
+    {'db_name': 'main_high_0', 'owner_id': OWNER_A, 'classification': 3},
+    {'db_name': 'main_high_1', 'owner_id': OWNER_B, 'classification': 3},
+    {'db_name': 'main_low', 'owner_id': OWNER_B, 'classification': 1},
+]
+
+#The endpoints open their own sessions, so the rows are committed and removed once the module is done
+@pytest.fixture(scope='module')
+def client():
+    Base.metadata.create_all(engine)
+    #the summary and version triggers come with the migrations, not with the models
+    with engine.begin() as connection:
+        connection.execute(text(load_migration(6).SUMMARY_TRIGGERS))
+        connection.execute(text(load_migration(9).VERSION_TRIGGERS))
+    with Session() as db:
+        assert create_multiple_employees_from_raw(db, EMPLOYEES_CSV)['success']
+        assert create_multiple_db_info_from_raw(db, json.dumps(DB_INFO))['success']
+    try:
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            monkeypatch.setattr(main, 'OUTBOX_WORKER', False)
+            with TestClient(main.app) as client:
+                yield client
+                #the pooled async connections belong to the client's event loop
+                client.portal.call(async_engine.dispose)
+    finally:
+        with Session() as db:
+            db.execute(delete(DBInfo).where(DBInfo.owner_id.in_(EMPLOYEE_IDS)))
+            db.execute(delete(EmployeeClosure).where(or_(EmployeeClosure.ancestor_id.in_(EMPLOYEE_IDS), EmployeeClosure.descendant_id.in_(EMPLOYEE_IDS))))
+            db.execute(delete(Employee).where(Employee.user_id.in_(EMPLOYEE_IDS)))
+            db.commit()
+
+@pytest.fixture(scope='module')
+def rows(client):
+    with Session() as db:
+        found = db.execute(select(DBInfo.id, DBInfo.db_name, DBInfo.owner_id, DBInfo.classification).where(DBInfo.owner_id.in_(EMPLOYEE_IDS)))
+        return {row.db_name: row._asdict() for row in found}
+
+def unclassified(rows):
+    return [rows[f"main_unclassified_{i}"] for i in range(3)]
+
+
+class TestUnclassifiedEndpoint:
+
+    def test_pages(self, client, rows):
+        expected = unclassified(rows)
+        after = expected[0]['id'] - 1
+        response = client.get('/db_info/unclassified', params={'after': after, 'limit': 2})
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/json'
+        assert response.headers['cache-control'] == 'no-cache'
+        assert response.json() == expected[:2]
+        assert response.headers['x-next-after'] == str(expected[1]['id'])
+        response = client.get('/db_info/unclassified', params={'after': response.headers['x-next-after'], 'limit': 2})
+        assert response.json() == expected[2:]
+        #the last page isn't full
+        assert 'x-next-after' not in response.headers
+
+    def test_without_pagination_returns_everything(self, client, rows):
+        page = client.get('/db_info/unclassified').json()
+        assert all(row in page for row in unclassified(rows))
+        assert [row['id'] for row in page] == sorted(row['id'] for row in page)
+
+    def test_ndjson(self, client, rows):
+        expected = unclassified(rows)
+        response = client.get('/db_info/unclassified', params={'after': expected[0]['id'] - 1, 'format': 'ndjson'})
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        assert 'etag' in response.headers
+        assert [json.loads(line) for line in response.text.splitlines()] == expected
+
+    def test_bad_parameters(self, client):
+        assert client.get('/db_info/unclassified', params={'format': 'xml'}).status_code == 422
+        assert client.get('/db_info/unclassified', params={'limit': 0}).status_code == 422
+
+    def test_if_none_match(self, client, rows):
+        params = {'after': unclassified(rows)[0]['id'] - 1, 'limit': 10}
+        response = client.get('/db_info/unclassified', params=params)
+        etag = response.headers['etag']
+        not_modified = client.get('/db_info/unclassified', params=params, headers={'If-None-Match': etag})
+        assert not_modified.status_code == 304
+        assert not_modified.headers['etag'] == etag
+        assert not_modified.content == b''
+        #other pages have their own tag
+        assert client.get('/db_info/unclassified', params={**params, 'limit': 1}, headers={'If-None-Match': etag}).status_code == 200
+        #an upload that writes db_info rows moves the tags on
+        with Session() as db:
+            assert create_multiple_db_info_from_raw(db, json.dumps([{'db_name': 'main_unclassified_new', 'owner_id': LONER, 'classification': 0}]))['success']
+        response = client.get('/db_info/unclassified', params=params, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['etag'] != etag
+        assert response.json()[-1]['db_name'] == 'main_unclassified_new'
+
+
+class TestStatsEndpoint:
+
+    def test_owner_and_manager(self, client):
+        response = client.get('/db_info/stats', params={'owner_id': OWNER_B})
+        assert response.status_code == 200
+        assert response.json() == {'scope': 'owner', 'key': OWNER_B, 'counts': {'UNCLASSIFIED': 2, 'LOW': 1, 'MEDIUM': 0, 'HIGH': 1}, 'total': 4}
+        #only the boss's direct reports
+        response = client.get('/db_info/stats', params={'manager_id': BOSS})
+        assert response.json() == {'scope': 'manager', 'key': BOSS, 'counts': {'UNCLASSIFIED': 1, 'LOW': 0, 'MEDIUM': 0, 'HIGH': 1}, 'total': 2}
+
+    def test_total(self, client):
+        stats = client.get('/db_info/stats').json()
+        assert (stats['scope'], stats['key']) == ('total', None)
+        assert stats['total'] == sum(stats['counts'].values())
+        assert stats['counts']['HIGH'] >= 2
+
+    def test_owner_and_manager_together(self, client):
+        assert client.get('/db_info/stats', params={'owner_id': OWNER_B, 'manager_id': BOSS}).status_code == 400
+
+
+class TestExportEndpoint:
+
+    def test_csv(self, client, rows):
+        response = client.get('/db_info/export')
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/csv')
+        assert response.headers['content-disposition'] == 'attachment; filename="db_info_export.csv"'
+        lines = list(csv.reader(io.StringIO(response.text)))
+        assert tuple(lines[0]) == EXPORT_COLUMNS
+        exported = {line[1]: line for line in lines[1:]}
+        assert exported['main_high_1'] == [str(rows['main_high_1']['id']), 'main_high_1', 'HIGH', str(OWNER_B), 'main_b@company.com', str(OWNER_A), 'main_a@company.com']
+        assert exported['main_low'][2] == 'LOW'
+
+    def test_ndjson_by_classification(self, client, rows):
+        response = client.get('/db_info/export', params={'format': 'ndjson', 'classification': ['high', 'low']})
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        exported = [json.loads(line) for line in response.text.splitlines()]
+        assert {entry['classification'] for entry in exported} <= {'HIGH', 'LOW'}
+        ours = [entry for entry in exported if entry['owner_id'] in EMPLOYEE_IDS]
+        assert [entry['db_name'] for entry in ours] == ['main_high_0', 'main_high_1', 'main_low']
+        assert ours[0] == {'id': rows['main_high_0']['id'], 'db_name': 'main_high_0', 'classification': 'HIGH', 'owner_id': OWNER_A,
+                           'owner_mail': 'main_a@company.com', 'manager_id': BOSS, 'manager_mail': 'main_boss@company.com'}
+
+    def test_bad_classification(self, client):
+        assert client.get('/db_info/export', params={'classification': 'secret'}).status_code == 422
+
+
+class TestClosureEndpoints:
+
+    def test_subtree_dbs(self, client, rows):
+        response = client.get(f"/employees/{BOSS}/subtree/dbs")
+        assert response.status_code == 200
+        assert response.json() == [rows['main_high_0'], rows['main_high_1']]
+        assert 'x-next-after' not in response.headers
+        #OWNER_A's team is OWNER_A and OWNER_B
+        response = client.get(f"/employees/{OWNER_A}/subtree/dbs", params={'classification': 'unclassified', 'limit': 2})
+        assert response.json() == unclassified(rows)[:2]
+        assert response.headers['x-next-after'] == str(unclassified(rows)[1]['id'])
+        response = client.get(f"/employees/{OWNER_B}/subtree/dbs", params={'classification': 'unclassified', 'after': unclassified(rows)[1]['id']})
+        assert response.json() == unclassified(rows)[2:]
+
+    def test_escalation(self, client):
+        response = client.get(f"/employees/{OWNER_B}/escalation")
+        assert response.status_code == 200
+        assert response.json() == [
+            {'depth': 1, 'user_id': OWNER_A, 'user_mail': 'main_a@company.com'},
+            {'depth': 2, 'user_id': BOSS, 'user_mail': 'main_boss@company.com'},
+        ]
+        assert client.get(f"/employees/{OWNER_B}/escalation", params={'levels': 1}).json() == [{'depth': 1, 'user_id': OWNER_A, 'user_mail': 'main_a@company.com'}]
+        #the top of the tree has nobody above
+        assert client.get(f"/employees/{BOSS}/escalation").json() == []
+
+    def test_unknown_employee(self, client):
+        assert client.get('/employees/8899/subtree/dbs').status_code == 404
+        assert client.get('/employees/8899/escalation').status_code == 404
@@ -0,0 +1,121 @@
+import json
+import asyncio
+import pytest
+from types import SimpleNamespace
+from fastapi import FastAPI, Request, Response
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from sqlalchemy import event, text
+from sqlalchemy.orm import sessionmaker
+from database import Base, engine
+from crud import create_multiple_employees_from_stream, create_multiple_db_info_from_stream
+from notifier import SMTPConnectionPool, CircuitBreaker, RecipientRateLimiter, deliver_notifications
+from metrics import RequestMetricsMiddleware, render_metrics
+from compression import ResponseCompressionMiddleware
+
+Session = sessionmaker(bind=engine)
+
+@pytest.fixture(scope='class')
+def db_session():
+    Base.metadata.create_all(engine)
+    connection = engine.connect()
+    transaction = connection.begin()
+    session = Session(bind=connection)
+    nested = connection.begin_nested()
+
+    @event.listens_for(session, "after_transaction_end")
+    def end_savepoint(session, transaction):
+        nonlocal nested
+        if not nested.is_active:
+            nested = connection.begin_nested()
+
+    yield session
+
+    session.close()
+    transaction.rollback()
+    connection.close()
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+#Runs `action` and returns how much each of the samples grew
+def growth(samples, action):
+    before = [sample(name, **labels) for name, labels in samples]
+    action()
+    return [sample(name, **labels) - value for (name, labels), value in zip(samples, before)]
+
+
+class TestMetrics:
+
+    def test_ingest_rows_are_counted_by_stage(self, db_session):
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+8000,8000,True,8000,metrics0@company.com
+8001,8001,True,8000,metrics1@company.com
+8002,8000,True,8000,duplicated@company.com
+"""
+        stages = ['parsed', 'validated', 'inserted', 'rejected']
+        samples = [('ingest_rows_total', {'kind': 'employee', 'stage': stage}) for stage in stages]
+        samples.append(('ingest_batch_failures_total', {'kind': 'employee'}))
+        assert growth(samples, lambda: create_multiple_employees_from_stream(db_session, [raw_csv], batch_size=2)) == [3, 3, 2, 0, 1]
+
+        raw_json = json.dumps([
+            {'db_name': 'metrics_a', 'owner_id': 8000, 'classification': 1},
+            {'db_name': 'metrics_b', 'owner_id': 999999, 'classification': 1},
+            {'db_name': 'metrics_c', 'owner_id': 8001, 'classification': -1},
+            {'db_name': 'metrics_d', 'owner_id': 8001, 'classification': 2},
+        ])
+        samples = [('ingest_rows_total', {'kind': 'db_info', 'stage': stage}) for stage in stages]
+        assert growth(samples, lambda: create_multiple_db_info_from_stream(db_session, [raw_json], batch_size=1)) == [4, 2, 2, 2]
+
+    def test_query_time_is_recorded(self, db_session):
+        samples = [('db_query_seconds_count', {'engine': 'sync', 'statement': 'SELECT'})]
+        assert growth(samples, lambda: db_session.execute(text('SELECT 1'))) == [1]
+
+    def test_smtp_failures_are_counted(self):
+        samples = [('smtp_send_seconds_count', {}), ('smtp_send_failures_total', {})]
+        with SMTPConnectionPool('localhost', 1, size=1, timeout=1) as pool:
+            notifications = [(False, [('db', 'owner@company.com')], 'manager@company.com')]
+            deliver = lambda: deliver_notifications(notifications, breaker=CircuitBreaker(), limiter=RecipientRateLimiter(rate=0), pool=pool)
+            assert growth(samples, deliver) == [1, 1]
+
+    def test_request_latency_is_recorded_by_route(self):
+        route = SimpleNamespace(path='/items/{item_id}')
+
+        async def app(scope, receive, send):
+            scope['route'] = route
+            await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def send(message):
+            pass
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/items/1'}
+        samples = [
+            ('http_request_duration_seconds_count', {'method': 'GET', 'route': '/items/{item_id}'}),
+            ('http_requests_total', {'method': 'GET', 'route': '/items/{item_id}', 'status': '404'}),
+        ]
+        assert growth(samples, lambda: asyncio.run(RequestMetricsMiddleware(app)(scope, None, send))) == [1, 1]
+
+    def test_compressed_conditional_requests_are_recorded(self):
+        app = FastAPI()
+        app.add_middleware(ResponseCompressionMiddleware, minimum_size=10)
+        app.add_middleware(RequestMetricsMiddleware)
+
+        @app.get('/metrics_etag')
+        def tagged(request: Request):
+            if request.headers.get('if-none-match') == '"abc"':
+                return Response(status_code=304, headers={'ETag': '"abc"'})
+            return Response('x' * 100, media_type='text/plain', headers={'ETag': '"abc"'})
+
+        client = TestClient(app)
+        samples = [
+            ('http_request_duration_seconds_count', {'method': 'GET', 'route': '/metrics_etag'}),
+            ('http_requests_total', {'method': 'GET', 'route': '/metrics_etag', 'status': '304'}),
+        ]
+        request = lambda: client.get('/metrics_etag', headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"abc-gzip"'})
+        assert growth(samples, lambda: request().status_code) == [1, 1]
+
+    def test_render_metrics(self):
+        content, content_type = render_metrics()
+        assert content_type.startswith('text/plain')
+        assert b'# TYPE http_request_duration_seconds histogram' in content
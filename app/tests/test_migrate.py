@@ -0,0 +1,80 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+from database import Base, engine
+import pytest
+from migrate import available_migrations, run_migrations, load_migration
+
+
+class TestMigrate:
+
+    def test_available_migrations_in_order(self):
+        versions = [version for version, _ in available_migrations()]
+        assert versions == sorted(versions)
+        assert versions[:2] == [1, 2]
+
+    def test_migrations_from_scratch_match_models(self):
+        with engine.connect() as connection:
+            transaction = connection.begin()
+            try:
+                #run on an empty schema so the migrations build everything themselves
+                connection.execute(text('CREATE SCHEMA migration_test'))
+                connection.execute(text('SET LOCAL search_path TO migration_test'))
+                applied = run_migrations(connection)
+                assert applied == [version for version, _ in available_migrations()]
+                assert run_migrations(connection) == []
+                inspector = inspect(connection)
+                for table in Base.metadata.sorted_tables:
+                    columns = {c['name'] for c in inspector.get_columns(table.name, schema='migration_test')}
+                    assert columns == {c.name for c in table.columns}
+                    #unique constraints are reported as indexes too
+                    indexes = {i['name'] for i in inspector.get_indexes(table.name, schema='migration_test') if 'duplicates_constraint' not in i}
+                    assert indexes == {i.name for i in table.indexes}
+            finally:
+                transaction.rollback()
+
+    def test_db_info_key_is_name_and_owner(self):
+        with engine.connect() as connection:
+            transaction = connection.begin()
+            try:
+                connection.execute(text('CREATE SCHEMA migration_test'))
+                connection.execute(text('SET LOCAL search_path TO migration_test'))
+                for version in (1, 2):
+                    load_migration(version).upgrade(connection)
+                connection.execute(text("INSERT INTO employee (user_id, user_state, user_manager, user_mail, created_at) VALUES (1, true, 1, 'a@company.com', now()), (2, true, 1, 'b@company.com', now())"))
+                #the same name for two owners is fine, twice for the same owner is not
+                connection.execute(text("INSERT INTO db_info (db_name, owner_id, classification) VALUES ('prod', 1, 1), ('prod', 2, 1)"))
+                load_migration(3).upgrade(connection)
+                with pytest.raises(IntegrityError):
+                    with connection.begin_nested():
+                        connection.execute(text("INSERT INTO db_info (db_name, owner_id, classification) VALUES ('prod', 1, 3)"))
+                #a pair repeated before the key exists stops the migration
+                with pytest.raises(RuntimeError):
+                    with connection.begin_nested():
+                        connection.execute(text('DROP INDEX ux_db_info_db_name_owner_id'))
+                        connection.execute(text("INSERT INTO db_info (db_name, owner_id, classification) VALUES ('prod', 1, 3)"))
+                        load_migration(3).upgrade(connection)
+            finally:
+                transaction.rollback()
+
+    def test_db_info_key_of_an_earlier_0003_moves_to_name_and_owner(self):
+        with engine.connect() as connection:
+            transaction = connection.begin()
+            try:
+                connection.execute(text('CREATE SCHEMA migration_test'))
+                connection.execute(text('SET LOCAL search_path TO migration_test'))
+                for version in range(1, 8):
+                    load_migration(version).upgrade(connection)
+                #the key an earlier version of 0003 created
+                connection.execute(text('DROP INDEX ux_db_info_db_name_owner_id'))
+                connection.execute(text('CREATE UNIQUE INDEX ux_db_info_db_name ON db_info (db_name)'))
+                connection.execute(text("INSERT INTO employee (user_id, user_state, user_manager, user_mail, created_at) VALUES (1, true, 1, 'a@company.com', now()), (2, true, 1, 'b@company.com', now())"))
+                connection.execute(text("INSERT INTO db_info (db_name, owner_id, classification) VALUES ('prod', 1, 1)"))
+                load_migration(8).upgrade(connection)
+                connection.execute(text("INSERT INTO db_info (db_name, owner_id, classification) VALUES ('prod', 2, 1)"))
+                with pytest.raises(IntegrityError):
+                    with connection.begin_nested():
+                        connection.execute(text("INSERT INTO db_info (db_name, owner_id, classification) VALUES ('prod', 1, 3)"))
+                indexes = {i['name'] for i in inspect(connection).get_indexes('db_info', schema='migration_test')}
+                assert 'ux_db_info_db_name' not in indexes
+            finally:
+                transaction.rollback()
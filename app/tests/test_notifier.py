@@ -0,0 +1,175 @@
+import email
+import email.policy
+import pytest
+import smtplib
+from notifier import SMTPConnectionPool, CircuitBreaker, RecipientRateLimiter, deliver_notifications, is_permanent_failure, SENT, FAILED, REJECTED, DEFERRED
+from benchmarks.smtp_sink import SMTPSink
+
+
+@pytest.fixture()
+def smtp_sink(monkeypatch):
+    with SMTPSink(reject={'broken@company.com'}) as sink:
+        monkeypatch.setenv('MAIL_SERVER', sink.host)
+        monkeypatch.setenv('MAIL_PORT', str(sink.port))
+        yield sink
+
+
+class TestNotifier:
+
+    def test_notification_message(self, smtp_sink):
+        with SMTPConnectionPool() as pool:
+            outcomes = deliver_notifications([(False, [('test_db', 'owner@company.com')], 'manager@company.com')], pool=pool)
+        assert outcomes == [(SENT, None)]
+        assert len(smtp_sink.messages) == 1
+        sender, recipients, data = smtp_sink.messages[0]
+        assert sender == 'noreply@meli.local'
+        assert recipients == ['manager@company.com']
+        message = email.message_from_string(data, policy=email.policy.default)
+        assert message['Subject'] == 'Revisión de la DB test_db'
+        assert 'owner@company.com' in message.get_body().get_content()
+
+    def test_pool_is_reused_across_deliveries(self, smtp_sink):
+        notifications = [(False, [(f"db_{i}", f"owner{i}@company.com")], f"manager{i}@company.com") for i in range(40)]
+        notifications[7] = (False, [('db_7', 'owner7@company.com')], 'broken@company.com')
+        with SMTPConnectionPool(size=3) as pool:
+            for start in (0, 20):
+                outcomes = deliver_notifications(notifications[start:start + 20], breaker=CircuitBreaker(), limiter=RecipientRateLimiter(rate=0), pool=pool, workers=3)
+        assert [outcome for outcome, _ in outcomes] == [SENT] * 20
+        assert len(smtp_sink.messages) == 39
+        #the refused recipient closes its connection, the rest reuse the pooled ones in both calls
+        assert smtp_sink.connections <= 3 + 1
+
+    def test_pool_discards_failed_connections(self, smtp_sink):
+        with SMTPConnectionPool(size=1) as pool:
+            with pool.connection() as server:
+                first = server
+            with pytest.raises(RuntimeError):
+                with pool.connection() as server:
+                    assert server is first
+                    raise RuntimeError('send failed')
+            with pool.connection() as server:
+                assert server is not first
+
+    def test_pool_drops_stale_connections(self, smtp_sink, monkeypatch):
+        clock = FakeClock()
+        with SMTPConnectionPool(size=1, max_idle=60, clock=clock) as pool:
+            with pool.connection() as server:
+                first = server
+            with pool.connection() as server:
+                assert server is first
+            #idle for too long
+            clock.now = 61
+            with pool.connection() as server:
+                assert server is not first
+                second = server
+            #the mail server setting changed
+            with SMTPSink() as other:
+                monkeypatch.setenv('MAIL_SERVER', other.host)
+                monkeypatch.setenv('MAIL_PORT', str(other.port))
+                with pool.connection() as server:
+                    assert server is not second
+                    assert server.sock.getpeername()[1] == other.port
+                pool.close()
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeliveryControls:
+
+    def test_circuit_breaker(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(threshold=3, cooldown=60, clock=clock)
+        for _ in range(2):
+            breaker.record_failure()
+        assert breaker.before_send() == 0
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        clock.now = 20
+        assert breaker.before_send() == 40
+        #after the cooldown a single probe goes through
+        clock.now = 60
+        assert breaker.before_send() == 0
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.before_send() > 0
+        #a failed probe opens it again, a good one closes it
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        clock.now = 120
+        assert breaker.before_send() == 0
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.before_send() == 0
+
+    def test_success_resets_the_failure_count(self):
+        breaker = CircuitBreaker(threshold=2, clock=FakeClock())
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_recipient_rate_limiter(self):
+        clock = FakeClock()
+        limiter = RecipientRateLimiter(rate=2, per=60, clock=clock)
+        assert limiter.acquire('a@company.com') == 0
+        assert limiter.acquire('a@company.com') == 0
+        assert limiter.acquire('a@company.com') == pytest.approx(30)
+        #other recipients have their own bucket
+        assert limiter.acquire('b@company.com') == 0
+        clock.now = 30
+        assert limiter.acquire('a@company.com') == 0
+        assert limiter.acquire('a@company.com') > 0
+        assert RecipientRateLimiter(rate=0).acquire('a@company.com') == 0
+
+    def test_open_circuit_keeps_the_recipient_tokens(self):
+        breaker = CircuitBreaker(threshold=1, clock=FakeClock())
+        breaker.record_failure()
+        limiter = RecipientRateLimiter(rate=1, clock=FakeClock())
+        notifications = [(False, [('db_1', 'owner@company.com')], 'manager@company.com')]
+        outcomes = deliver_notifications(notifications, breaker=breaker, limiter=limiter, pool=SMTPConnectionPool('127.0.0.1', 1))
+        assert outcomes[0][0] == DEFERRED
+        assert limiter.acquire('manager@company.com') == 0
+        #a token taken for an email that was not sent is given back
+        limiter.release('manager@company.com')
+        assert limiter.acquire('manager@company.com') == 0
+
+    def test_is_permanent_failure(self):
+        assert is_permanent_failure(smtplib.SMTPRecipientsRefused({'a@company.com': (550, b'mailbox unavailable')}))
+        assert not is_permanent_failure(smtplib.SMTPRecipientsRefused({'a@company.com': (450, b'try again later')}))
+        assert is_permanent_failure(smtplib.SMTPDataError(554, b'rejected'))
+        assert not is_permanent_failure(smtplib.SMTPServerDisconnected('gone'))
+        assert not is_permanent_failure(TimeoutError())
+
+    def test_deliver_notifications(self, smtp_sink):
+        notifications = [
+            (False, [('db_1', 'owner1@company.com')], 'manager@company.com'),
+            (True, [('db_2', 'owner2@company.com'), ('db_3', 'owner2@company.com')], 'manager@company.com'),
+            (False, [('db_4', 'owner4@company.com')], 'broken@company.com'),
+            (False, [('db_5', 'owner5@company.com')], 'manager@company.com'),
+        ]
+        breaker = CircuitBreaker(clock=FakeClock())
+        limiter = RecipientRateLimiter(rate=2, clock=FakeClock())
+        with SMTPConnectionPool(size=2) as pool:
+            outcomes = deliver_notifications(notifications, breaker=breaker, limiter=limiter, pool=pool, workers=2)
+        assert [outcome for outcome, _ in outcomes] == [SENT, SENT, REJECTED, DEFERRED]
+        assert outcomes[3][1] > 0
+        assert len(smtp_sink.messages) == 2
+        #a refusal means the server is working
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_deliver_notifications_server_down(self, monkeypatch):
+        with SMTPSink() as sink:
+            port = sink.port
+        notifications = [(False, [(f"db_{i}", 'owner@company.com')], f"manager{i}@company.com") for i in range(5)]
+        breaker = CircuitBreaker(threshold=2, clock=FakeClock())
+        #one worker, so the sends happen in order and the circuit opens after the second failure
+        with SMTPConnectionPool('127.0.0.1', port, size=1) as pool:
+            outcomes = deliver_notifications(notifications, breaker=breaker, limiter=RecipientRateLimiter(rate=0), pool=pool, workers=1)
+        assert [outcome for outcome, _ in outcomes] == [FAILED, FAILED, DEFERRED, DEFERRED, DEFERRED]
+        assert breaker.state == CircuitBreaker.OPEN
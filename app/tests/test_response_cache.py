@@ -0,0 +1,104 @@
+import json
+import pytest
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event, text
+from database import Base, engine
+from migrate import load_migration
+from crud import create_multiple_employees_from_raw, create_multiple_db_info_from_raw
+from response_cache import ResponseCache, db_info_version, make_etag, etag_matches
+
+Session = sessionmaker(bind=engine)
+
+@pytest.fixture(scope='class')
+def db_session():
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text(load_migration(9).VERSION_TRIGGERS))
+    connection = engine.connect()
+    transaction = connection.begin()
+    session = Session(bind=connection)
+    nested = connection.begin_nested()
+
+    @event.listens_for(session, "after_transaction_end")
+    def end_savepoint(session, transaction):
+        nonlocal nested
+        if not nested.is_active:
+            nested = connection.begin_nested()
+
+    yield session
+
+    session.close()
+    transaction.rollback()
+    connection.close()
+
+
+class TestResponseCache:
+
+    def test_get_and_put(self):
+        cache = ResponseCache('test')
+        assert cache.get(1, 'a') is None
+        cache.put(1, 'a', b'body', {'X-Next-After': '1'})
+        assert cache.get(1, 'a') == (b'body', {'X-Next-After': '1'})
+
+    def test_newer_version_drops_entries(self):
+        cache = ResponseCache('test')
+        cache.put(1, 'a', b'body')
+        assert cache.get(2, 'a') is None
+        assert cache.stats() == {'version': 2, 'entries': 0, 'bytes': 0}
+        #a response built from an older version is neither served nor stored
+        cache.put(1, 'a', b'stale')
+        assert cache.get(1, 'a') is None
+        assert cache.get(2, 'a') is None
+        assert cache.stats()['version'] == 2
+
+    def test_bounded_by_entries_and_bytes(self):
+        cache = ResponseCache('test', max_bytes=10, max_entries=2)
+        cache.put(1, 'a', b'aaaa')
+        cache.put(1, 'b', b'bbbb')
+        cache.get(1, 'a')
+        cache.put(1, 'c', b'cccc')
+        #b was the least recently used
+        assert cache.get(1, 'b') is None
+        assert cache.get(1, 'a') is not None
+        cache.put(1, 'd', b'dddddddd')
+        assert cache.stats()['bytes'] <= 10
+        #bigger than the whole cache, never stored
+        cache.put(1, 'e', b'e' * 11)
+        assert cache.get(1, 'e') is None
+
+    def test_etag(self):
+        etag = make_etag(1, ('json', None, 10))
+        assert etag == make_etag(1, ('json', None, 10))
+        assert etag != make_etag(1, ('json', None, 20))
+        assert etag.startswith('"') and etag.endswith('"')
+        assert etag_matches(etag, etag)
+        assert etag_matches(f'"other", W/{etag}', etag)
+        assert etag_matches('*', etag)
+        assert not etag_matches(None, etag)
+        assert not etag_matches('"other"', etag)
+        assert etag != make_etag(2, ('json', None, 10))
+
+    def test_db_info_uploads_bump_the_version(self, db_session):
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+1,9300,True,9300,cache@company.com
+"""
+        before = db_info_version.current(db_session)
+        assert create_multiple_employees_from_raw(db_session, raw_csv)['success']
+        assert db_info_version.current(db_session) == before
+        raw_json = json.dumps([{'db_name': 'cache_a', 'owner_id': 9300, 'classification': 0}])
+        assert create_multiple_db_info_from_raw(db_session, raw_json, upsert=True)['success']
+        after_upload = db_info_version.current(db_session)
+        assert after_upload != before
+        #an upsert that changes nothing keeps the cached responses
+        assert create_multiple_db_info_from_raw(db_session, raw_json, upsert=True)['success']
+        assert db_info_version.current(db_session) == after_upload
+
+    def test_writes_outside_crud_are_seen(self, db_session):
+        raw_csv = """row_id,user_id,user_state,user_manager,user_mail
+1,9301,True,9301,other@company.com
+"""
+        assert create_multiple_employees_from_raw(db_session, raw_csv)['success']
+        before = db_info_version.current(db_session)
+        #a write that doesn't go through crud, as another worker or psql would make it
+        db_session.execute(text("INSERT INTO db_info (db_name, owner_id, classification) VALUES ('outside', 9301, 0)"))
+        assert db_info_version.current(db_session) > before
@@ -0,0 +1,89 @@
+import io
+import csv
+import json
+import pytest
+from streaming import iter_text_chunks, iter_parsed, LineSplitter, CSVDictStream, JSONArrayStream, split_csv_shards, split_json_array_shards
+
+
+class TestStreaming:
+
+    def test_iter_text_chunks_multibyte_split(self):
+        raw = 'revisión,ñandú\n'.encode('utf-8')
+        #chunk size of 1 byte splits every multibyte character
+        chunks = list(iter_text_chunks(io.BytesIO(raw), chunk_size=1))
+        assert ''.join(chunks) == 'revisión,ñandú\n'
+
+    def test_line_splitter_keeps_partial_lines(self):
+        splitter = LineSplitter()
+        assert splitter.feed('a,b\nc,') == ['a,b\n']
+        assert splitter.feed('d\ne') == ['c,d\n']
+        assert splitter.close() == ['e']
+        assert splitter.close() == []
+
+    def test_line_splitter_breaks_only_at_newlines(self):
+        splitter = LineSplitter()
+        assert splitter.feed('a\x0bb\x0c\u2028c\r\nd\x85\n') == ['a\x0bb\x0c\u2028c\r\n', 'd\x85\n']
+        assert splitter.close() == []
+
+    def test_csv_dict_stream(self):
+        parser = CSVDictStream()
+        rows = parser.feed('user_id,user_mail\n1,a@company.com\n2,b@com')
+        rows += parser.feed('pany.com')
+        rows += parser.close()
+        assert rows == [{'user_id': '1', 'user_mail': 'a@company.com'}, {'user_id': '2', 'user_mail': 'b@company.com'}]
+
+    def test_csv_dict_stream_quoted_line_breaks(self):
+        raw = 'db_name,owner_id\r\n"multi\nline, ""quoted""",1\r\n"tab\x0bform\x0cfeed\u2028",2\r\n'
+        for size in (1, 3, len(raw)):
+            chunks = [raw[i:i + size] for i in range(0, len(raw), size)]
+            assert list(iter_parsed(CSVDictStream(), chunks)) == list(csv.DictReader(io.StringIO(raw, newline='')))
+        assert list(iter_parsed(CSVDictStream(), [raw]))[0]['db_name'] == 'multi\nline, "quoted"'
+
+    def test_json_array_stream(self):
+        raw = ' [ {"db_name": "a, \\"b\\"]", "owner_id": 1}, 12345 , [1, 2], null ,"x"]\n'
+        for size in (1, 2, 5, len(raw)):
+            chunks = [raw[i:i + size] for i in range(0, len(raw), size)]
+            assert list(iter_parsed(JSONArrayStream(), chunks)) == json.loads(raw)
+
+    def test_json_array_stream_empty(self):
+        assert list(iter_parsed(JSONArrayStream(), ['[', ' ]'])) == []
+
+    @pytest.mark.parametrize('raw', ['{"db_name": "a"}', '[1, 2', '[1 2]', '[1,]', '[1] 2', ''])
+    def test_json_array_stream_malformed(self, raw):
+        with pytest.raises(ValueError):
+            list(iter_parsed(JSONArrayStream(), [raw]))
+
+    def test_json_array_stream_item_too_big(self):
+        parser = JSONArrayStream(max_item_size=10)
+        with pytest.raises(ValueError):
+            parser.feed('[{"db_name": "' + 'a' * 20)
+
+    def test_split_csv_shards(self):
+        raw = 'user_id,user_mail\n' + ''.join(f"{i},user{i}@company.com\n" for i in range(100))
+        header, shards = split_csv_shards(raw, 4)
+        assert header == 'user_id,user_mail\n'
+        assert len(shards) == 4
+        assert all(shard.endswith('\n') for shard in shards)
+        assert header + ''.join(shards) == raw
+        #more shards than lines
+        assert split_csv_shards('a,b\n1,2\n', 8) == ('a,b\n', ['1,2\n'])
+
+    def test_split_csv_shards_inside_quoted_field(self):
+        raw = 'db_name,owner_id\n' + '"multi\nline",1\n' * 20
+        assert split_csv_shards(raw, 4) is None
+
+    def test_split_json_array_shards(self):
+        entries = [{'db_name': f"db_{i}", 'owner_id': i, 'classification': {'nested': [i]}} for i in range(50)]
+        raw = ' ' + json.dumps(entries, indent=1) + '\n'
+        shards = split_json_array_shards(raw, 4)
+        assert len(shards) == 4
+        assert [entry for shard in shards for entry in json.loads('[' + shard + ']')] == entries
+        assert split_json_array_shards('[]', 4) == ['']
+        assert split_json_array_shards('{"db_name": "a"}', 4) is None
+
+    def test_split_json_array_shards_inside_string(self):
+        #a boundary lookalike inside a string is cut, the shards don't parse
+        raw = '[{"db_name": "' + 'a},{' * 20 + '"}]'
+        shards = split_json_array_shards(raw, 2)
+        with pytest.raises(ValueError):
+            [json.loads('[' + shard + ']') for shard in shards]
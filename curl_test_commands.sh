@@ -9,3 +9,6 @@ curl localhost:8080/db_info/unclassified
 
 #notify
 curl -X POST localhost:8080/notify
+
+#notify job progress
+#curl localhost:8080/notify/<job_id>